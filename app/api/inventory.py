@@ -1,11 +1,13 @@
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, Query, Response, status
+from fastapi.responses import StreamingResponse
 
 from app.api.responses import (ALREADY_EXISTS, NOT_FOUND_RESPONSE,
                                SERVICE_ERROR, UNEXPECTED_ERROR)
 from app.inventory.common import get_current_user
-from app.inventory.schemas import (InventoryResponse, ItemToInventory,
+from app.inventory.schemas import (BatchGrant, GrantResult,
+                                   InventoryResponse, ItemToInventory,
                                    SuccessResponse, UseItem, UserInfo)
 from app.services.inventory_service import (
     InventoryService, get_inventory_service
@@ -60,6 +62,28 @@ async def add_to_inventory(
     return SuccessResponse(detail="Item added")
 
 
+@router.post(
+    '/grant_batch',
+    response_model=list[GrantResult],
+    summary=(
+        "Пакетно начислить предметы в инвентари пользователей. "
+        "Доступно только администраторам"
+    ),
+    description=(
+        "Принимает список начислений (user_id, item_id, amount) и "
+        "возвращает результат для каждого из них"
+    ),
+)
+async def grant_batch(
+        batch: BatchGrant,
+        inventory_service: Annotated[
+            InventoryService, Depends(get_inventory_service)
+        ],
+        user: Annotated[UserInfo, Depends(get_current_user)],
+):
+    return await inventory_service.grant_items(batch, user)
+
+
 @router.patch(
     '/use_item',
     response_model=SuccessResponse,
@@ -96,11 +120,42 @@ async def get_user_inventory(
     return await inventory_service.get_user_inventory(user)
 
 
+@router.get(
+    '/user_inventories',
+    response_model=list[InventoryResponse],
+    summary="Получить инвентари нескольких игроков",
+    description=(
+        "Возвращает инвентари пользователей с переданными ID. "
+        "Пользователи без инвентаря в ответ не попадают"
+    ),
+)
+async def get_user_inventories(
+        inventory_service: Annotated[
+            InventoryService, Depends(get_inventory_service)
+        ],
+        user: Annotated[UserInfo, Depends(get_current_user)],
+        user_ids: Annotated[
+            list[int], Query(min_length=1, max_length=1000)
+        ],
+):
+    """
+    Получить инвентари нескольких игроков, например, при старте матча.
+
+    - **returns**: Инвентари пользователей
+    """
+    return await inventory_service.get_user_inventories(user_ids)
+
+
 @router.get(
     '/all_inventory_with_item',
     response_model=list[InventoryResponse],
+    responses=NOT_FOUND_RESPONSE,
     summary="Получить все инвентари игроков, содержащие предмет с ID",
-    description="Возвращает инвентари пользователей",
+    description=(
+        "Возвращает страницу инвентарей пользователей. Курсор следующей "
+        "страницы передаётся в заголовке X-Next-Cursor. С stream=true "
+        "возвращает все инвентари потоком в формате NDJSON"
+    ),
 )
 async def get_all_inventory_with_item(
         inventory_service: Annotated[
@@ -108,11 +163,28 @@ async def get_all_inventory_with_item(
             Depends(get_inventory_service)
         ],
         item_id: int,
-        user: Annotated[UserInfo, Depends(get_current_user)]
+        user: Annotated[UserInfo, Depends(get_current_user)],
+        response: Response,
+        after: Annotated[int | None, Query(ge=0)] = None,
+        limit: Annotated[int, Query(gt=0, le=1000)] = 100,
+        stream: bool = False
 ):
     """
     Получить все инвентари игроков, содержащие предмет с ID.
 
-    - **returns**: Инвентари пользователя
+    - **after**: inventory_id последнего инвентаря предыдущей страницы
+    - **limit**: размер страницы
+    - **stream**: вернуть все инвентари потоком NDJSON
+    - **returns**: Инвентари пользователей
     """
-    return await inventory_service.get_all_with_item(item_id)
+    if stream:
+        return StreamingResponse(
+            await inventory_service.stream_all_with_item(item_id),
+            media_type='application/x-ndjson'
+        )
+    inventories, next_cursor = await inventory_service.get_all_with_item(
+        item_id, after_inventory_id=after, limit=limit
+    )
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = str(next_cursor)
+    return inventories
@@ -1,6 +1,6 @@
 from typing import Annotated
 
-from fastapi import APIRouter, Path, Request
+from fastapi import APIRouter, Path
 from fastapi.params import Depends
 
 from app.api.responses import (NOT_FOUND_RESPONSE, SERVICE_ERROR,
@@ -58,12 +58,11 @@ async def delete_item(
     tags=['admin']
 )
 async def create_item(
-        request: Request,
         item: ItemCreate,
         item_service: Annotated[ItemService, Depends(get_item_service)],
         user: Annotated[UserInfo, Depends(get_current_user)]
 ):
-    return await item_service.create_item(item, user, request)
+    return await item_service.create_item(item, user)
 
 
 @router.get(
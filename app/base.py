@@ -4,22 +4,31 @@ from sqlalchemy import exists
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.future import select
 
-from app.database import get_session
 from app.exceptions import DatabaseError, RepositoryError
+from app.query_cache import cached_query, invalidates
+from app.replicas import replica_read
 
 logger = logging.getLogger(__name__)
 
 
 class BaseDAO:
+    """
+    Базовый репозиторий. Методы выполняются в сессии единицы работы
+    (app.database.unit_of_work) и не коммитят её сами
+    """
     model = None
 
     @classmethod
-    async def find_one_or_none_by_id(cls, data_id: int):
+    @cached_query(
+        '{model}.by_id',
+        tags=('{model}',),
+        schema=lambda cls: cls.model | None
+    )
+    async def find_one_or_none_by_id(cls, session, data_id: int):
         try:
-            async with get_session() as session:
-                query = select(cls.model).filter_by(id=data_id)
-                result = await session.exec(query)
-                return result.scalar_one_or_none()
+            query = select(cls.model).filter_by(id=data_id)
+            result = await session.exec(query)
+            return result.scalar_one_or_none()
         except SQLAlchemyError as e:
             logger.error(f"Database error for item_id {data_id}: {e}")
             raise DatabaseError(f"Failed to fetch item {data_id}") from e
@@ -28,12 +37,16 @@ class BaseDAO:
             raise RepositoryError("Repository operation failed") from e
 
     @classmethod
-    async def find_one_or_none(cls, **filter_by):
+    @cached_query(
+        '{model}.one',
+        tags=('{model}',),
+        schema=lambda cls: cls.model | None
+    )
+    async def find_one_or_none(cls, session, **filter_by):
         try:
-            async with get_session() as session:
-                query = select(cls.model).filter_by(**filter_by)
-                result = await session.exec(query)
-                return result.scalar_one_or_none()
+            query = select(cls.model).filter_by(**filter_by)
+            result = await session.exec(query)
+            return result.scalar_one_or_none()
         except SQLAlchemyError as e:
             logger.error(f"Database error: {e}")
             raise DatabaseError("Failed to fetch find item") from e
@@ -42,12 +55,17 @@ class BaseDAO:
             raise RepositoryError("Repository operation failed") from e
 
     @classmethod
-    async def find_all(cls, **filter_by):
+    @cached_query(
+        '{model}.all',
+        tags=('{model}',),
+        schema=lambda cls: list[cls.model]
+    )
+    @replica_read('{model}')
+    async def find_all(cls, session, **filter_by):
         try:
-            async with get_session() as session:
-                query = select(cls.model).filter_by(**filter_by)
-                result = await session.exec(query)
-                return result.scalars().all()
+            query = select(cls.model).filter_by(**filter_by)
+            result = await session.exec(query)
+            return result.scalars().all()
         except SQLAlchemyError as e:
             logger.error(f"Database error: {e}")
             raise DatabaseError("Failed to fetch find all items") from e
@@ -56,13 +74,13 @@ class BaseDAO:
             raise RepositoryError("Repository operation failed") from e
 
     @classmethod
-    async def add(cls, values):
+    @invalidates('{model}')
+    async def add(cls, session, values):
         try:
-            async with get_session() as session:
-                async with session.begin():
-                    new_instance = cls.model(**values)
-                    session.add(new_instance)
-                    return new_instance
+            new_instance = cls.model(**values)
+            session.add(new_instance)
+            await session.flush()
+            return new_instance
         except SQLAlchemyError as e:
             logger.error(f"Database error: {e}")
             raise DatabaseError("Failed to add new item") from e
@@ -71,12 +89,12 @@ class BaseDAO:
             raise RepositoryError("Repository operation failed") from e
 
     @classmethod
-    async def check_exists(self, item_id: int) -> bool:
+    @cached_query('{model}.exists', tags=('{model}',))
+    async def check_exists(self, session, item_id: int) -> bool:
         try:
-            async with get_session() as session:
-                query = select(exists().where(self.model.id == item_id))
-                result = await session.exec(query)
-                return result.scalar()
+            query = select(exists().where(self.model.id == item_id))
+            result = await session.exec(query)
+            return result.scalar()
         except SQLAlchemyError as e:
             logger.error(f"Database error for item_id {item_id}: {e}")
             raise DatabaseError(f"Failed to fetch item {item_id}") from e
@@ -85,13 +103,13 @@ class BaseDAO:
             raise RepositoryError("Repository operation failed") from e
 
     @classmethod
-    async def delete_one_by_id(cls, data_id: int):
+    @invalidates('{model}')
+    async def delete_one_by_id(cls, session, data_id: int):
         try:
-            async with get_session() as session:
-                async with session.begin():
-                    obj = await session.get(cls.model, data_id)
-                    await session.delete(obj)
-                    return None
+            obj = await session.get(cls.model, data_id)
+            await session.delete(obj)
+            await session.flush()
+            return None
         except SQLAlchemyError as e:
             logger.error(f"Database error for item_id {data_id}: {e}")
             raise DatabaseError(f"Failed to delete item {data_id}") from e
@@ -0,0 +1,979 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from logging.handlers import RotatingFileHandler
+from typing import (Any, AsyncIterator, Awaitable, Callable, Hashable,
+                    NamedTuple)
+
+from redis.asyncio import BlockingConnectionPool, Redis
+from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import TimeoutError as RedisTimeoutError
+
+from app.codec import cache_serializer
+from app.config import settings
+from app.exceptions import CacheUnavailableError
+from app.metrics import (CACHE_BREAKER_STATE, CACHE_ERRORS, CACHE_LOADS,
+                         CACHE_LOADS_COALESCED, CACHE_REFRESHES,
+                         CACHE_REJECTED)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+handler = RotatingFileHandler(
+    os.path.join(settings.LOG_PATH, 'app.log'),
+    maxBytes=50000,
+    backupCount=1
+)
+logger.addHandler(handler)
+formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+handler.setFormatter(formatter)
+
+# Не держим redis на одной команде DEL с огромным числом ключей
+DELETE_CHUNK_SIZE = 500
+
+# Версионированная запись - hash с полем version. Поле stale помечает
+# метку версии без данных: она только не даёт записать более старое
+# состояние и при чтении считается промахом. Запись той же версии
+# разрешена: так фоновое обновление продлевает срок годности.
+SET_VERSIONED_SCRIPT = """
+local current = tonumber(redis.call('HGET', KEYS[1], 'version'))
+if current and current > tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], 'version', ARGV[1], unpack(ARGV, 3))
+if tonumber(ARGV[2]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+PATCH_VERSIONED_SCRIPT = """
+local current = tonumber(redis.call('HGET', KEYS[1], 'version'))
+local version = tonumber(ARGV[1])
+if current and current >= version then
+    return 0
+end
+if current == version - 1
+        and redis.call('HEXISTS', KEYS[1], 'stale') == 0 then
+    local deleted = tonumber(ARGV[3])
+    for i = 4, 3 + deleted do
+        redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+    if #ARGV > 3 + deleted then
+        redis.call('HSET', KEYS[1], unpack(ARGV, 4 + deleted))
+    end
+    redis.call('HSET', KEYS[1], 'version', ARGV[1])
+    return 1
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], 'version', ARGV[1], 'stale', 1)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return -1
+"""
+
+# Метка версии без изменения: изменение нельзя выразить полями записи
+MARK_STALE_SCRIPT = """
+local current = tonumber(redis.call('HGET', KEYS[1], 'version'))
+if current and current >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], 'version', ARGV[1], 'stale', 1)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+# Ключ записи с тегами - префикс и текущие версии тегов (KEYS[2..]).
+# Смена версии тега делает недоступными все записи с ним, а запись,
+# загруженная из БД до смены, попадает под старый ключ. Читаемый ключ
+# не передаётся в KEYS: скрипт рассчитан на redis без кластера
+GET_TAGGED_SCRIPT = """
+local key = KEYS[1]
+if #KEYS > 1 then
+    local versions = redis.call('MGET', unpack(KEYS, 2))
+    for i = 1, #versions do
+        versions[i] = versions[i] or '0'
+    end
+    key = key .. ':' .. table.concat(versions, '.')
+end
+return {key, redis.call('GET', key)}
+"""
+
+
+class CacheEntry(NamedTuple):
+    """
+    Значение из кэша со сведениями для обновления до истечения срока.
+    Ключ в redis живёт CACHE_EXPIRE + CACHE_STALE_TTL секунд: после
+    мягкого срока expires_at значение ещё отдаётся, но обновляется в фоне
+    """
+    value: Any
+    delta: float  # сколько длилось вычисление значения, с
+    expires_at: float  # мягкий срок годности, unix time
+
+    @classmethod
+    def fresh(cls, value: Any, delta: float) -> 'CacheEntry':
+        return cls(value, delta, time.time() + settings.CACHE_EXPIRE)
+
+    def needs_refresh(self) -> bool:
+        """
+        Вероятностное досрочное обновление (XFetch): чем ближе срок
+        и чем дольше вычисление, тем выше вероятность обновить значение
+        раньше, поэтому обновления разных ключей и процессов
+        не совпадают по времени.
+        """
+        jitter = -self.delta * settings.CACHE_XFETCH_BETA * math.log(
+            1.0 - random.random()
+        )
+        return time.time() + jitter >= self.expires_at
+
+    def dumps(self, payload: Any) -> bytes:
+        """Упаковать JSON-совместимое представление значения"""
+        return cache_serializer.dumps({
+            'value': payload,
+            'delta': self.delta,
+            'expires_at': self.expires_at
+        })
+
+    @staticmethod
+    def loads(raw: bytes) -> tuple[Any, float, float]:
+        """
+        :return: JSON-представление значения, delta и expires_at
+        :raises ValueError: если значение в другом формате
+        """
+        data = cache_serializer.loads(raw)
+        return data['value'], data['delta'], data['expires_at']
+
+
+def cache_ttl() -> int:
+    """Время жизни ключа в redis: мягкий срок плюс окно устаревших данных"""
+    return settings.CACHE_EXPIRE + settings.CACHE_STALE_TTL
+
+
+RedisKey = str | bytes
+RedisValue = str | bytes | int | float
+
+# Ошибки, означающие недоступность redis, а не ошибку в команде
+UNAVAILABLE_ERRORS = (RedisConnectionError, RedisTimeoutError, OSError)
+
+
+class CircuitBreaker:
+    """
+    Размыкатель: после failure_threshold ошибок подряд размыкается
+    на reset_timeout секунд, и вызовы отклоняются без обращения к redis.
+    Затем пропускает один пробный вызов: успех замыкает размыкатель,
+    ошибка размыкает снова.
+    """
+    CLOSED, OPEN, HALF_OPEN = 0, 1, 2
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int,
+        reset_timeout: float
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._set_state(self.CLOSED)
+
+    def _set_state(self, state: int) -> None:
+        self.state = state
+        CACHE_BREAKER_STATE.labels(self.name).set(state)
+
+    def allow(self) -> bool:
+        """:return: можно ли выполнить вызов"""
+        if self.state == self.CLOSED:
+            return True
+        if (
+            self.state == self.OPEN
+            and time.monotonic() - self.opened_at >= self.reset_timeout
+        ):
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._probing = False
+        if self.state != self.CLOSED:
+            logger.info(f'Circuit breaker {self.name} closed')
+            self._set_state(self.CLOSED)
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if (
+            self.state == self.HALF_OPEN
+            or self.failures >= self.failure_threshold
+        ):
+            if self.state != self.OPEN:
+                logger.warning(f'Circuit breaker {self.name} opened')
+            self.opened_at = time.monotonic()
+            self._set_state(self.OPEN)
+
+    def record_cancelled(self) -> None:
+        """Отменённый пробный вызов не решает судьбу размыкателя"""
+        self._probing = False
+
+
+class CacheBackend:
+    """
+    Redis-бэкенд кэша на пуле соединений redis.asyncio.
+    Значения хранятся и возвращаются как bytes; многоключевые операции
+    и изменения нескольких записей отправляются одним пайплайном.
+    Каждая операция ограничена таймаутом и проходит через размыкатель:
+    при недоступности redis методы сразу бросают CacheUnavailableError,
+    и сервисы работают напрямую с БД.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        pool_size: int | None = None,
+        pool_timeout: float | None = None,
+        socket_timeout: float | None = None,
+        connect_timeout: float | None = None,
+        read_timeout_ms: int | None = None,
+        write_timeout_ms: int | None = None
+    ):
+        """
+        :param url: адрес redis (redis://host:port/db)
+        :param pool_size: максимум соединений; при исчерпании запрос ждёт
+        свободное соединение не дольше pool_timeout секунд
+        :param socket_timeout: таймаут ответа redis на команду, с
+        :param connect_timeout: таймаут установки соединения, с
+        :param read_timeout_ms: таймаут операции чтения целиком, мс
+        :param write_timeout_ms: таймаут операции записи целиком, мс
+        """
+        self._url = url
+        self._connect_timeout = (
+            connect_timeout or settings.REDIS_CONNECT_TIMEOUT
+        )
+        self._read_timeout = (
+            read_timeout_ms or settings.CACHE_READ_TIMEOUT_MS
+        ) / 1000
+        self._write_timeout = (
+            write_timeout_ms or settings.CACHE_WRITE_TIMEOUT_MS
+        ) / 1000
+        self.breaker = CircuitBreaker(
+            'redis',
+            failure_threshold=settings.CACHE_BREAKER_FAILURES,
+            reset_timeout=settings.CACHE_BREAKER_RESET_MS / 1000
+        )
+        self._pool = BlockingConnectionPool.from_url(
+            url,
+            max_connections=pool_size or settings.REDIS_POOL_SIZE,
+            timeout=pool_timeout or settings.REDIS_POOL_TIMEOUT,
+            socket_timeout=socket_timeout or settings.REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=self._connect_timeout,
+            socket_keepalive=True,
+            health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL
+        )
+        self._client = Redis(connection_pool=self._pool)
+        self._set_versioned = self._client.register_script(
+            SET_VERSIONED_SCRIPT
+        )
+        self._patch_versioned = self._client.register_script(
+            PATCH_VERSIONED_SCRIPT
+        )
+        self._mark_stale = self._client.register_script(MARK_STALE_SCRIPT)
+        self._get_tagged = self._client.register_script(GET_TAGGED_SCRIPT)
+        self._release_lock = self._client.register_script(RELEASE_LOCK_SCRIPT)
+        # Ключи, которые не удалось удалить: удаляются повторно после
+        # первой успешной операции, иначе устаревшие записи отдавались бы
+        # до истечения срока жизни. Хранятся в памяти процесса и теряются
+        # при его перезапуске
+        self._pending_deletes: set[str] = set()
+        self._replay_task: asyncio.Task | None = None
+
+    async def _call(
+        self,
+        operation: Callable[[], Awaitable],
+        timeout: float
+    ) -> Any:
+        """
+        Выполнить операцию с таймаутом через размыкатель.
+        :raises CacheUnavailableError: размыкатель открыт, таймаут
+        или ошибка соединения
+        """
+        if not self.breaker.allow():
+            CACHE_REJECTED.labels(self.breaker.name).inc()
+            raise CacheUnavailableError('Cache circuit breaker is open')
+        try:
+            async with asyncio.timeout(timeout):
+                result = await operation()
+        except UNAVAILABLE_ERRORS as e:
+            self.breaker.record_failure()
+            CACHE_ERRORS.labels(self.breaker.name).inc()
+            raise CacheUnavailableError(
+                f'Cache operation failed: {e!r}'
+            ) from e
+        except BaseException:
+            self.breaker.record_cancelled()
+            raise
+        self.breaker.record_success()
+        if self._pending_deletes and self._replay_task is None:
+            self._replay_task = asyncio.ensure_future(self._replay_deletes())
+        return result
+
+    def _defer_deletes(self, keys: tuple) -> None:
+        pending = len(self._pending_deletes) + len(keys)
+        if pending > settings.CACHE_PENDING_DELETES_MAX:
+            # Эти ключи устареют не дольше чем на срок жизни записей
+            logger.error(f'Dropped {len(keys)} pending cache deletes')
+            return
+        self._pending_deletes.update(keys)
+
+    async def _replay_deletes(self) -> None:
+        """Повторить несостоявшиеся удаления во всех процессах"""
+        keys = tuple(self._pending_deletes)
+        self._pending_deletes.clear()
+        try:
+            await self.invalidate(settings.LOCAL_CACHE_CHANNEL, *keys)
+            logger.info(f'Replayed {len(keys)} cache deletes')
+        except Exception as e:
+            logger.error(f'Cache delete replay failed: {e}')
+        finally:
+            self._replay_task = None
+
+    async def ping(self) -> bool:
+        return await self._client.ping()
+
+    async def close(self) -> None:
+        await self._client.aclose()
+        await self._pool.disconnect()
+
+    async def get(self, key: RedisKey) -> bytes | None:
+        return await self._call(
+            lambda: self._client.get(key), self._read_timeout
+        )
+
+    async def set(
+        self,
+        key: RedisKey,
+        value: RedisValue,
+        expire: int = 0
+    ) -> bool:
+        """
+        :param expire: время жизни ключа, с (0 - без ограничения)
+        """
+        return bool(await self._call(
+            lambda: self._client.set(key, value, ex=expire or None),
+            self._write_timeout
+        ))
+
+    async def delete(self, key: RedisKey) -> int:
+        """
+        :raises CacheUnavailableError: ключ будет удалён повторно,
+        когда redis станет доступен
+        """
+        return await self.delete_many(key)
+
+    def _pipe_delete(self, pipe, keys: tuple) -> None:
+        for start in range(0, len(keys), DELETE_CHUNK_SIZE):
+            pipe.delete(*keys[start:start + DELETE_CHUNK_SIZE])
+
+    async def delete_many(self, *keys: RedisKey) -> int:
+        """
+        Удалить несколько ключей за один round trip.
+        Ключи отправляются многоключевыми DEL по DELETE_CHUNK_SIZE штук
+        :return: количество удалённых ключей
+        """
+        if not keys:
+            return 0
+
+        async def execute():
+            async with self._client.pipeline(transaction=False) as pipe:
+                self._pipe_delete(pipe, keys)
+                return sum(await pipe.execute())
+
+        try:
+            return await self._call(execute, self._write_timeout)
+        except CacheUnavailableError:
+            self._defer_deletes(keys)
+            raise
+
+    async def invalidate(self, channel: str, *keys: str) -> None:
+        """
+        Удалить ключи и опубликовать их список в канал pub/sub
+        за один round trip
+        """
+        if not keys:
+            return
+
+        async def execute():
+            async with self._client.pipeline(transaction=False) as pipe:
+                self._pipe_delete(pipe, keys)
+                pipe.publish(channel, json.dumps(keys))
+                await pipe.execute()
+
+        try:
+            await self._call(execute, self._write_timeout)
+        except CacheUnavailableError:
+            self._defer_deletes(keys)
+            raise
+
+    async def set_and_publish(
+        self,
+        channel: str,
+        mapping: dict,
+        expire: int
+    ) -> None:
+        """
+        Записать ключи и опубликовать их список в канал pub/sub
+        за один round trip
+        :param expire: время жизни ключей, с
+        """
+        if not mapping:
+            return
+        keys = tuple(mapping)
+
+        async def execute():
+            async with self._client.pipeline(transaction=False) as pipe:
+                for key, value in mapping.items():
+                    pipe.set(key, value, ex=expire)
+                pipe.publish(channel, json.dumps(keys))
+                await pipe.execute()
+
+        try:
+            await self._call(execute, self._write_timeout)
+        except CacheUnavailableError:
+            self._defer_deletes(keys)
+            raise
+
+    async def get_many(self, *keys: RedisKey) -> list[bytes | None]:
+        """
+        Получить значения нескольких ключей одной командой MGET.
+        :return: список значений в порядке ключей (None для промахов)
+        """
+        if not keys:
+            return []
+        return await self._call(
+            lambda: self._client.mget(keys), self._read_timeout
+        )
+
+    async def get_tagged(
+        self,
+        prefix: str,
+        *tags: str
+    ) -> tuple[str, bytes | None]:
+        """
+        Прочитать запись, ключ которой зависит от версий тегов.
+        :param prefix: ключ записи без версий
+        :param tags: ключи версий тегов
+        :return: ключ с текущими версиями тегов и значение (None - промах)
+        """
+        key, value = await self._call(
+            lambda: self._get_tagged(keys=[prefix, *tags]),
+            self._read_timeout
+        )
+        return key.decode(), value
+
+    async def bump_tags(self, *tags: str, expire: int) -> None:
+        """Увеличить версии тегов, сделав недоступными записи с ними"""
+        if not tags:
+            return
+
+        async def execute():
+            async with self._client.pipeline(transaction=False) as pipe:
+                for tag in tags:
+                    pipe.incr(tag)
+                    pipe.expire(tag, expire)
+                await pipe.execute()
+
+        await self._call(execute, self._write_timeout)
+
+    async def set_many(self, mapping: dict, expire: int = 0) -> None:
+        """
+        Записать несколько ключей за один round trip: MSET без времени
+        жизни, иначе пайплайн SET EX
+        """
+        if not mapping:
+            return
+        if not expire:
+            await self._call(
+                lambda: self._client.mset(mapping), self._write_timeout
+            )
+            return
+
+        async def execute():
+            async with self._client.pipeline(transaction=False) as pipe:
+                for key, value in mapping.items():
+                    pipe.set(key, value, ex=expire)
+                await pipe.execute()
+
+        await self._call(execute, self._write_timeout)
+
+    async def get_versioned_many(self, *keys: RedisKey) -> list:
+        """
+        Прочитать несколько версионированных записей одним пайплайном.
+        :return: словари полей (с полем version) в порядке ключей,
+        None для промахов и меток версии. Имена полей - str, значения - bytes
+        """
+        if not keys:
+            return []
+
+        async def execute():
+            async with self._client.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.hgetall(key)
+                return await pipe.execute()
+
+        entries = await self._call(execute, self._read_timeout)
+        result = []
+        for entry in entries:
+            fields = {
+                field.decode(): value for field, value in entry.items()
+            }
+            if 'version' in fields and 'stale' not in fields:
+                result.append(fields)
+            else:
+                result.append(None)
+        return result
+
+    async def set_versioned_many(self, entries: dict, expire: int = 0) -> None:
+        """
+        Записать версионированные записи, если в кэше нет записи новее.
+        :param entries: {ключ: (версия, {поле: значение})}
+        """
+        if not entries:
+            return
+
+        async def execute():
+            async with self._client.pipeline(transaction=False) as pipe:
+                for key, (version, fields) in entries.items():
+                    args = [version, expire]
+                    for field, value in fields.items():
+                        args.extend((field, value))
+                    await self._set_versioned(
+                        keys=[key], args=args, client=pipe
+                    )
+                await pipe.execute()
+
+        await self._call(execute, self._write_timeout)
+
+    async def patch_versioned(
+        self,
+        key: RedisKey,
+        version: int,
+        fields: dict,
+        deleted: tuple = (),
+        expire: int = 0
+    ) -> int:
+        """
+        Применить изменение версии version к записи версии version - 1.
+        Если запись уже новее - ничего не делает. Если записи нет или
+        пропущено промежуточное изменение - оставляет метку версии
+        со временем жизни expire, чтобы более старое состояние
+        не попало в кэш.
+        :param fields: изменённые поля
+        :param deleted: удалённые поля
+        :return: 1 - применено, 0 - запись новее, -1 - оставлена метка
+        """
+        args = [version, expire, len(deleted), *deleted]
+        for field, value in fields.items():
+            args.extend((field, value))
+        return await self._call(
+            lambda: self._patch_versioned(keys=[key], args=args),
+            self._write_timeout
+        )
+
+    async def mark_stale_many(self, versions: dict, expire: int) -> None:
+        """
+        Оставить метки версий вместо записей, если в кэше нет записи
+        новее. В отличие от удаления ключа метка не даёт запросу,
+        прочитавшему БД до изменения, записать устаревшее состояние.
+        :param versions: {ключ: версия после изменения}
+        :param expire: время жизни метки
+        """
+        if not versions:
+            return
+
+        async def execute():
+            async with self._client.pipeline(transaction=False) as pipe:
+                for key, version in versions.items():
+                    await self._mark_stale(
+                        keys=[key], args=[version, expire], client=pipe
+                    )
+                await pipe.execute()
+
+        await self._call(execute, self._write_timeout)
+
+    async def set_if_absent(
+        self,
+        key: RedisKey,
+        value: RedisValue,
+        expire: int
+    ) -> bool:
+        """
+        Записать ключ командой SET NX EX.
+        :return: True, если ключа не было и он записан
+        """
+        return bool(await self._call(
+            lambda: self._client.set(key, value, ex=expire, nx=True),
+            self._write_timeout
+        ))
+
+    async def acquire_lock(self, key: str, token: str, ttl_ms: int) -> bool:
+        """
+        Взять блокировку SET NX PX.
+        :param token: значение, по которому блокировку снимает только владелец
+        :return: True, если блокировка взята
+        """
+        return bool(await self._call(
+            lambda: self._client.set(key, token, px=ttl_ms, nx=True),
+            self._write_timeout
+        ))
+
+    async def release_lock(self, key: str, token: str) -> None:
+        """Снять блокировку, если она ещё принадлежит token"""
+        await self._call(
+            lambda: self._release_lock(keys=[key], args=[token]),
+            self._write_timeout
+        )
+
+    async def publish(self, channel: str, message: RedisValue) -> int:
+        """
+        Опубликовать сообщение в канал pub/sub.
+        :return: количество получивших сообщение подписчиков
+        """
+        return await self._call(
+            lambda: self._client.publish(channel, message),
+            self._write_timeout
+        )
+
+    @asynccontextmanager
+    async def subscribe(self, channel: str) -> AsyncIterator[AsyncIterator]:
+        """
+        Подписаться на канал pub/sub. Подписка занимает соединение целиком
+        и ждёт сообщений дольше socket_timeout, поэтому открывается
+        отдельное соединение вне пула.
+        Использование: async with cache.subscribe(channel) as messages
+        :return: асинхронный итератор данных сообщений (bytes)
+        """
+        client = Redis.from_url(
+            self._url,
+            socket_connect_timeout=self._connect_timeout,
+            socket_keepalive=True,
+            health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL
+        )
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(channel)
+            yield self._messages(pubsub)
+        finally:
+            await pubsub.aclose()
+            await client.aclose()
+
+    @staticmethod
+    async def _messages(pubsub) -> AsyncIterator[bytes]:
+        async for message in pubsub.listen():
+            if message['type'] == 'message':
+                yield message['data']
+
+
+class LocalCache:
+    """
+    LRU-кэш в памяти процесса с временем жизни записей.
+    Хранит уже декодированные объекты; не потокобезопасен,
+    рассчитан на использование из одного event loop.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable) -> Any:
+        """
+        :return: значение или None, если ключа нет или он устарел
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, *keys: Hashable) -> None:
+        for key in keys:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SingleFlight:
+    """
+    Объединяет одновременные загрузки одного ключа при промахе кэша.
+    В процессе ожидающие получают результат общей задачи, между
+    процессами загрузку выполняет держатель блокировки в redis,
+    а остальные опрашивают кэш до её появления.
+    """
+
+    def __init__(self):
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._refreshing: dict[str, asyncio.Future] = {}
+
+    async def load(
+        self,
+        cache: CacheBackend,
+        key: str,
+        name: str,
+        read_cached: Callable[[], Awaitable[Any]],
+        load: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        """
+        Получить значение ключа, загрузив его не более одного раза.
+        :param name: тип ключа для метрик (item, items_list, inventory)
+        :param read_cached: чтение значения из кэша, None при промахе
+        :param load: загрузка из БД с записью в кэш
+        """
+        task = self._inflight.get(key)
+        if task is not None:
+            CACHE_LOADS_COALESCED.labels(name, 'local').inc()
+        else:
+            task = asyncio.ensure_future(
+                self._load_once(cache, key, name, read_cached, load)
+            )
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Отмена одного запроса не должна отменять загрузку для остальных
+        return await asyncio.shield(task)
+
+    def refresh(
+        self,
+        cache: CacheBackend,
+        key: str,
+        name: str,
+        load: Callable[[], Awaitable[Any]]
+    ) -> None:
+        """
+        Обновить значение ключа в фоне. Обновление пропускается,
+        если ключ уже загружается в этом процессе или другой процесс
+        держит его блокировку
+        """
+        if key in self._inflight or key in self._refreshing:
+            return
+        task = asyncio.ensure_future(
+            self._refresh_once(cache, key, name, load)
+        )
+        self._refreshing[key] = task
+        task.add_done_callback(lambda _: self._refreshing.pop(key, None))
+
+    @staticmethod
+    async def _refresh_once(cache, key, name, load):
+        lock_key = f'lock:{key}'
+        token = uuid.uuid4().hex
+        try:
+            if not await cache.acquire_lock(
+                lock_key, token, settings.CACHE_LOCK_TTL_MS
+            ):
+                return
+        except Exception as e:
+            logger.error(f'Cache lock failed: {e}')
+            return
+        try:
+            CACHE_REFRESHES.labels(name).inc()
+            await load()
+        except Exception as e:
+            logger.error(f'Background refresh of {key} failed: {e}')
+        finally:
+            try:
+                await cache.release_lock(lock_key, token)
+            except Exception as e:
+                logger.error(f'Cache unlock failed: {e}')
+
+    @staticmethod
+    async def _load_once(cache, key, name, read_cached, load):
+        lock_key = f'lock:{key}'
+        token = uuid.uuid4().hex
+        try:
+            locked = await cache.acquire_lock(
+                lock_key, token, settings.CACHE_LOCK_TTL_MS
+            )
+        except Exception as e:
+            logger.error(f'Cache lock failed: {e}')
+            CACHE_LOADS.labels(name).inc()
+            return await load()
+        if locked:
+            try:
+                # Ключ мог быть заполнен, пока брали блокировку
+                value = await read_cached()
+                if value is not None:
+                    return value
+                CACHE_LOADS.labels(name).inc()
+                return await load()
+            finally:
+                try:
+                    await cache.release_lock(lock_key, token)
+                except Exception as e:
+                    logger.error(f'Cache unlock failed: {e}')
+        deadline = time.monotonic() + settings.CACHE_LOCK_WAIT_MS / 1000
+        while time.monotonic() < deadline:
+            await asyncio.sleep(settings.CACHE_LOCK_POLL_MS / 1000)
+            value = await read_cached()
+            if value is not None:
+                CACHE_LOADS_COALESCED.labels(name, 'remote').inc()
+                return value
+            # Блокировка снята без значения: загрузка завершилась ошибкой
+            # или отсутствием сущности. load() сам проверит отметку missing:*
+            try:
+                if await cache.get(lock_key) is None:
+                    break
+            except Exception as e:
+                logger.error(f'Cache get failed: {e}')
+                break
+        else:
+            logger.warning(f'Cache lock wait timed out for {key}')
+        CACHE_LOADS.labels(name).inc()
+        return await load()
+
+
+single_flight = SingleFlight()
+
+
+class NegativeCache:
+    """
+    Отметки об отсутствии сущности в БД: в памяти процесса и в redis
+    с коротким временем жизни. Повторные запросы несуществующих id
+    не доходят до БД. При создании сущности отметка заменяется
+    отметкой о существовании: запрос, проверивший БД до коммита
+    создания, не может записать отсутствие поверх неё. Без redis
+    отсутствие не запоминается
+    """
+
+    MISSING = b'1'
+    EXISTS = b'0'
+
+    def __init__(self, local_cache: LocalCache):
+        self.local_cache = local_cache
+
+    async def is_missing(self, cache: CacheBackend, key: str) -> bool:
+        if self.local_cache.get(key):
+            return True
+        try:
+            missing = await cache.get(key) == self.MISSING
+        except Exception as e:
+            logger.error(f'Cache get failed: {e}')
+            return False
+        if missing:
+            self.local_cache.set(key, True)
+        return missing
+
+    async def remember(self, cache: CacheBackend, key: str) -> None:
+        try:
+            remembered = await cache.set_if_absent(
+                key, self.MISSING, expire=settings.NEGATIVE_CACHE_TTL
+            )
+        except Exception as e:
+            logger.error(f'Cache set failed: {e}')
+            return
+        # Не записано - сущность создана после проверки
+        if remembered:
+            self.local_cache.set(key, True)
+
+    async def forget(self, cache: CacheBackend, *keys: str) -> None:
+        """Снять отметки во всех процессах после создания сущностей"""
+        self.local_cache.delete(*keys)
+        try:
+            await cache.set_and_publish(
+                settings.LOCAL_CACHE_CHANNEL,
+                dict.fromkeys(keys, self.EXISTS),
+                expire=settings.NEGATIVE_CACHE_TTL
+            )
+        except Exception as e:
+            logger.error(f'Negative cache invalidation failed: {e}')
+
+
+negative_cache = NegativeCache(LocalCache(
+    maxsize=settings.NEGATIVE_CACHE_SIZE,
+    ttl=settings.NEGATIVE_CACHE_TTL
+))
+
+
+async def mark_stale(cache: CacheBackend, versions: dict) -> None:
+    """
+    Пометить версионированные записи устаревшими после изменения в БД.
+    Если redis недоступен, ключи удаляются (с повтором после
+    восстановления)
+    :param versions: {ключ: версия после изменения}
+    """
+    try:
+        await cache.mark_stale_many(versions, expire=cache_ttl())
+    except Exception as e:
+        logger.error(f'Cache mark stale failed: {e}')
+        try:
+            await cache.delete_many(*versions)
+        except Exception as e:
+            logger.error(f'Cache delete failed: {e}')
+
+
+class LocalCacheInvalidator:
+    """
+    Слушает канал LOCAL_CACHE_CHANNEL и удаляет опубликованные ключи
+    из локальных кэшей этого процесса
+    """
+
+    def __init__(self, cache: CacheBackend, *local_caches: LocalCache):
+        self.cache = cache
+        self.local_caches = local_caches
+
+    def clear(self) -> None:
+        for local_cache in self.local_caches:
+            local_cache.clear()
+
+    async def run(self) -> None:
+        """Слушает канал, переподключаясь при обрыве соединения"""
+        while True:
+            try:
+                async with self.cache.subscribe(
+                    settings.LOCAL_CACHE_CHANNEL
+                ) as messages:
+                    # Пока подписки не было, сообщения могли быть потеряны
+                    self.clear()
+                    async for message in messages:
+                        keys = json.loads(message)
+                        for local_cache in self.local_caches:
+                            local_cache.delete(*keys)
+                logger.warning('Local cache channel closed')
+            except Exception as e:
+                logger.error(f'Local cache listener failed: {e}')
+            self.clear()
+            await asyncio.sleep(1)
@@ -0,0 +1,139 @@
+"""
+Кодеки значений кэша.
+
+Значение в redis - заголовок из одного байта и тело:
+    биты 0-3 - кодек (CacheCodec.codec_id)
+    биты 4-6 - версия формата тела (FORMAT_VERSION)
+    бит 7    - тело сжато zlib
+Значение с неизвестным кодеком или версией формата считается промахом,
+поэтому смена кодека или формы кэшируемых моделей не требует сброса кэша.
+"""
+import zlib
+from abc import ABC, abstractmethod
+from typing import Any
+
+import orjson
+
+from app.config import settings
+
+try:
+    import msgpack
+except ImportError:  # msgpack - необязательная зависимость
+    msgpack = None
+
+# Увеличивается при несовместимом изменении кэшируемых моделей
+FORMAT_VERSION = 1
+COMPRESSED = 0x80
+
+
+class CacheCodec(ABC):
+    """Сериализация JSON-совместимых значений в bytes"""
+    codec_id: int
+    name: str
+
+    @abstractmethod
+    def dumps(self, value: Any) -> bytes:
+        ...
+
+    @abstractmethod
+    def loads(self, data: bytes) -> Any:
+        ...
+
+
+class OrjsonCodec(CacheCodec):
+    codec_id = 1
+    name = 'orjson'
+
+    def dumps(self, value: Any) -> bytes:
+        return orjson.dumps(value)
+
+    def loads(self, data: bytes) -> Any:
+        return orjson.loads(data)
+
+
+class MsgpackCodec(CacheCodec):
+    codec_id = 2
+    name = 'msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError('msgpack is not installed')
+
+    def dumps(self, value: Any) -> bytes:
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data: bytes) -> Any:
+        return msgpack.unpackb(data, raw=False)
+
+
+CODECS = {codec.name: codec for codec in (OrjsonCodec, MsgpackCodec)}
+
+
+class CacheSerializer:
+    """
+    Упаковывает значения выбранным кодеком, сжимая тела больше
+    compress_min_size байт. Читает значения любого доступного кодека
+    """
+
+    def __init__(
+        self,
+        codec: CacheCodec,
+        compress_min_size: int,
+        compress_level: int = zlib.Z_DEFAULT_COMPRESSION
+    ):
+        """
+        :param compress_min_size: с какого размера тела сжимать (0 - никогда)
+        """
+        self.codec = codec
+        self.compress_min_size = compress_min_size
+        self.compress_level = compress_level
+        self._decoders: dict[int, CacheCodec] = {codec.codec_id: codec}
+        for codec_class in CODECS.values():
+            if codec_class.codec_id not in self._decoders:
+                try:
+                    self._decoders[codec_class.codec_id] = codec_class()
+                except RuntimeError:
+                    pass
+
+    def dumps(self, value: Any) -> bytes:
+        body = self.codec.dumps(value)
+        header = self.codec.codec_id | FORMAT_VERSION << 4
+        if 0 < self.compress_min_size <= len(body):
+            body = zlib.compress(body, self.compress_level)
+            header |= COMPRESSED
+        return bytes((header,)) + body
+
+    def loads(self, data: bytes) -> Any:
+        """
+        :raises ValueError: если значение в другом формате или повреждено
+        """
+        if not data:
+            raise ValueError('Empty cache value')
+        header = data[0]
+        codec = self._decoders.get(header & 0x0f)
+        if codec is None or (header >> 4) & 0x07 != FORMAT_VERSION:
+            raise ValueError(f'Unsupported cache value format {header:#x}')
+        body = data[1:]
+        if header & COMPRESSED:
+            try:
+                body = zlib.decompress(body)
+            except zlib.error as e:
+                raise ValueError(f'Corrupted cache value: {e}') from e
+        try:
+            return codec.loads(body)
+        except Exception as e:
+            raise ValueError(f'Corrupted cache value: {e}') from e
+
+
+def create_serializer() -> CacheSerializer:
+    codec_class = CODECS.get(settings.CACHE_CODEC)
+    if codec_class is None:
+        raise RuntimeError(f'Unknown cache codec {settings.CACHE_CODEC}')
+    return CacheSerializer(
+        codec_class(),
+        compress_min_size=settings.CACHE_COMPRESS_MIN_SIZE,
+        compress_level=settings.CACHE_COMPRESS_LEVEL
+    )
+
+
+cache_serializer = create_serializer()
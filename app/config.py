@@ -12,10 +12,105 @@ class Settings(BaseSettings):
     db_password: str = Field(alias='POSTGRES_PASSWORD')
     db_name: str = Field(alias='POSTGRES_DB')
     db_port: int = Field(alias='DB_PORT', default=5432)
+    # Пул соединений с БД одного процесса: до DB_POOL_SIZE постоянных
+    # соединений и DB_MAX_OVERFLOW временных сверх них
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30.0  # seconds, ожидание свободного соединения
+    DB_POOL_RECYCLE: int = 1800  # seconds, -1 - не пересоздавать
+    DB_POOL_PRE_PING: bool = True
+    # Сколько соединений открыть при старте приложения (0 - не открывать)
+    DB_POOL_PREWARM: int = 5
+    # Кэши подготовленных выражений asyncpg и адаптера SQLAlchemy.
+    # За pgbouncer в режиме transaction оба нужно выставить в 0
+    DB_STATEMENT_CACHE_SIZE: int = 100
+    DB_STATEMENT_CACHE_LIFETIME: int = 300  # seconds
+    DB_PREPARED_STATEMENT_CACHE_SIZE: int = 100
+    # Реплики для чтения: ["host", "host:port"], пользователь, пароль
+    # и БД те же, что у основной. Пусто - всё читается с основной БД
+    DB_REPLICA_HOSTS: list[str] = []
+    # Окно чтения своих записей: столько после изменения данные
+    # читаются с основной БД. Должно быть не меньше DB_REPLICA_MAX_LAG
+    DB_REPLICA_READ_YOUR_WRITES: int = 5  # seconds
+    DB_REPLICA_MAX_LAG: float = 5.0  # seconds, отставание сверх - нездорова
+    DB_REPLICA_HEALTH_INTERVAL: float = 5.0  # seconds, проверка отставания
+    # Сколько не использовать реплику после ошибки запроса к ней
+    DB_REPLICA_RETRY_INTERVAL: float = 10.0  # seconds
     KAFKA_SERVER: str = Field(alias='KAFKA_SERVER')
+    KAFKA_CONSUMER_BATCH_SIZE: int = 500
+    KAFKA_CONSUMER_FLUSH_INTERVAL_MS: int = 1000
+    KAFKA_CONSUMER_WORKERS: int = 1  # >1 - параллельная обработка партиций
+    KAFKA_CONSUMER_QUEUE_SIZE: int = 2  # пачек в очереди одной партиции
+    # Повторы неудачной пачки до её пропуска, пауза растёт до 30 с
+    KAFKA_CONSUMER_MAX_RETRIES: int = 10
+    # Сколько ждать обработки очередей отзываемых партиций
+    KAFKA_CONSUMER_DRAIN_TIMEOUT_MS: int = 30000
+    # False - консьюмер запускается отдельным процессом (python -m app.worker)
+    RUN_KAFKA_CONSUMER: bool = True
+    WORKER_DB_POOL_SIZE: int = 5
+    WORKER_METRICS_PORT: int = 8001
+    KAFKA_PRODUCER_COMPRESSION: str = 'gzip'
+    KAFKA_PRODUCER_LINGER_MS: int = 20
+    RUN_OUTBOX_RELAY: bool = True
+    OUTBOX_BATCH_SIZE: int = 500
+    OUTBOX_POLL_INTERVAL_MS: int = 500
+    OUTBOX_RETENTION_HOURS: int = 24
+    INVENTORY_EVENTS_TOPIC: str = 'inventory.changes'
     REDIS_HOST: str = Field(alias='REDIS_HOST')
     REDIS_PORT: int = Field(alias='REDIS_PORT', default=6379)
-    CACHE_EXPIRE: int = 3600  # seconds
+    # Пул соединений с redis: запрос ждёт свободное соединение
+    # не дольше REDIS_POOL_TIMEOUT вместо открытия новых без ограничения
+    REDIS_POOL_SIZE: int = 50
+    REDIS_POOL_TIMEOUT: float = 1.0  # seconds
+    REDIS_SOCKET_TIMEOUT: float = 0.5  # seconds, ответ на команду
+    REDIS_CONNECT_TIMEOUT: float = 1.0  # seconds
+    REDIS_HEALTH_CHECK_INTERVAL: int = 30  # seconds
+    # Таймауты операций кэша: дольше выгоднее сходить в БД
+    CACHE_READ_TIMEOUT_MS: int = 50
+    CACHE_WRITE_TIMEOUT_MS: int = 200
+    # Размыкатель: после CACHE_BREAKER_FAILURES ошибок подряд кэш
+    # не используется CACHE_BREAKER_RESET_MS, затем пробуется одним вызовом
+    CACHE_BREAKER_FAILURES: int = 5
+    CACHE_BREAKER_RESET_MS: int = 5000
+    # Сколько несостоявшихся удалений ключей помнить для повтора
+    CACHE_PENDING_DELETES_MAX: int = 100000
+    CACHE_EXPIRE: int = 3600  # seconds, мягкий срок годности значений
+    # Сколько после мягкого срока отдавать значение, обновляя его в фоне
+    CACHE_STALE_TTL: int = 600  # seconds
+    CACHE_XFETCH_BETA: float = 1.0  # >1 - обновлять раньше
+    CACHE_CODEC: str = 'orjson'  # orjson или msgpack
+    # Значения больше порога сжимаются zlib (0 - не сжимать)
+    CACHE_COMPRESS_MIN_SIZE: int = 1024  # bytes
+    CACHE_COMPRESS_LEVEL: int = 1
+    # Локальный кэш предметов в памяти процесса (0 - отключён)
+    ITEM_LOCAL_CACHE_SIZE: int = 1024
+    ITEM_LOCAL_CACHE_TTL: int = 60  # seconds
+    # Канал pub/sub для инвалидации локальных кэшей всех процессов
+    LOCAL_CACHE_CHANNEL: str = 'cache:local:invalidate'
+    # Отметки об отсутствии предметов и инвентарей
+    NEGATIVE_CACHE_SIZE: int = 10000
+    NEGATIVE_CACHE_TTL: int = 30  # seconds
+    # Блокировка загрузки ключа между процессами при промахе кэша
+    CACHE_LOCK_TTL_MS: int = 3000
+    CACHE_LOCK_WAIT_MS: int = 2000
+    CACHE_LOCK_POLL_MS: int = 50
+    # Поиск предметов по id пачками: запросы, пришедшие за окно
+    # (0 - за одну итерацию цикла событий), выполняются одним SELECT
+    ITEM_LOADER_WINDOW_US: int = 0
+    ITEM_LOADER_MAX_BATCH: int = 1000
+    # Групповая запись: начисления и списания одновременных запросов
+    # выполняются одной транзакцией с одним коммитом
+    GROUP_COMMIT_ENABLED: bool = False
+    GROUP_COMMIT_WINDOW_MS: int = 2
+    GROUP_COMMIT_MAX_BATCH: int = 100
+    # Кэш запросов репозиториев (app/query_cache.py), выключен по умолчанию:
+    # предметы и инвентари уже кэшируются сервисами
+    QUERY_CACHE_ENABLED: bool = False
+    QUERY_CACHE_TTL: int = 60  # seconds
+    # Сроки по семействам запросов, например {"item.all": 300}
+    QUERY_CACHE_FAMILY_TTL: dict[str, int] = {}
+    # Время жизни версий тегов, должно быть больше сроков семейств
+    QUERY_CACHE_TAG_TTL: int = 86400  # seconds
 
     @property
     def db_url(self) -> PostgresDsn:
@@ -24,6 +119,18 @@ class Settings(BaseSettings):
             f'{self.db_host}:{self.db_port}/{self.db_name}'
         )
 
+    @property
+    def replica_urls(self) -> list[str]:
+        urls = []
+        for host in self.DB_REPLICA_HOSTS:
+            if ':' not in host:
+                host = f'{host}:{self.db_port}'
+            urls.append(
+                f'postgresql+asyncpg://{self.db_user}:{self.db_password}@'
+                f'{host}/{self.db_name}'
+            )
+        return urls
+
     class Config:
         env_file = os.path.join(
             os.path.dirname(os.path.abspath(__file__)),
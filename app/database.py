@@ -1,28 +1,118 @@
+import asyncio
 import logging
+import time
 from contextlib import asynccontextmanager
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Awaitable, Callable
 
 from sqlalchemy import text
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.asyncio import (AsyncEngine, async_sessionmaker,
                                     create_async_engine)
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlmodel import SQLModel
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from app.config import settings
+from app.exceptions import ServiceError
+from app.metrics import (DB_POOL_CHECKED_OUT, DB_POOL_OVERFLOW,
+                         DB_POOL_TIMEOUTS, DB_POOL_WAIT_SECONDS)
 
 logger = logging.getLogger(__name__)
 
-engine: AsyncEngine = create_async_engine(settings.db_url)
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """
+    Пул соединений, который пишет в метрики ожидание соединения
+    и таймауты. Метки метрик - pool_logging_name движка
+    """
+
+    def _do_get(self):
+        name = self.logging_name or 'primary'
+        started = time.monotonic()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            DB_POOL_TIMEOUTS.labels(name).inc()
+            raise
+        finally:
+            DB_POOL_WAIT_SECONDS.labels(name).observe(
+                time.monotonic() - started
+            )
+
+
+def engine_options(**overrides) -> dict:
+    """
+    Параметры пула и кэша подготовленных выражений asyncpg из настроек.
+    :param overrides: параметры create_async_engine поверх настроек
+    """
+    options = {
+        'poolclass': InstrumentedPool,
+        'pool_size': settings.DB_POOL_SIZE,
+        'max_overflow': settings.DB_MAX_OVERFLOW,
+        'pool_timeout': settings.DB_POOL_TIMEOUT,
+        'pool_recycle': settings.DB_POOL_RECYCLE,
+        'pool_pre_ping': settings.DB_POOL_PRE_PING,
+        'connect_args': {
+            # Кэш подготовленных выражений самого asyncpg
+            'statement_cache_size': settings.DB_STATEMENT_CACHE_SIZE,
+            'max_cached_statement_lifetime':
+                settings.DB_STATEMENT_CACHE_LIFETIME,
+            # Кэш подготовленных выражений адаптера SQLAlchemy
+            'prepared_statement_cache_size':
+                settings.DB_PREPARED_STATEMENT_CACHE_SIZE,
+        },
+    }
+    options.update(overrides)
+    return options
+
+
+def instrument_engine(engine: AsyncEngine, name: str) -> None:
+    """Снимать занятость пула движка в метрики с меткой name"""
+    DB_POOL_CHECKED_OUT.labels(name).set_function(
+        lambda: engine.pool.checkedout()
+    )
+    # Отрицательное значение - сколько соединений до pool_size не открыто
+    DB_POOL_OVERFLOW.labels(name).set_function(
+        lambda: engine.pool.overflow()
+    )
+
+
+def create_engine(url, name: str = 'primary', **overrides) -> AsyncEngine:
+    """Движок с параметрами пула из настроек и метриками пула"""
+    engine = create_async_engine(
+        url, pool_logging_name=name, **engine_options(**overrides)
+    )
+    instrument_engine(engine, name)
+    return engine
+
+
+engine: AsyncEngine = create_engine(settings.db_url)
 
 async_session_maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
 
+def configure_engine(**engine_kwargs) -> AsyncEngine:
+    """
+    Пересоздаёт движок с другими параметрами пула.
+    Используется отдельными процессами (например, консьюмером kafka),
+    которым нужен свой размер пула. Вызывать до первого запроса к БД.
+    :param engine_kwargs: параметры create_async_engine поверх настроек
+    """
+    global engine, async_session_maker
+    engine = create_engine(settings.db_url, **engine_kwargs)
+    async_session_maker = async_sessionmaker(
+        engine, class_=AsyncSession, expire_on_commit=False
+    )
+    return engine
+
+
 @asynccontextmanager
 async def get_session() -> AsyncGenerator[AsyncSession, None]:
     """
     Асинхронный генератор сессий для работы с базой данных.
-    Используется для получения сессии в эндпоинтах и репозиториях.
+    Используется там, где сессия живёт дольше запроса (потоковая выдача,
+    relay outbox); запросы получают сессию через get_unit_of_work.
     Пример использования:
         async with get_session() as session:
             ...
@@ -31,6 +121,59 @@ async def get_session() -> AsyncGenerator[AsyncSession, None]:
         yield session
 
 
+@asynccontextmanager
+async def unit_of_work() -> AsyncGenerator[AsyncSession, None]:
+    """
+    Единица работы: одна сессия и одна транзакция для всех вызовов
+    репозиториев. Коммит выполняется один раз при выходе без исключения,
+    при исключении транзакция откатывается. После коммита выполняются
+    действия, добавленные через after_commit.
+    Пример использования:
+        async with unit_of_work() as session:
+            await InventoryRepository.add_item(session, 1, 2, 3)
+    """
+    async with async_session_maker() as session:
+        async with session.begin():
+            yield session
+        await run_after_commit(session)
+
+
+def after_commit(
+    session: AsyncSession,
+    callback: Callable[[], Awaitable[None]]
+) -> None:
+    """
+    Выполнить callback после коммита единицы работы session.
+    При откате действия отбрасываются
+    """
+    session.info.setdefault('after_commit', []).append(callback)
+
+
+async def run_after_commit(session: AsyncSession) -> None:
+    """Выполнить действия, накопленные до коммита session"""
+    for callback in session.info.pop('after_commit', []):
+        try:
+            await callback()
+        except Exception as e:
+            # Изменение уже в БД: ошибка кэша не должна становиться
+            # ошибкой запроса
+            logger.error(f'After commit action failed: {e}')
+
+
+async def get_unit_of_work() -> AsyncGenerator[AsyncSession, None]:
+    """
+    Зависимость FastAPI: единица работы запроса. Все сервисы запроса
+    получают одну сессию, коммит выполняется после обработчика
+    до отправки ответа
+    """
+    try:
+        async with unit_of_work() as session:
+            yield session
+    except SQLAlchemyError as e:
+        logger.error(f'Request transaction failed: {e}')
+        raise ServiceError('Service temporarily unavailable') from e
+
+
 async def create_db_and_tables():
     """
     Асинхронно создаёт все таблицы в базе данных согласно моделям SQLModel.
@@ -55,6 +198,48 @@ async def check_connection() -> bool:
         return False
 
 
+async def prewarm_pool(
+    size: int | None = None,
+    target: AsyncEngine | None = None
+) -> int:
+    """
+    Открывает соединения пула заранее, чтобы первые запросы не ждали
+    подключения к БД. Ошибки подключения не мешают запуску.
+    :param size: сколько соединений открыть (по умолчанию
+        DB_POOL_PREWARM, не больше DB_POOL_SIZE)
+    :param target: движок (по умолчанию основной)
+    :return: сколько соединений открыто
+    """
+    target = target or engine
+    if size is None:
+        size = settings.DB_POOL_PREWARM
+    size = min(size, target.pool.size())
+    if size <= 0:
+        return 0
+    # Соединения держатся одновременно, иначе пул вернёт одно и то же
+    connections = await asyncio.gather(
+        *(target.connect() for _ in range(size)),
+        return_exceptions=True
+    )
+    opened = 0
+    for connection in connections:
+        if isinstance(connection, BaseException):
+            logger.warning(f'Pool prewarm connection failed: {connection}')
+            continue
+        await connection.close()
+        opened += 1
+    logger.info(
+        f'Database pool {target.pool.logging_name} prewarmed '
+        f'with {opened} connections'
+    )
+    return opened
+
+
+async def close_db() -> None:
+    """Закрывает соединения пула при остановке приложения"""
+    await engine.dispose()
+
+
 async def init_db() -> None:
     """
     Инициализирует базу данных: проверяет соединение и создаёт таблицы, если соединение успешно.
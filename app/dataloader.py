@@ -0,0 +1,104 @@
+"""
+Пакетная загрузка по ключам.
+
+Запросы ключей от одновременных корутин собираются за одну итерацию
+цикла событий (или за окно window_us) и выполняются одним вызовом
+load_many. Каждый вызывающий получает своё значение или общую ошибку
+загрузки пачки.
+"""
+import asyncio
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+from app.metrics import LOADER_BATCH_SIZE
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+def consume_exception(future: asyncio.Future) -> None:
+    # Все ожидающие могли быть отменены: ошибку пачки больше некому прочитать
+    if not future.cancelled():
+        future.exception()
+
+
+class BatchLoader(Generic[K, V]):
+    """
+    Загрузчик, объединяющий одновременные запросы ключей в пачки.
+    Повторный запрос ключа из той же пачки ждёт ту же загрузку
+    """
+
+    def __init__(
+        self,
+        name: str,
+        load_many: Callable[[list[K]], Awaitable[dict[K, V]]],
+        window_us: int = 0,
+        max_batch: int = 1000
+    ):
+        """
+        :param name: имя загрузчика в метриках
+        :param load_many: загрузка значений по списку ключей, отсутствующие
+            ключи в результат не попадают
+        :param window_us: сколько собирать пачку (0 - одна итерация цикла)
+        :param max_batch: размер пачки, при котором она уходит сразу
+        """
+        self.name = name
+        self.load_many = load_many
+        self.window_us = window_us
+        self.max_batch = max_batch
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._pending: dict[K, asyncio.Future] = {}
+        self._handle: asyncio.Handle | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def load(self, key: K) -> V | None:
+        """
+        :return: значение ключа или None, если его нет
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._pending = {}
+            self._handle = None
+        future = self._pending.get(key)
+        if future is None:
+            future = loop.create_future()
+            future.add_done_callback(consume_exception)
+            self._pending[key] = future
+            if len(self._pending) >= self.max_batch:
+                self._dispatch()
+            elif self._handle is None:
+                if self.window_us:
+                    self._handle = loop.call_later(
+                        self.window_us / 1_000_000, self._dispatch
+                    )
+                else:
+                    self._handle = loop.call_soon(self._dispatch)
+        # Отмена одного вызывающего не должна отменять загрузку остальных
+        return await asyncio.shield(future)
+
+    def _dispatch(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        batch, self._pending = self._pending, {}
+        if batch:
+            task = asyncio.ensure_future(self._resolve(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _resolve(self, batch: dict[K, asyncio.Future]) -> None:
+        LOADER_BATCH_SIZE.labels(self.name).observe(len(batch))
+        try:
+            values = await self.load_many(list(batch))
+        except asyncio.CancelledError:
+            for future in batch.values():
+                future.cancel()
+            raise
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(values.get(key))
@@ -23,6 +23,11 @@ class RepositoryError(BaseAppException):
     pass
 
 
+class CacheUnavailableError(BaseAppException):
+    """Кэш недоступен: таймаут, ошибка соединения или размыкатель открыт"""
+    pass
+
+
 class ServiceError(BaseAppException):
     """Ошибка сервиса"""
     pass
@@ -0,0 +1,106 @@
+"""
+Групповая запись.
+
+Изменения от одновременных запросов собираются за окно window_ms
+и применяются одной транзакцией с одним коммитом. Каждый вызывающий
+получает свой результат или свою ошибку; ошибка всей транзакции
+достаётся всем изменениям пачки.
+"""
+import asyncio
+import time
+from typing import Awaitable, Callable, Generic, TypeVar
+
+from app.dataloader import consume_exception
+from app.metrics import GROUP_COMMIT_BATCH_SIZE, GROUP_COMMIT_WAIT_SECONDS
+
+M = TypeVar('M')
+R = TypeVar('R')
+
+
+class GroupCommitWriter(Generic[M, R]):
+    """
+    Писатель, объединяющий одновременные изменения в транзакции.
+    Отмена вызывающего не отзывает уже отправленное изменение
+    """
+
+    def __init__(
+        self,
+        name: str,
+        apply_batch: Callable[[list[M]], Awaitable[list[R | Exception]]],
+        window_ms: int,
+        max_batch: int
+    ):
+        """
+        :param name: имя писателя в метриках
+        :param apply_batch: применение пачки в одной транзакции, возвращает
+            результат или исключение для каждого изменения по порядку
+        :param window_ms: сколько собирать пачку после первого изменения
+        :param max_batch: размер пачки, при котором она уходит сразу
+        """
+        self.name = name
+        self.apply_batch = apply_batch
+        self.window_ms = window_ms
+        self.max_batch = max_batch
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._pending: list[tuple[M, asyncio.Future, float]] = []
+        self._handle: asyncio.Handle | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def submit(self, mutation: M) -> R:
+        """
+        :return: результат изменения
+        :raises Exception: ошибка этого изменения или всей пачки
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._pending = []
+            self._handle = None
+        future = loop.create_future()
+        future.add_done_callback(consume_exception)
+        self._pending.append((mutation, future, time.monotonic()))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._handle is None:
+            self._handle = loop.call_later(
+                self.window_ms / 1000, self._flush
+            )
+        return await asyncio.shield(future)
+
+    def _flush(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._apply(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _apply(self, batch: list[tuple[M, asyncio.Future, float]]):
+        started = time.monotonic()
+        GROUP_COMMIT_BATCH_SIZE.labels(self.name).observe(len(batch))
+        for _, _, submitted_at in batch:
+            GROUP_COMMIT_WAIT_SECONDS.labels(self.name).observe(
+                started - submitted_at
+            )
+        try:
+            results = await self.apply_batch(
+                [mutation for mutation, _, _ in batch]
+            )
+        except asyncio.CancelledError:
+            for _, future, _ in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future, _), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
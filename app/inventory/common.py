@@ -4,11 +4,10 @@ import os
 from logging.handlers import RotatingFileHandler
 
 import jwt
-from fastapi_cache import caches
-from fastapi_cache.backends.redis import CACHE_KEY, RedisCacheBackend
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 
+from app.cache import CacheBackend
 from app.config import settings
 from app.inventory.schemas import UserInfo
 
@@ -56,9 +55,6 @@ async def get_current_user(
         )
 
 
-async def redis_cache():
-    return caches.get(CACHE_KEY)
-
-
-async def get_cache() -> RedisCacheBackend | None:
-    return await redis_cache()
+async def get_cache(request: Request) -> CacheBackend:
+    """Кэш приложения, созданный в lifespan"""
+    return request.app.state.cache
@@ -1,5 +1,7 @@
+from datetime import datetime, timezone
 from typing import Optional
 
+from sqlalchemy import Column, DateTime, Index, text
 from sqlmodel import Field, Relationship, SQLModel
 
 from app.inventory.schemas import ItemKind
@@ -53,6 +55,34 @@ class Inventory(SQLModel, table=True):
     """Модель инвентаря пользователя"""
     id: int | None = Field(default=None, primary_key=True, index=True)
     user_id: int = Field(unique=True, index=True)
+    version: int = Field(
+        default=0,
+        sa_column_kwargs={'server_default': '0'},
+        description="Увеличивается при каждом изменении инвентаря"
+    )
     inventory_items: list["InventoryItem"] = Relationship(
         back_populates="inventory"
     )
+
+
+class OutboxEvent(SQLModel, table=True):
+    """Событие для kafka, записанное в одной транзакции с изменением данных"""
+    __table_args__ = (
+        Index(
+            'ix_outboxevent_undelivered',
+            'id',
+            postgresql_where=text('delivered_at IS NULL')
+        ),
+    )
+    id: int | None = Field(default=None, primary_key=True)
+    topic: str
+    key: str | None = Field(default=None)
+    payload: str
+    created_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_column=Column(DateTime(timezone=True), nullable=False)
+    )
+    delivered_at: datetime | None = Field(
+        default=None,
+        sa_column=Column(DateTime(timezone=True), nullable=True)
+    )
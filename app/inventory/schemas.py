@@ -17,16 +17,21 @@ class ItemKind(str, Enum):
 class BaseItem(BaseModel):
     name: str
     kind: ItemKind
-    description: str
+    description: str | None = None
     shop_item_id: int | None
     use_limit: int | None
     cooldown: int | None
-    script: str = None
+    script: str | None = None
 
 
 class ItemResponse(BaseItem):
     id: int
 
+    @classmethod
+    def from_cache(cls, data: dict) -> 'ItemResponse':
+        """Собрать из значения кэша без валидации: его записал сервис"""
+        return cls.model_construct(**{**data, 'kind': ItemKind(data['kind'])})
+
 
 class ItemCreate(SQLModel):
     name: str
@@ -51,7 +56,12 @@ class InventoryItemResponse(SQLModel):
     use_limit: int
     cooldown: int
     amount: int
-    script: str
+    script: str | None = None
+
+    @classmethod
+    def from_cache(cls, data: dict) -> 'InventoryItemResponse':
+        """Собрать из значения кэша без валидации: его записал сервис"""
+        return cls.model_construct(**data)
 
 
 class InventoryResponse(SQLModel):
@@ -59,6 +69,11 @@ class InventoryResponse(SQLModel):
     linked_items: list[InventoryItemResponse] = []
 
 
+class VersionedInventory(InventoryResponse):
+    """Инвентарь с версией строки inventory, по которой версионируется кэш"""
+    version: int = 0
+
+
 class UserInfo(SQLModel):
     user_id: int
     role: str
@@ -70,3 +85,40 @@ class UseItem(BaseModel):
     amount: int = Field(
         gt=0, default=1, description="Количество элементов на использование"
     )
+
+
+class GrantItem(BaseModel):
+    """Модель начисления предмета в инвентарь конкретного игрока"""
+    user_id: int = Field(gt=0, description="ID пользователя")
+    item_id: int = Field(gt=0, description="ID начисляемого предмета")
+    amount: int = Field(gt=0, description="Количество начисляемых предметов")
+
+
+class BatchGrant(BaseModel):
+    """Модель пакетного начисления предметов"""
+    grants: list[GrantItem] = Field(
+        min_length=1,
+        max_length=10000,
+        description="Список начислений (user_id, item_id, amount)"
+    )
+
+
+class GrantStatus(str, Enum):
+    GRANTED = 'granted'
+    INVENTORY_NOT_FOUND = 'inventory_not_found'
+    ITEM_NOT_FOUND = 'item_not_found'
+
+
+class GrantResult(BaseModel):
+    """Результат одного начисления из пакета"""
+    user_id: int
+    item_id: int
+    status: GrantStatus
+    amount: int | None = Field(
+        default=None,
+        description="Количество предмета после начисления"
+    )
+    version: int | None = Field(
+        default=None,
+        description="Версия инвентаря после начисления"
+    )
@@ -6,18 +6,20 @@ from logging.handlers import RotatingFileHandler
 
 from fastapi import FastAPI, Request, status
 from fastapi.responses import JSONResponse
-from fastapi_cache import caches, close_caches
-from fastapi_cache.backends.redis import CACHE_KEY, RedisCacheBackend
 from prometheus_fastapi_instrumentator import Instrumentator
 from sqlalchemy.exc import SQLAlchemyError
-from aiokafka import AIOKafkaProducer
 
 from app.api.inventory import router as inventory_router
 from app.api.items import router as item_router
+from app.cache import CacheBackend, LocalCacheInvalidator, negative_cache
 from app.config import settings
+from app.query_cache import query_cache
+from app.replicas import replica_router
 from app.services.inventory_service import KafkaConsumer
+from app.services.item_service import item_local_cache
+from app.services.outbox_service import OutboxRelay, create_kafka_producer
 
-from app.database import init_db
+from app.database import close_db, init_db, prewarm_pool
 from app.exceptions import (BusinessError, InventoryAlreadyExistsError,
                             ItemAlreadyExistsError, NotAdminError,
                             NotFoundError, ServiceError, ValidationError)
@@ -41,29 +43,44 @@ async def lifespan(app: FastAPI):
     try:
         logger.info('Initializing database...')
         await init_db()
+        await prewarm_pool()
+        for replica in replica_router.replicas:
+            await prewarm_pool(target=replica.engine)
         logger.info('Init cache...')
-        rc = RedisCacheBackend(
-            f'redis://{settings.REDIS_HOST}',
-            encoding='utf-8'
+        rc = CacheBackend(
+            f'redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}'
         )
         try:
-            await rc.set('connection_test', 'ok', expire=1)
-            test_value = await rc.get('connection_test')
-            if test_value != 'ok':
+            if not await rc.ping():
                 raise RuntimeError('Redis connection test failed')
         except Exception as e:
             logger.critical(f'Redis connection failed: {str(e)}')
             raise
-        caches.set(CACHE_KEY, rc)
+        app.state.cache = rc
+        query_cache.configure(rc)
+        replica_router.configure(rc)
+        replica_task = None
+        if replica_router.replicas:
+            replica_task = asyncio.create_task(replica_router.run())
         logger.info('Init cache successfully')
-        consumer = KafkaConsumer()
-        task = asyncio.create_task(consumer.consume_message())
-
-        kafka_producer = AIOKafkaProducer(
-            bootstrap_servers=settings.KAFKA_SERVER
+        invalidator_task = asyncio.create_task(
+            LocalCacheInvalidator(
+                rc, item_local_cache, negative_cache.local_cache
+            ).run()
         )
+        task = None
+        if settings.RUN_KAFKA_CONSUMER:
+            consumer = KafkaConsumer(rc)
+            task = asyncio.create_task(consumer.consume_message())
+
+        kafka_producer = create_kafka_producer()
         await kafka_producer.start()
         app.state.kafkaproducer = kafka_producer
+        relay_task = None
+        if settings.RUN_OUTBOX_RELAY:
+            relay_task = asyncio.create_task(
+                OutboxRelay(kafka_producer).run()
+            )
         logger.info('app started')
     except SQLAlchemyError as e:
         logger.critical(f'Failed to initialize database: {e}')
@@ -71,13 +88,35 @@ async def lifespan(app: FastAPI):
 
     yield
     logger.info('Application shutdown started')
-    await close_caches()
-    task.cancel()
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            logger.info('Consumer task cancelled')
+    if relay_task is not None:
+        relay_task.cancel()
+        try:
+            await relay_task
+        except asyncio.CancelledError:
+            logger.info('Outbox relay task cancelled')
+    if replica_task is not None:
+        replica_task.cancel()
+        try:
+            await replica_task
+        except asyncio.CancelledError:
+            logger.info('Replica health check task cancelled')
+    invalidator_task.cancel()
     try:
-        await task
+        await invalidator_task
     except asyncio.CancelledError:
-        logger.info('Consumer task cancelled')
+        logger.info('Local cache invalidator task cancelled')
     await kafka_producer.stop()
+    query_cache.configure(None)
+    replica_router.configure(None)
+    await rc.close()
+    await replica_router.close()
+    await close_db()
     logger.info('Application shutdown completed')
 
 
@@ -0,0 +1,116 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+CONSUMER_MESSAGES = Counter(
+    'inventory_consumer_messages_total',
+    'Сообщения о новых пользователях, полученные из kafka'
+)
+CONSUMER_INVENTORIES_CREATED = Counter(
+    'inventory_consumer_inventories_created_total',
+    'Инвентари, созданные консьюмером'
+)
+CONSUMER_BATCH_SECONDS = Histogram(
+    'inventory_consumer_batch_seconds',
+    'Время обработки одной пачки сообщений'
+)
+CONSUMER_BATCH_ERRORS = Counter(
+    'inventory_consumer_batch_errors_total',
+    'Ошибки обработки пачек сообщений'
+)
+CONSUMER_BATCHES_SKIPPED = Counter(
+    'inventory_consumer_batches_skipped_total',
+    'Пачки, пропущенные после исчерпания повторов'
+)
+CACHE_LOADS = Counter(
+    'inventory_cache_loads_total',
+    'Загрузки из БД при промахе кэша',
+    ['cache']
+)
+CACHE_LOADS_COALESCED = Counter(
+    'inventory_cache_loads_coalesced_total',
+    'Промахи кэша, дождавшиеся чужой загрузки вместо запроса к БД',
+    ['cache', 'scope']
+)
+CACHE_REFRESHES = Counter(
+    'inventory_cache_refreshes_total',
+    'Фоновые обновления значений кэша до истечения срока',
+    ['cache']
+)
+CACHE_BREAKER_STATE = Gauge(
+    'inventory_cache_breaker_state',
+    'Состояние размыкателя кэша: 0 - замкнут, 1 - разомкнут, 2 - проба',
+    ['cache']
+)
+CACHE_ERRORS = Counter(
+    'inventory_cache_errors_total',
+    'Ошибки и таймауты операций кэша',
+    ['cache']
+)
+CACHE_REJECTED = Counter(
+    'inventory_cache_rejected_total',
+    'Операции кэша, пропущенные разомкнутым размыкателем',
+    ['cache']
+)
+QUERY_CACHE_HITS = Counter(
+    'inventory_query_cache_hits_total',
+    'Попадания в кэш запросов репозиториев',
+    ['family']
+)
+QUERY_CACHE_MISSES = Counter(
+    'inventory_query_cache_misses_total',
+    'Промахи кэша запросов репозиториев',
+    ['family']
+)
+LOADER_BATCH_SIZE = Histogram(
+    'inventory_loader_batch_size',
+    'Количество ключей в одном пакетном запросе загрузчика',
+    ['loader'],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+)
+GROUP_COMMIT_BATCH_SIZE = Histogram(
+    'inventory_group_commit_batch_size',
+    'Количество изменений в одной транзакции групповой записи',
+    ['writer'],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500)
+)
+GROUP_COMMIT_WAIT_SECONDS = Histogram(
+    'inventory_group_commit_wait_seconds',
+    'Ожидание изменения до начала транзакции его пачки',
+    ['writer'],
+    buckets=(0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25)
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    'inventory_db_pool_checked_out',
+    'Соединения пула БД, выданные сессиям',
+    ['pool']
+)
+DB_POOL_OVERFLOW = Gauge(
+    'inventory_db_pool_overflow',
+    'Соединения пула БД сверх pool_size (отрицательное - ещё не открытые)',
+    ['pool']
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    'inventory_db_pool_wait_seconds',
+    'Ожидание соединения из пула БД, включая подключение',
+    ['pool'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 30)
+)
+DB_POOL_TIMEOUTS = Counter(
+    'inventory_db_pool_timeouts_total',
+    'Запросы, не дождавшиеся соединения из пула БД за pool_timeout',
+    ['pool']
+)
+DB_READS = Counter(
+    'inventory_db_reads_total',
+    'Чтения методов репозиториев, которые можно выполнить на реплике',
+    ['pool', 'reason']
+)
+DB_REPLICA_HEALTHY = Gauge(
+    'inventory_db_replica_healthy',
+    'Используется ли реплика для чтения: 1 - да, 0 - исключена',
+    ['pool']
+)
+DB_REPLICA_LAG_SECONDS = Gauge(
+    'inventory_db_replica_lag_seconds',
+    'Отставание реплики на последней проверке',
+    ['pool']
+)
@@ -0,0 +1,44 @@
+"""Add outbox
+
+Revision ID: c3d1e7a9f0b2
+Revises: bbc4a12e65cb
+Create Date: 2026-10-16 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+import sqlmodel
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'c3d1e7a9f0b2'
+down_revision: Union[str, Sequence[str], None] = 'bbc4a12e65cb'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('outboxevent',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('topic', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('key', sqlmodel.sql.sqltypes.AutoString(), nullable=True),
+    sa.Column('payload', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('delivered_at', sa.DateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(
+        'ix_outboxevent_undelivered',
+        'outboxevent',
+        ['id'],
+        unique=False,
+        postgresql_where=sa.text('delivered_at IS NULL')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_outboxevent_undelivered', table_name='outboxevent')
+    op.drop_table('outboxevent')
@@ -0,0 +1,30 @@
+"""Add inventory version
+
+Revision ID: d4e2f8b1a3c5
+Revises: c3d1e7a9f0b2
+Create Date: 2026-10-16 13:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'd4e2f8b1a3c5'
+down_revision: Union[str, Sequence[str], None] = 'c3d1e7a9f0b2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column(
+        'inventory',
+        sa.Column('version', sa.Integer(), server_default='0', nullable=False)
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('inventory', 'version')
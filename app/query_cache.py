@@ -0,0 +1,275 @@
+"""
+Кэш запросов репозиториев.
+
+Методы чтения помечаются декоратором cached_query, методы записи -
+invalidates. Ключ записи строится из семейства запроса и аргументов
+вызова, к нему добавляются текущие версии тегов. Запись в БД увеличивает
+версии своих тегов, и закэшированные результаты с этими тегами перестают
+читаться без удаления по одному. Результат, загруженный из БД до записи,
+сохраняется под ключом со старыми версиями и тоже не читается.
+
+В шаблоне семейства доступно {model} - имя таблицы репозитория, в шаблонах
+тегов - ещё и аргументы метода:
+
+    @classmethod
+    @cached_query('{model}.by_id', tags=('{model}',),
+                  schema=lambda cls: cls.model | None)
+    async def find_one_or_none_by_id(cls, session, data_id: int):
+        ...
+
+Аргумент session (единица работы) в ключ не входит. Теги записей,
+сделанных в единице работы, сбрасываются после её коммита, а до него
+чтения этой единицы работы идут мимо кэша: они видят её незакоммиченные
+изменения. Сброшенные теги получают и commit_listeners (например, окно
+чтения своих записей реплик в app/replicas.py).
+"""
+import functools
+import hashlib
+import inspect
+import logging
+import os
+from logging.handlers import RotatingFileHandler
+from typing import Any, Awaitable, Callable, Iterable
+
+from pydantic import TypeAdapter
+
+from app.cache import CacheBackend
+from app.codec import CODECS, CacheSerializer, cache_serializer
+from app.config import settings
+from app.database import after_commit
+from app.metrics import QUERY_CACHE_HITS, QUERY_CACHE_MISSES
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+handler = RotatingFileHandler(
+    os.path.join(settings.LOG_PATH, 'app.log'),
+    maxBytes=50000,
+    backupCount=1
+)
+logger.addHandler(handler)
+formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+handler.setFormatter(formatter)
+
+
+def tag_key(tag: str) -> str:
+    """Ключ версии тега в redis"""
+    return f'qtag:{tag}'
+
+
+class QueryCache:
+    """
+    Кэш результатов методов репозиториев в redis.
+    Пока backend не задан, методы выполняются без кэша
+    """
+
+    def __init__(self):
+        self.backend: CacheBackend | None = None
+
+    def configure(self, backend: CacheBackend | None) -> None:
+        """Подключить кэш, если он включён настройкой QUERY_CACHE_ENABLED"""
+        self.backend = backend if settings.QUERY_CACHE_ENABLED else None
+
+    @staticmethod
+    def ttl(family: str, default: int | None = None) -> int:
+        """Срок семейства: QUERY_CACHE_FAMILY_TTL, затем default"""
+        return settings.QUERY_CACHE_FAMILY_TTL.get(
+            family, default or settings.QUERY_CACHE_TTL
+        )
+
+    async def invalidate(self, *tags: str) -> None:
+        """
+        Сделать недоступными записи с тегами.
+        Вызывается после коммита изменения
+        """
+        if self.backend is None or not tags:
+            return
+        try:
+            await self.backend.bump_tags(
+                *(tag_key(tag) for tag in tags),
+                expire=settings.QUERY_CACHE_TAG_TTL
+            )
+        except Exception as e:
+            # Записи с тегами останутся до истечения срока семейства
+            logger.error(f'Query cache invalidation failed: {e}')
+
+
+query_cache = QueryCache()
+
+# Ключ session.info с тегами, которые сбросятся после коммита
+PENDING_TAGS = 'query_cache_tags'
+
+# Вызываются с тегами закоммиченных изменений после сброса кэша
+commit_listeners: list[Callable[..., Awaitable[None]]] = []
+
+
+async def tags_committed(*tags: str) -> None:
+    """Сбросить теги закоммиченных изменений и уведомить слушателей"""
+    await query_cache.invalidate(*tags)
+    for listener in commit_listeners:
+        await listener(*tags)
+
+
+def invalidate_on_commit(session, *tags: str) -> None:
+    """Сбросить теги после коммита единицы работы session"""
+    pending = session.info.get(PENDING_TAGS)
+    if pending is None:
+        pending = session.info[PENDING_TAGS] = set()
+        after_commit(session, lambda: tags_committed(*pending))
+    pending.update(tags)
+
+
+def is_dirty(session) -> bool:
+    """Меняла ли единица работы session данные с тегами"""
+    return session is not None and bool(session.info.get(PENDING_TAGS))
+
+
+def bind_arguments(
+    signature: inspect.Signature,
+    args: tuple,
+    kwargs: dict
+) -> tuple[Any, Any, dict]:
+    """Класс репозитория, сессия и остальные аргументы вызова по именам"""
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    arguments = dict(bound.arguments)
+    owner = arguments.pop(next(iter(arguments)))
+    session = arguments.pop('session', None)
+    return owner, session, arguments
+
+
+def model_name(owner) -> str:
+    """Имя таблицы репозитория для {model} в шаблонах"""
+    model = getattr(owner, 'model', None)
+    return model.__tablename__ if model is not None else owner.__name__
+
+
+def _digest(arguments: dict) -> str:
+    """Часть ключа, зависящая от аргументов вызова"""
+    return hashlib.blake2b(
+        repr(sorted(arguments.items())).encode(), digest_size=12
+    ).hexdigest()
+
+
+def cached_query(
+    family: str,
+    tags: tuple[str, ...] = (),
+    ttl: int | None = None,
+    codec: str | None = None,
+    schema: Callable[[type], Any] | None = None
+):
+    """
+    Кэшировать результат метода чтения репозитория.
+    Исключения не кэшируются, ошибки redis приводят к чтению из БД.
+    :param family: шаблон семейства - имени в ключах, сроках и метриках
+    :param tags: шаблоны тегов, по которым сбрасываются записи
+    :param ttl: срок записей, если семейства нет в QUERY_CACHE_FAMILY_TTL
+    :param codec: кодек значений (по умолчанию CACHE_CODEC)
+    :param schema: тип результата по классу репозитория для сериализации
+        (None - результат уже JSON-совместим)
+    """
+    serializer = cache_serializer
+    if codec is not None:
+        serializer = CacheSerializer(
+            CODECS[codec](),
+            compress_min_size=settings.CACHE_COMPRESS_MIN_SIZE,
+            compress_level=settings.CACHE_COMPRESS_LEVEL
+        )
+    adapters: dict[Any, TypeAdapter] = {}
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            backend = query_cache.backend
+            if backend is None:
+                return await func(*args, **kwargs)
+            owner, session, arguments = bind_arguments(
+                signature, args, kwargs
+            )
+            if is_dirty(session):
+                return await func(*args, **kwargs)
+            model = model_name(owner)
+            name = family.format(model=model)
+            adapter = None
+            if schema is not None:
+                adapter = adapters.get(owner)
+                if adapter is None:
+                    adapter = adapters[owner] = TypeAdapter(schema(owner))
+            try:
+                key, raw = await backend.get_tagged(
+                    f'q:{name}:{_digest(arguments)}',
+                    *(
+                        tag_key(tag.format(model=model, **arguments))
+                        for tag in tags
+                    )
+                )
+            except Exception as e:
+                logger.error(f'Query cache get failed: {e}')
+                return await func(*args, **kwargs)
+            if raw is not None:
+                try:
+                    value = serializer.loads(raw)
+                    if adapter is not None:
+                        value = adapter.validate_python(value)
+                except ValueError as e:
+                    # Другой формат или схема: перезаписываем из БД
+                    logger.warning(f'Query cache value {key} skipped: {e}')
+                else:
+                    QUERY_CACHE_HITS.labels(name).inc()
+                    return value
+            QUERY_CACHE_MISSES.labels(name).inc()
+            result = await func(*args, **kwargs)
+            payload = result
+            if adapter is not None:
+                payload = adapter.dump_python(result, mode='json')
+            try:
+                await backend.set(
+                    key,
+                    serializer.dumps(payload),
+                    expire=query_cache.ttl(name, ttl)
+                )
+            except Exception as e:
+                logger.error(f'Query cache set failed: {e}')
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def invalidates(
+    *tags: str,
+    result_tags: Callable[[Any], Iterable[str]] | None = None
+):
+    """
+    Сбросить записи с тегами после успешного метода записи репозитория.
+    Теги сбрасываются после коммита единицы работы из аргумента session,
+    без него - сразу (метод завершает транзакцию сам)
+    :param tags: шаблоны тегов (аргументы метода и {model})
+    :param result_tags: теги, которые зависят от результата метода
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            result = await func(*args, **kwargs)
+            owner, session, arguments = bind_arguments(
+                signature, args, kwargs
+            )
+            model = model_name(owner)
+            keys = [tag.format(model=model, **arguments) for tag in tags]
+            if result_tags is not None:
+                keys.extend(result_tags(result))
+            if session is not None:
+                invalidate_on_commit(session, *keys)
+            else:
+                await tags_committed(*keys)
+            return result
+
+        return wrapper
+
+    return decorator
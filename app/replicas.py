@@ -0,0 +1,240 @@
+"""
+Чтение с реплик БД.
+
+Методы чтения репозиториев, помеченные replica_read, выполняются в своей
+сессии реплики из DB_REPLICA_HOSTS. Реплики выбираются по кругу. Реплика,
+на которой запрос упал, исключается на DB_REPLICA_RETRY_INTERVAL,
+а отставшая больше DB_REPLICA_MAX_LAG - до следующей проверки; запрос
+в этом случае выполняется на основной БД.
+
+Метод читает основную БД, если:
+- реплик нет или все исключены;
+- единица работы запроса уже меняла данные (реплика их ещё не видит);
+- данные с тегами метода менялись за последние
+  DB_REPLICA_READ_YOUR_WRITES секунд (окно чтения своих записей).
+
+Теги те же, что у кэша запросов: изменения инвентаря пользователя
+сбрасывают 'inventory:{user_id}', поэтому после своего изменения
+пользователь читает инвентарь с основной БД:
+
+    @classmethod
+    @replica_read('{model}:{user_id}')
+    async def get_user_inventory(cls, session, user_id: int):
+        ...
+"""
+import asyncio
+import functools
+import inspect
+import logging
+import time
+
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.cache import CacheBackend
+from app.config import settings
+from app.database import create_engine
+from app.exceptions import DatabaseError, RepositoryError
+from app.metrics import DB_READS, DB_REPLICA_HEALTHY, DB_REPLICA_LAG_SECONDS
+from app.query_cache import (bind_arguments, commit_listeners, is_dirty,
+                             model_name)
+
+logger = logging.getLogger(__name__)
+
+# Ошибки запроса к реплике, после которых он повторяется на основной БД
+REPLICA_ERRORS = (SQLAlchemyError, DatabaseError, RepositoryError, OSError)
+
+# Отставание реплики, с; 0 - если реплика догнала основную
+# или это не реплика
+LAG_QUERY = text(
+    'SELECT CASE '
+    'WHEN NOT pg_is_in_recovery() THEN 0 '
+    'WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+    'ELSE COALESCE(EXTRACT(EPOCH FROM '
+    'now() - pg_last_xact_replay_timestamp()), 0) END'
+)
+
+
+def written_key(tag: str) -> str:
+    """Ключ отметки о недавнем изменении данных с тегом в redis"""
+    return f'written:{tag}'
+
+
+class Replica:
+    """Реплика: движок, фабрика сессий и время возврата в работу"""
+
+    def __init__(self, name: str, engine: AsyncEngine):
+        self.name = name
+        self.engine = engine
+        self.session_maker = async_sessionmaker(
+            engine, class_=AsyncSession, expire_on_commit=False
+        )
+        self.unhealthy_until = 0.0
+        DB_REPLICA_HEALTHY.labels(name).set(1)
+
+    @property
+    def healthy(self) -> bool:
+        return self.unhealthy_until <= time.monotonic()
+
+
+class ReplicaRouter:
+    """
+    Выбор реплики для чтения и отметки о недавних изменениях.
+    Отметки хранятся в redis и общие для всех процессов; пока backend
+    не задан или redis недоступен, чтения с тегами идут на основную БД
+    """
+
+    def __init__(self, urls: list[str]):
+        self.replicas = [
+            Replica(f'replica{i}', create_engine(url, name=f'replica{i}'))
+            for i, url in enumerate(urls)
+        ]
+        self.backend: CacheBackend | None = None
+        self._next = 0
+
+    def configure(self, backend: CacheBackend | None) -> None:
+        """Подключить redis для отметок об изменениях"""
+        self.backend = backend
+
+    def choose(self) -> Replica | None:
+        """Следующая по кругу здоровая реплика (None - таких нет)"""
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[self._next % len(self.replicas)]
+            self._next += 1
+            if replica.healthy:
+                return replica
+        return None
+
+    def mark_unhealthy(
+        self,
+        replica: Replica,
+        reason: str,
+        interval: float | None = None
+    ) -> None:
+        """Не использовать реплику interval секунд"""
+        if replica.healthy:
+            logger.warning(f'Replica {replica.name} excluded: {reason}')
+        replica.unhealthy_until = time.monotonic() + (
+            interval or settings.DB_REPLICA_RETRY_INTERVAL
+        )
+        DB_REPLICA_HEALTHY.labels(replica.name).set(0)
+
+    def mark_healthy(self, replica: Replica) -> None:
+        if not replica.healthy:
+            logger.info(f'Replica {replica.name} restored')
+        replica.unhealthy_until = 0.0
+        DB_REPLICA_HEALTHY.labels(replica.name).set(1)
+
+    async def mark_written(self, *tags: str) -> None:
+        """Отметить изменение данных с тегами на окно чтения своих записей"""
+        if self.backend is None or not self.replicas or not tags:
+            return
+        try:
+            await self.backend.set_many(
+                {written_key(tag): b'1' for tag in tags},
+                expire=settings.DB_REPLICA_READ_YOUR_WRITES
+            )
+        except Exception as e:
+            # Отметки не будет: чтение может попасть на отставшую реплику
+            logger.error(f'Replica write marks failed: {e}')
+
+    async def recently_written(self, *tags: str) -> bool:
+        """Менялись ли данные с тегами в окне чтения своих записей"""
+        if not tags:
+            return False
+        if self.backend is None:
+            return True
+        try:
+            marks = await self.backend.get_many(
+                *(written_key(tag) for tag in tags)
+            )
+        except Exception as e:
+            logger.error(f'Replica write marks check failed: {e}')
+            return True
+        return any(mark is not None for mark in marks)
+
+    async def check_health(self) -> None:
+        """Проверить доступность и отставание всех реплик"""
+        for replica in self.replicas:
+            try:
+                async with replica.engine.connect() as conn:
+                    lag = float((await conn.execute(LAG_QUERY)).scalar())
+            except Exception as e:
+                self.mark_unhealthy(replica, f'health check failed: {e}')
+                continue
+            DB_REPLICA_LAG_SECONDS.labels(replica.name).set(lag)
+            if lag > settings.DB_REPLICA_MAX_LAG:
+                self.mark_unhealthy(
+                    replica,
+                    f'lag {lag:.1f}s',
+                    settings.DB_REPLICA_HEALTH_INTERVAL
+                )
+            else:
+                self.mark_healthy(replica)
+
+    async def run(self) -> None:
+        """Проверять реплики каждые DB_REPLICA_HEALTH_INTERVAL секунд"""
+        while True:
+            await self.check_health()
+            await asyncio.sleep(settings.DB_REPLICA_HEALTH_INTERVAL)
+
+    async def close(self) -> None:
+        """Закрыть соединения пулов реплик"""
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+
+replica_router = ReplicaRouter(settings.replica_urls)
+commit_listeners.append(replica_router.mark_written)
+
+
+def replica_read(*tags: str):
+    """
+    Выполнять метод чтения репозитория на реплике.
+    Метод получает сессию реплики вместо session и не должен ничего
+    в ней менять. Бизнес-ошибки метода (например, NotFoundError)
+    не повторяются на основной БД.
+    :param tags: шаблоны тегов данных метода (аргументы метода и {model})
+    для окна чтения своих записей
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not replica_router.replicas:
+                return await func(*args, **kwargs)
+            owner, session, arguments = bind_arguments(
+                signature, args, kwargs
+            )
+            if is_dirty(session):
+                DB_READS.labels('primary', 'unit_of_work').inc()
+                return await func(*args, **kwargs)
+            model = model_name(owner)
+            if await replica_router.recently_written(
+                *(tag.format(model=model, **arguments) for tag in tags)
+            ):
+                DB_READS.labels('primary', 'read_your_writes').inc()
+                return await func(*args, **kwargs)
+            replica = replica_router.choose()
+            if replica is None:
+                DB_READS.labels('primary', 'unhealthy').inc()
+                return await func(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            try:
+                async with replica.session_maker() as replica_session:
+                    async with replica_session.begin():
+                        bound.arguments['session'] = replica_session
+                        result = await func(*bound.args, **bound.kwargs)
+            except REPLICA_ERRORS as e:
+                replica_router.mark_unhealthy(replica, repr(e))
+                DB_READS.labels('primary', 'replica_error').inc()
+                return await func(*args, **kwargs)
+            DB_READS.labels(replica.name, 'replica').inc()
+            return result
+
+        return wrapper
+
+    return decorator
@@ -1,187 +1,520 @@
+from typing import NamedTuple
+
 from fastapi import HTTPException, status
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import (Integer, any_, bindparam, column, delete, func,
+                        literal, tuple_, update)
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.future import select
 from sqlalchemy.sql import exists
 
 from app.base import BaseDAO
-from app.database import get_session
+from app.config import settings
+from app.database import get_session, unit_of_work
 from app.exceptions import (
-    DatabaseError, RepositoryError, InventoryAlreadyExistsError,
+    DatabaseError, RepositoryError,
     ValidationError, NotFoundError
 )
 from app.inventory.common import logger
+from app.group_commit import GroupCommitWriter
 from app.inventory.models import Inventory, InventoryItem, Item
-from app.inventory.schemas import (InventoryItemResponse, InventoryResponse,
-                                   UserInfo, UseItem)
+from app.query_cache import cached_query, invalidate_on_commit, invalidates
+from app.replicas import replica_read
+from app.repositories.outbox_repo import inventory_event
+from app.inventory.schemas import (GrantItem, GrantResult, GrantStatus,
+                                   InventoryItemResponse, InventoryResponse,
+                                   UserInfo, UseItem, VersionedInventory)
+
+# Не больше 3 * 5000 параметров на запрос (лимит asyncpg - 32767)
+BULK_CHUNK_SIZE = 5000
+# Размер порции серверного курсора при потоковой выдаче
+STREAM_YIELD_PER = 1000
+
+
+def bump_inventory_version(*criteria):
+    """
+    CTE, увеличивающее версию инвентарей и блокирующее их строки до конца
+    транзакции. Изменения одного инвентаря выполняются строго по очереди.
+    """
+    return (
+        update(Inventory)
+        .where(*criteria)
+        .values(version=Inventory.version + 1)
+        .returning(Inventory.id, Inventory.user_id, Inventory.version)
+        .cte('bumped_inventory')
+    )
+
+
+def unnest_changes(keys: list[tuple[int, int]], amounts: list[int]):
+    """
+    Строки (inventory_id, item_id, amount) из трёх параметров-массивов:
+    число параметров запроса не зависит от размера пачки
+    """
+    inventory_ids, item_ids = zip(*keys)
+    return func.unnest(
+        bindparam('inventory_ids', list(inventory_ids), type_=ARRAY(Integer)),
+        bindparam('item_ids', list(item_ids), type_=ARRAY(Integer)),
+        bindparam('amounts', amounts, type_=ARRAY(Integer))
+    ).table_valued(
+        column('inventory_id', Integer),
+        column('item_id', Integer),
+        column('amount', Integer)
+    ).render_derived(name='changes')
+
+
+class InventoryMutation(NamedTuple):
+    """Изменение количества предмета для групповой записи"""
+    user_id: int
+    item_id: int
+    amount: int  # > 0 - начисление, < 0 - списание
 
 
 class InventoryRepository(BaseDAO):
     model = Inventory
 
     @classmethod
-    async def add_for_current_user(cls, user: UserInfo):
-        async with get_session() as session:
-            async with session.begin():
-                query = select(exists().where(
-                    cls.model.user_id == user.user_id)
-                )
-                obj = await session.exec(query)
-                obj = obj.one()
-                if obj[0]:
-                    raise HTTPException(
-                        detail='Already exists',
-                        status_code=status.HTTP_409_CONFLICT
-                    )
-                new_instance = cls.model(user_id=user.user_id)
-                session.add(new_instance)
-                return new_instance
+    @invalidates('{model}', '{model}:{user.user_id}')
+    async def add_for_current_user(cls, session, user: UserInfo):
+        query = select(exists().where(
+            cls.model.user_id == user.user_id)
+        )
+        obj = await session.exec(query)
+        obj = obj.one()
+        if obj[0]:
+            raise HTTPException(
+                detail='Already exists',
+                status_code=status.HTTP_409_CONFLICT
+            )
+        new_instance = cls.model(user_id=user.user_id)
+        session.add(new_instance)
+        session.add(inventory_event(
+            user.user_id, None, 0, 0, new_instance.version
+        ))
+        await session.flush()
+        return new_instance
 
     @classmethod
+    async def add_for_users(cls, session, user_ids: list[int]) -> int:
+        """
+        Создать инвентари для нескольких пользователей одним запросом.
+        Уже существующие инвентари пропускаются.
+        Возвращает количество созданных инвентарей.
+        """
+        try:
+            rows = [
+                {'user_id': user_id} for user_id in sorted(set(user_ids))
+            ]
+            query = (
+                pg_insert(cls.model)
+                .values(rows)
+                .on_conflict_do_nothing(index_elements=['user_id'])
+                .returning(cls.model.user_id, cls.model.version)
+            )
+            result = await session.exec(query)
+            created = result.all()
+            session.add_all([
+                inventory_event(user_id, None, 0, 0, version)
+                for user_id, version in created
+            ])
+            invalidate_on_commit(session, 'inventory', *(
+                f'inventory:{user_id}' for user_id, _ in created
+            ))
+            return len(created)
+        except SQLAlchemyError as e:
+            logger.error(f'Database error for create inventories: {e}')
+            raise DatabaseError('Failed to create inventories') from e
+        except Exception as e:
+            logger.error(f'Unexpected error in repository: {e}')
+            raise RepositoryError('Repository operation failed') from e
+
+    @classmethod
+    @invalidates('{model}', '{model}:{user_id}')
     async def add_item(
             cls,
+            session,
             user_id: int,
             item_id: int,
             amount: int
-    ):
+    ) -> tuple[int, int]:
+        """
+        Добавить предмет в инвентарь одним INSERT ... ON CONFLICT.
+        Инвентарь определяется по user_id и получает новую версию
+        в том же запросе. Событие изменения пишется в outbox.
+        Возвращает новое количество предмета и новую версию инвентаря.
+        При GROUP_COMMIT_ENABLED изменение применяется групповой записью
+        в её собственной транзакции, а не в session.
+        """
         if amount <= 0:
-            raise ValidationError(
-                detail='Amount should be positive'
+            raise ValidationError('Amount should be positive')
+        if settings.GROUP_COMMIT_ENABLED:
+            return await inventory_writer.submit(
+                InventoryMutation(user_id, item_id, amount)
             )
-        async with get_session() as session:
-            async with session.begin():
-                query = select(cls.model).filter_by(user_id=user_id)
-                result = await session.exec(query)
-                inv_obj: Inventory = result.scalar_one_or_none()
-                if not inv_obj:
-                    inv_obj: Inventory = Inventory(user_id=user_id)
-                    session.add(inv_obj)
-                    session.commit()
-                    session.refresh(inv_obj)
-
-                item_obj = await session.get(Item, item_id)
-                if not item_obj:
-                    raise HTTPException(
-                        status_code=status.HTTP_404_NOT_FOUND,
-                        detail=(
-                            f'Не существует предмета {item_id}'
-                        )
-                    )
+        try:
+            return await cls._add_item_in(session, user_id, item_id, amount)
+        except NotFoundError:
+            raise
+        except IntegrityError as e:
+            logger.error(f'Integrity error for item_id {item_id}: {e}')
+            raise NotFoundError(f'Item with ID {item_id} not found') from e
+        except SQLAlchemyError as e:
+            logger.error(f'Database error for add item: {e}')
+            raise DatabaseError('Failed to add item to inventory') from e
+        except Exception as e:
+            logger.error(f'Unexpected error in repository: {e}')
+            raise RepositoryError('Repository operation failed') from e
 
-                query = select(InventoryItem).where(
-                    InventoryItem.inventory_id == inv_obj.id,
-                    InventoryItem.item_id == item_id
+    @staticmethod
+    async def _add_item_in(
+            session,
+            user_id: int,
+            item_id: int,
+            amount: int
+    ) -> tuple[int, int]:
+        """Upsert предмета и событие outbox в транзакции session"""
+        # Предмет блокируется (FOR KEY SHARE) раньше инвентаря, как при
+        # удалении предмета и в add_items_bulk. Иначе проверка внешнего
+        # ключа ждала бы удаления, держащего свою блокировку инвентаря
+        item_locked = exists(
+            select(Item.id)
+            .where(Item.id == item_id)
+            .with_for_update(read=True, key_share=True)
+        )
+        inventory = bump_inventory_version(
+            Inventory.user_id == user_id, item_locked
+        )
+        source = select(
+            literal(item_id).label('item_id'),
+            inventory.c.id,
+            literal(amount).label('amount')
+        )
+        query = pg_insert(InventoryItem).from_select(
+            ['item_id', 'inventory_id', 'amount'], source
+        )
+        query = query.on_conflict_do_update(
+            index_elements=['item_id', 'inventory_id'],
+            set_={'amount': InventoryItem.amount + query.excluded.amount}
+        ).returning(
+            InventoryItem.amount,
+            select(inventory.c.version).scalar_subquery()
+        )
+        result = await session.exec(query)
+        row = result.one_or_none()
+        if row is None:
+            result = await session.exec(
+                select(exists().where(Item.id == item_id))
+            )
+            if not result.scalar():
+                raise NotFoundError(f'Item with ID {item_id} not found')
+            raise NotFoundError('Инвентарь пользователя не найден.')
+        new_amount, version = row
+        session.add(inventory_event(
+            user_id, item_id, amount, new_amount, version
+        ))
+        return new_amount, version
+
+    @classmethod
+    @invalidates(
+        '{model}',
+        result_tags=lambda results: [
+            f'inventory:{result.user_id}' for result in results
+            if result.status == GrantStatus.GRANTED
+        ]
+    )
+    async def add_items_bulk(
+            cls,
+            session,
+            grants: list[GrantItem]
+    ) -> list[GrantResult]:
+        """
+        Начислить предметы нескольким пользователям в одной транзакции.
+        Повторяющиеся пары (user_id, item_id) суммируются, затем
+        выполняются многострочные INSERT ... ON CONFLICT пачками.
+        По каждой паре в outbox пишется событие изменения.
+        Возвращает результат для каждого элемента grants в исходном порядке.
+        """
+        totals: dict[tuple[int, int], int] = {}
+        for grant in grants:
+            key = (grant.user_id, grant.item_id)
+            totals[key] = totals.get(key, 0) + grant.amount
+        item_ids = {item_id for _, item_id in totals}
+        try:
+            # FOR SHARE не даёт удалить предмет до конца транзакции
+            result = await session.exec(
+                select(Item.id)
+                .where(Item.id.in_(item_ids))
+                .with_for_update(read=True)
+            )
+            known_items = set(result.scalars().all())
+            granted_users = {
+                user_id for user_id, item_id in totals
+                if item_id in known_items
+            }
+            # Блокируем инвентари по возрастанию id: UPDATE ... WHERE
+            # user_id IN захватывает строки в порядке плана, и пачки
+            # с общими пользователями могли взаимно заблокироваться
+            result = await session.exec(
+                select(Inventory.id)
+                .where(Inventory.user_id.in_(granted_users))
+                .order_by(Inventory.id)
+                .with_for_update()
+            )
+            locked = result.scalars().all()
+            result = await session.exec(
+                update(Inventory)
+                .where(Inventory.id.in_(locked))
+                .values(version=Inventory.version + 1)
+                .returning(
+                    Inventory.user_id,
+                    Inventory.id,
+                    Inventory.version
                 )
-                existing_link = (
-                    await session.exec(query)
-                ).scalar_one_or_none()
-
-                if existing_link:
-                    existing_link.amount += amount
-                else:
-                    new_link = InventoryItem(
-                        inventory_id=inv_obj.id,
-                        item_id=item_id,
-                        amount=amount
-                    )
-                    session.add(new_link)
-                return inv_obj
+                .execution_options(synchronize_session=False)
+            )
+            inventories = {}
+            versions = {}
+            for user_id, inventory_id, version in result.all():
+                inventories[user_id] = inventory_id
+                versions[user_id] = version
+            # Строки inventory_item меняются только под блокировкой
+            # их инвентаря, сортировка лишь делает пачки
+            # воспроизводимыми
+            rows = sorted(
+                (
+                    {
+                        'item_id': item_id,
+                        'inventory_id': inventories[user_id],
+                        'amount': amount
+                    }
+                    for (user_id, item_id), amount in totals.items()
+                    if user_id in inventories
+                    and item_id in known_items
+                ),
+                key=lambda row: (row['item_id'], row['inventory_id'])
+            )
+            amounts = {}
+            for start in range(0, len(rows), BULK_CHUNK_SIZE):
+                query = pg_insert(InventoryItem).values(
+                    rows[start:start + BULK_CHUNK_SIZE]
+                )
+                query = query.on_conflict_do_update(
+                    index_elements=['item_id', 'inventory_id'],
+                    set_={
+                        'amount': (
+                            InventoryItem.amount
+                            + query.excluded.amount
+                        )
+                    }
+                ).returning(
+                    InventoryItem.inventory_id,
+                    InventoryItem.item_id,
+                    InventoryItem.amount
+                )
+                result = await session.exec(query)
+                for inventory_id, item_id, amount in result.all():
+                    amounts[(inventory_id, item_id)] = amount
+            session.add_all([
+                inventory_event(
+                    user_id,
+                    item_id,
+                    delta,
+                    amounts[(inventories[user_id], item_id)],
+                    versions[user_id]
+                )
+                for (user_id, item_id), delta in totals.items()
+                if user_id in inventories and item_id in known_items
+            ])
+        except SQLAlchemyError as e:
+            logger.error(f'Database error for bulk grant: {e}')
+            raise DatabaseError('Failed to grant items') from e
+        except Exception as e:
+            logger.error(f'Unexpected error in repository: {e}')
+            raise RepositoryError('Repository operation failed') from e
+
+        results = []
+        for grant in grants:
+            if grant.item_id not in known_items:
+                grant_status = GrantStatus.ITEM_NOT_FOUND
+                amount = version = None
+            elif grant.user_id not in inventories:
+                grant_status = GrantStatus.INVENTORY_NOT_FOUND
+                amount = version = None
+            else:
+                grant_status = GrantStatus.GRANTED
+                amount = amounts[(inventories[grant.user_id], grant.item_id)]
+                version = versions[grant.user_id]
+            results.append(GrantResult(
+                user_id=grant.user_id,
+                item_id=grant.item_id,
+                status=grant_status,
+                amount=amount,
+                version=version
+            ))
+        return results
 
     @classmethod
+    @cached_query(
+        '{model}.user',
+        tags=('{model}:{user_id}',),
+        schema=lambda cls: VersionedInventory
+    )
+    @replica_read('{model}:{user_id}')
     async def get_user_inventory(
             cls,
+            session,
             user_id: int
     ):
-        async with get_session() as session:
-            async with session.begin():
-                query = select(cls.model).filter_by(user_id=user_id)
-                result = await session.exec(query)
-                inv_obj: Inventory = result.scalar_one_or_none()
-                if not inv_obj:
-                    raise HTTPException(
-                        status_code=status.HTTP_404_NOT_FOUND,
-                        detail=(
-                            f'Не существует инвентаря для '
-                            f'пользователя {user_id}'
-                        )
-                    )
-                query = (
-                    select(
-                        InventoryItem.item_id,
-                        Item.name,
-                        Item.script,
-                        Item.use_limit,
-                        Item.cooldown,
-                        InventoryItem.amount
-                    )
-                    .join(Item, InventoryItem.item_id == Item.id)
-                    .where(InventoryItem.inventory_id == inv_obj.id)
+        query = select(cls.model).filter_by(user_id=user_id)
+        result = await session.exec(query)
+        inv_obj: Inventory = result.scalar_one_or_none()
+        if not inv_obj:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=(
+                    f'Не существует инвентаря для '
+                    f'пользователя {user_id}'
                 )
-                result = await session.exec(query)
-                items_data = result.all()
-                linked_items = [
-                    InventoryItemResponse(
-                        item_id=item_id,
-                        name=name,
-                        script=script,
-                        use_limit=use_limit,
-                        cooldown=cooldown,
-                        amount=amount
-                    )
-                    for item_id, name, script, use_limit, cooldown, amount in (
-                        items_data
-                    )
-                ]
-                return InventoryResponse(
-                    user_id=user_id,
-                    linked_items=linked_items
+            )
+        query = (
+            select(
+                InventoryItem.item_id,
+                Item.name,
+                Item.script,
+                Item.use_limit,
+                Item.cooldown,
+                InventoryItem.amount
+            )
+            .join(Item, InventoryItem.item_id == Item.id)
+            .where(InventoryItem.inventory_id == inv_obj.id)
+        )
+        result = await session.exec(query)
+        items_data = result.all()
+        linked_items = [
+            InventoryItemResponse(
+                item_id=item_id,
+                name=name,
+                script=script,
+                use_limit=use_limit,
+                cooldown=cooldown,
+                amount=amount
+            )
+            for item_id, name, script, use_limit, cooldown, amount in (
+                items_data
+            )
+        ]
+        return VersionedInventory(
+            user_id=user_id,
+            linked_items=linked_items,
+            version=inv_obj.version
+        )
+
+    @classmethod
+    async def get_user_inventories(
+            cls,
+            session,
+            user_ids: list[int]
+    ) -> list[VersionedInventory]:
+        """
+        Получить инвентари нескольких пользователей одним запросом.
+        Пользователи без инвентаря в результат не попадают.
+        """
+        query = (
+            select(
+                Inventory.user_id,
+                Inventory.version,
+                InventoryItem.item_id,
+                Item.name,
+                Item.script,
+                Item.use_limit,
+                Item.cooldown,
+                InventoryItem.amount
+            )
+            .outerjoin(
+                InventoryItem, InventoryItem.inventory_id == Inventory.id
+            )
+            .outerjoin(Item, InventoryItem.item_id == Item.id)
+            .where(
+                Inventory.user_id == any_(
+                    bindparam('user_ids', user_ids, type_=ARRAY(Integer))
+                )
+            )
+        )
+        try:
+            result = await session.exec(query)
+            items_data = result.all()
+        except SQLAlchemyError as e:
+            logger.error(f'Database error for user_ids {user_ids}: {e}')
+            raise DatabaseError('Failed to fetch inventories') from e
+        except Exception as e:
+            logger.error(f'Unexpected error in repository: {e}')
+            raise RepositoryError('Repository operation failed') from e
+
+        inventories: dict[int, VersionedInventory] = {}
+        for (
+            user_id, version, item_id, name, script, use_limit, cooldown,
+            amount
+        ) in items_data:
+            inventory = inventories.get(user_id)
+            if inventory is None:
+                inventory = inventories[user_id] = VersionedInventory(
+                    user_id=user_id, version=version
                 )
+            if item_id is not None:
+                inventory.linked_items.append(InventoryItemResponse(
+                    item_id=item_id,
+                    name=name,
+                    script=script,
+                    use_limit=use_limit,
+                    cooldown=cooldown,
+                    amount=amount
+                ))
+        return list(inventories.values())
 
     @classmethod
     async def get_inventory_by_id(
             cls,
+            session,
             inventory_id: int
     ):
-        async with get_session() as session:
-            async with session.begin():
-                inv_obj = await session.get(Inventory, inventory_id)
-                if not inv_obj:
-                    raise HTTPException(
-                        status_code=status.HTTP_404_NOT_FOUND,
-                        detail=(
-                            f'Не существует инвентаря {inventory_id}'
-                        )
-                    )
-                query = (
-                    select(
-                        InventoryItem.item_id,
-                        Item.name,
-                        InventoryItem.amount
-                    )
-                    .join(Item, InventoryItem.item_id == Item.id)
-                    .where(InventoryItem.inventory_id == inv_obj.id)
-                )
-                result = await session.exec(query)
-                items_data = result.all()
-                items = [
-                    InventoryItemResponse(
-                        item_id=item_id,
-                        name=name,
-                        amount=amount
-                    )
-                    for item_id, name, amount in items_data
-                ]
-                return InventoryResponse(
-                    user_id=inv_obj.user_id,
-                    items=items
+        inv_obj = await session.get(Inventory, inventory_id)
+        if not inv_obj:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=(
+                    f'Не существует инвентаря {inventory_id}'
                 )
+            )
+        query = (
+            select(
+                InventoryItem.item_id,
+                Item.name,
+                InventoryItem.amount
+            )
+            .join(Item, InventoryItem.item_id == Item.id)
+            .where(InventoryItem.inventory_id == inv_obj.id)
+        )
+        result = await session.exec(query)
+        items_data = result.all()
+        items = [
+            InventoryItemResponse(
+                item_id=item_id,
+                name=name,
+                amount=amount
+            )
+            for item_id, name, amount in items_data
+        ]
+        return InventoryResponse(
+            user_id=inv_obj.user_id,
+            items=items
+        )
 
     @classmethod
-    async def check_exists(cls, user_id: int) -> bool:
+    @cached_query('{model}.exists', tags=('{model}:{user_id}',))
+    async def check_exists(cls, session, user_id: int) -> bool:
         try:
-            async with get_session() as session:
-                query = select(exists().where(cls.model.user_id == user_id))
-                result = await session.exec(query)
-                return result.scalar()
+            query = select(exists().where(cls.model.user_id == user_id))
+            result = await session.exec(query)
+            return result.scalar()
         except SQLAlchemyError as e:
             logger.error(f'Database error for user_id {user_id}: {e}')
             raise DatabaseError(
@@ -192,111 +525,467 @@ class InventoryRepository(BaseDAO):
             raise RepositoryError('Repository operation failed') from e
 
     @classmethod
-    async def use_item_from_inventory(cls, use_item: UseItem, user: UserInfo):
+    @invalidates('{model}', '{model}:{user.user_id}')
+    async def use_item_from_inventory(
+            cls,
+            session,
+            use_item: UseItem,
+            user: UserInfo
+    ) -> tuple[int, int]:
+        """
+        Списать предмет одним условным UPDATE, который также увеличивает
+        версию инвентаря. Строка с нулевым остатком удаляется, а событие
+        изменения пишется в outbox в той же транзакции.
+        Возвращает оставшееся количество предмета и новую версию инвентаря.
+        При GROUP_COMMIT_ENABLED изменение применяется групповой записью
+        в её собственной транзакции, а не в session.
+        """
+        if settings.GROUP_COMMIT_ENABLED:
+            return await inventory_writer.submit(InventoryMutation(
+                user.user_id, use_item.item_id, -use_item.amount
+            ))
         try:
-            async with get_session() as session:
-                query = (
-                    select(InventoryItem)
-                    .join(
-                        Inventory, InventoryItem.inventory_id == Inventory.id
-                    )
-                    .where(
-                        Inventory.user_id == user.user_id,
-                        InventoryItem.item_id == use_item.item_id
+            return await cls._use_item_in(
+                session,
+                user.user_id,
+                use_item.item_id,
+                use_item.amount
+            )
+        except (ValidationError, NotFoundError):
+            raise
+        except SQLAlchemyError as e:
+            logger.error(f'Database error for use item: {e}')
+            raise DatabaseError('Failed to use item from inventory') from e
+        except Exception as e:
+            logger.error(f'Unexpected error in repository: {e}')
+            raise RepositoryError('Repository operation failed') from e
+
+    @classmethod
+    async def _use_item_in(
+            cls,
+            session,
+            user_id: int,
+            item_id: int,
+            amount: int
+    ) -> tuple[int, int]:
+        """Условное списание и событие outbox в транзакции session"""
+        inventory = bump_inventory_version(Inventory.user_id == user_id)
+        query = (
+            update(InventoryItem)
+            .where(
+                InventoryItem.inventory_id == (
+                    select(inventory.c.id).scalar_subquery()
+                ),
+                InventoryItem.item_id == item_id,
+                InventoryItem.amount >= amount
+            )
+            .values(amount=InventoryItem.amount - amount)
+            .returning(
+                InventoryItem.inventory_id,
+                InventoryItem.amount,
+                select(inventory.c.version).scalar_subquery()
+            )
+            .execution_options(synchronize_session=False)
+        )
+        result = await session.exec(query)
+        row = result.one_or_none()
+        if row is None:
+            await cls._raise_use_item_failure(session, user_id, item_id)
+        updated_inventory_id, left, version = row
+        session.add(inventory_event(user_id, item_id, -amount, left, version))
+        if left == 0:
+            await session.exec(
+                delete(InventoryItem)
+                .where(
+                    InventoryItem.inventory_id == updated_inventory_id,
+                    InventoryItem.item_id == item_id,
+                    InventoryItem.amount == 0
+                )
+                .execution_options(synchronize_session=False)
+            )
+        return left, version
+
+    @classmethod
+    async def apply_mutations(
+            cls,
+            mutations: list[InventoryMutation]
+    ) -> list[tuple[int, int] | Exception]:
+        """
+        Применить изменения разных запросов в одной транзакции с одним
+        коммитом. Начисления одной строки складываются и применяются
+        одним INSERT ... ON CONFLICT на всю пачку, списания - одним
+        условным UPDATE. Списания строки, которой не хватило на все
+        списания пачки, применяются по одному в порядке поступления.
+        Начисления пачки считаются выполненными раньше её списаний,
+        версия каждого инвентаря увеличивается один раз за пачку.
+        Отсутствие предмета или инвентаря и нехватка количества
+        становятся результатом своего изменения и не мешают остальным.
+        Возвращает (количество, версия) или исключение по каждому изменению.
+        Пачка общая для нескольких запросов и выполняется в своей единице
+        работы.
+        """
+        added_items = {
+            mutation.item_id for mutation in mutations if mutation.amount > 0
+        }
+        user_ids = {mutation.user_id for mutation in mutations}
+        results: list[tuple[int, int] | Exception | None] = (
+            [None] * len(mutations)
+        )
+        try:
+            async with unit_of_work() as session:
+                # Отсутствующий предмет проверяется заранее: ошибка
+                # внешнего ключа оборвала бы транзакцию всей пачки.
+                # FOR SHARE не даёт удалить предмет до коммита
+                known_items = set()
+                if added_items:
+                    result = await session.exec(
+                        select(Item.id)
+                        .where(Item.id.in_(added_items))
+                        .with_for_update(read=True)
                     )
+                    known_items = set(result.scalars().all())
+                # Инвентари пачки блокируются по возрастанию id, как
+                # в add_items_bulk: пачки не ждут друг друга по кругу
+                result = await session.exec(
+                    select(Inventory.user_id, Inventory.id)
+                    .where(Inventory.user_id.in_(user_ids))
+                    .order_by(Inventory.id)
+                    .with_for_update()
                 )
-                result = await session.exec(query)
-                db_item = result.scalar_one_or_none()
-                if db_item.amount < use_item.amount:
-                    raise ValidationError('Not unough items')
-                db_item.amount -= use_item.amount
-                if db_item.amount == 0:
-                    await session.delete(db_item)
-                await session.commit()
-        except ValidationError:
-            raise
+                inventories = dict(result.all())
+                # Номера изменений по строке (inventory_id, item_id)
+                adds: dict[tuple[int, int], list[int]] = {}
+                uses: dict[tuple[int, int], list[int]] = {}
+                for index, (user_id, item_id, amount) in enumerate(
+                    mutations
+                ):
+                    if amount > 0 and item_id not in known_items:
+                        results[index] = NotFoundError(
+                            f'Item with ID {item_id} not found'
+                        )
+                    elif user_id not in inventories:
+                        results[index] = NotFoundError(
+                            f'Inventory for user with ID {user_id} not found'
+                        )
+                    else:
+                        rows = adds if amount > 0 else uses
+                        rows.setdefault(
+                            (inventories[user_id], item_id), []
+                        ).append(index)
+                # Количество после каждого успешного изменения
+                amounts: dict[int, int] = {}
+                if adds:
+                    amounts.update(
+                        await cls._apply_adds(session, mutations, adds)
+                    )
+                if uses:
+                    amounts.update(
+                        await cls._apply_uses(
+                            session, mutations, uses, results
+                        )
+                    )
+                versions = {}
+                if amounts:
+                    result = await session.exec(
+                        update(Inventory)
+                        .where(Inventory.id.in_({
+                            inventories[mutations[index].user_id]
+                            for index in amounts
+                        }))
+                        .values(version=Inventory.version + 1)
+                        .returning(Inventory.id, Inventory.version)
+                        .execution_options(synchronize_session=False)
+                    )
+                    versions = dict(result.all())
+                for index in sorted(amounts):
+                    user_id, item_id, delta = mutations[index]
+                    version = versions[inventories[user_id]]
+                    results[index] = (amounts[index], version)
+                    session.add(inventory_event(
+                        user_id, item_id, delta, amounts[index], version
+                    ))
         except SQLAlchemyError as e:
-            logger.error(f'Database error for create new inventory: {e}')
-            raise DatabaseError('Failed to create new  inventory') from e
-        except InventoryAlreadyExistsError:
-            raise
+            logger.error(f'Database error for group commit: {e}')
+            raise DatabaseError('Failed to apply inventory changes') from e
         except Exception as e:
             logger.error(f'Unexpected error in repository: {e}')
             raise RepositoryError('Repository operation failed') from e
+        return results
+
+    @staticmethod
+    async def _apply_adds(
+            session,
+            mutations: list[InventoryMutation],
+            adds: dict[tuple[int, int], list[int]]
+    ) -> dict[int, int]:
+        """
+        Начисления пачки одним upsert по сумме на строку.
+        Возвращает количество после каждого начисления по его номеру
+        """
+        keys = sorted(adds)
+        changes = unnest_changes(keys, [
+            sum(mutations[index].amount for index in adds[key])
+            for key in keys
+        ])
+        query = pg_insert(InventoryItem).from_select(
+            ['inventory_id', 'item_id', 'amount'],
+            select(
+                changes.c.inventory_id,
+                changes.c.item_id,
+                changes.c.amount
+            )
+        )
+        query = query.on_conflict_do_update(
+            index_elements=['item_id', 'inventory_id'],
+            set_={'amount': InventoryItem.amount + query.excluded.amount}
+        ).returning(
+            InventoryItem.inventory_id,
+            InventoryItem.item_id,
+            InventoryItem.amount
+        )
+        result = await session.exec(query)
+        amounts = {}
+        for inventory_id, item_id, total in result.all():
+            indexes = adds[(inventory_id, item_id)]
+            amount = total - sum(mutations[index].amount for index in indexes)
+            for index in indexes:
+                amount += mutations[index].amount
+                amounts[index] = amount
+        return amounts
+
+    @classmethod
+    async def _apply_uses(
+            cls,
+            session,
+            mutations: list[InventoryMutation],
+            uses: dict[tuple[int, int], list[int]],
+            results: list
+    ) -> dict[int, int]:
+        """
+        Списания пачки одним условным UPDATE по сумме на строку.
+        Строки, которым суммы не хватило, списываются по одному;
+        ошибки таких списаний записываются в results.
+        Возвращает количество после каждого списания по его номеру
+        """
+        keys = sorted(uses)
+        totals = {
+            key: -sum(mutations[index].amount for index in uses[key])
+            for key in keys
+        }
+        changes = unnest_changes(keys, [totals[key] for key in keys])
+        result = await session.exec(
+            update(InventoryItem)
+            .where(
+                InventoryItem.inventory_id == changes.c.inventory_id,
+                InventoryItem.item_id == changes.c.item_id,
+                InventoryItem.amount >= changes.c.amount
+            )
+            .values(amount=InventoryItem.amount - changes.c.amount)
+            .returning(
+                InventoryItem.inventory_id,
+                InventoryItem.item_id,
+                InventoryItem.amount
+            )
+            .execution_options(synchronize_session=False)
+        )
+        amounts = {}
+        left = {}
+        for inventory_id, item_id, amount in result.all():
+            left[(inventory_id, item_id)] = amount
+            amount += totals[(inventory_id, item_id)]
+            for index in uses[(inventory_id, item_id)]:
+                amount += mutations[index].amount
+                amounts[index] = amount
+        for key in keys:
+            if key in left:
+                continue
+            inventory_id, item_id = key
+            # Условное списание без строки не обрывает транзакцию,
+            # поэтому точка сохранения не нужна
+            for index in uses[key]:
+                user_id, _, amount = mutations[index]
+                result = await session.exec(
+                    update(InventoryItem)
+                    .where(
+                        InventoryItem.inventory_id == inventory_id,
+                        InventoryItem.item_id == item_id,
+                        InventoryItem.amount >= -amount
+                    )
+                    .values(amount=InventoryItem.amount + amount)
+                    .returning(InventoryItem.amount)
+                    .execution_options(synchronize_session=False)
+                )
+                row = result.scalar_one_or_none()
+                if row is None:
+                    try:
+                        await cls._raise_use_item_failure(
+                            session, user_id, item_id
+                        )
+                    except (NotFoundError, ValidationError) as e:
+                        results[index] = e
+                    continue
+                left[key] = amounts[index] = row
+        emptied = [key for key, amount in left.items() if amount == 0]
+        if emptied:
+            await session.exec(
+                delete(InventoryItem)
+                .where(
+                    tuple_(
+                        InventoryItem.inventory_id, InventoryItem.item_id
+                    ).in_(emptied),
+                    InventoryItem.amount == 0
+                )
+                .execution_options(synchronize_session=False)
+            )
+        return amounts
+
+    @staticmethod
+    async def _raise_use_item_failure(session, user_id: int, item_id: int):
+        """
+        Определить причину, по которой списание не затронуло ни одной строки.
+        Выполняется только на неуспешном пути.
+        """
+        query = (
+            select(Inventory.id, InventoryItem.amount)
+            .outerjoin(
+                InventoryItem,
+                (InventoryItem.inventory_id == Inventory.id)
+                & (InventoryItem.item_id == item_id)
+            )
+            .where(Inventory.user_id == user_id)
+        )
+        result = await session.exec(query)
+        row = result.one_or_none()
+        if row is None:
+            raise NotFoundError(
+                f'Inventory for user with ID {user_id} not found'
+            )
+        _, amount = row
+        if amount is None:
+            raise NotFoundError(
+                f'User with ID {user_id} not have item {item_id}'
+            )
+        raise ValidationError('Not enough items')
+
+    @staticmethod
+    def _inventories_with_item_query(item_id: int):
+        """
+        Строки InventoryItem с предметом, упорядоченные по inventory_id.
+        Порядок совпадает с первичным ключом (item_id, inventory_id),
+        поэтому keyset-пагинация идёт по индексу без сортировки.
+        """
+        return (
+            select(
+                InventoryItem.inventory_id,
+                Inventory.user_id,
+                InventoryItem.amount
+            )
+            .join(Inventory, InventoryItem.inventory_id == Inventory.id)
+            .where(InventoryItem.item_id == item_id)
+            .order_by(InventoryItem.inventory_id)
+        )
+
+    @staticmethod
+    def _inventory_with_item(
+        item: Item,
+        user_id: int,
+        amount: int
+    ) -> InventoryResponse:
+        return InventoryResponse(
+            user_id=user_id,
+            linked_items=[
+                InventoryItemResponse(
+                    item_id=item.id,
+                    name=item.name,
+                    shop_item_id=item.shop_item_id,
+                    script=item.script,
+                    use_limit=item.use_limit,
+                    cooldown=item.cooldown,
+                    amount=amount
+                )
+            ]
+        )
+
+    @staticmethod
+    async def _get_item_or_raise(session, item_id: int) -> Item:
+        item_result = await session.exec(select(Item).filter_by(id=item_id))
+        item_obj = item_result.scalar_one_or_none()
+        if not item_obj:
+            raise NotFoundError(f"Item with ID {item_id} not found")
+        return item_obj
 
     @classmethod
+    @replica_read('item', '{model}')
     async def get_inventories_with_item(
         cls,
+        session,
         item_id: int,
-    ):
+        after_inventory_id: int | None = None,
+        limit: int = 100
+    ) -> tuple[list[InventoryResponse], int | None]:
+        """
+        Страница инвентарей, содержащих предмет (keyset-пагинация).
+        Выдача и списание предметов отмечают тег 'inventory', поэтому
+        после них страница читается с основной БД.
+
+        :param item_id: идентификатор предмета
+        :param after_inventory_id: курсор — последний inventory_id
+        предыдущей страницы
+        :param limit: размер страницы
+        :return: инвентари и курсор следующей страницы
+        (None, если страница последняя)
+        :raises NotFoundError: если предмет не найден
+        """
+        try:
+            item_obj = await cls._get_item_or_raise(session, item_id)
+            query = cls._inventories_with_item_query(item_id)
+            if after_inventory_id is not None:
+                query = query.where(
+                    InventoryItem.inventory_id > after_inventory_id
+                )
+            # Лишняя строка показывает, есть ли следующая страница
+            result = await session.exec(query.limit(limit + 1))
+            rows = result.all()
+            next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+            return [
+                cls._inventory_with_item(item_obj, user_id, amount)
+                for _, user_id, amount in rows[:limit]
+            ], next_cursor
+        except NotFoundError:
+            raise
+        except SQLAlchemyError as e:
+            logger.error(f'Database error: {e}')
+            raise DatabaseError('Database operation failed') from e
+        except Exception as e:
+            logger.error(f'Unexpected error: {e}')
+            raise RepositoryError('Repository operation failed') from e
+
+    @classmethod
+    async def stream_inventories_with_item(cls, item_id: int):
+        """
+        Все инвентари, содержащие предмет, через серверный курсор.
+        Строки читаются порциями по STREAM_YIELD_PER, поэтому память
+        не зависит от числа владельцев предмета. Поток читается после
+        завершения запроса, поэтому открывает свою сессию.
+
+        :param item_id: идентификатор предмета
+        :return: асинхронный итератор InventoryResponse
+        :raises NotFoundError: если предмет не найден
+        """
         async with get_session() as session:
             async with session.begin():
-                item_query = select(Item).filter_by(id=item_id)
-                item_result = await session.exec(item_query)
-                item_obj: Item = item_result.scalar_one_or_none()
-                if not item_obj:
-                    raise NotFoundError(f"Item with ID {item_id} not found")
-                query = (
-                    select(
-                        InventoryItem.inventory_id,
-                        Inventory.user_id,
-                        Item.name,
-                        Item.script,
-                        Item.use_limit,
-                        Item.cooldown,
-                        Item.shop_item_id,
-                        InventoryItem.amount
-                    )
-                    .join(Item, InventoryItem.item_id == Item.id)
-                    .join(
-                        Inventory,
-                        InventoryItem.inventory_id == Inventory.id
-                    )
-                    .where(InventoryItem.item_id == item_id)
+                item_obj = await cls._get_item_or_raise(session, item_id)
+                result = await session.stream(
+                    cls._inventories_with_item_query(item_id)
+                    .execution_options(yield_per=STREAM_YIELD_PER)
                 )
+                async for _, user_id, amount in result:
+                    yield cls._inventory_with_item(item_obj, user_id, amount)
 
-                result = await session.exec(query)
-                items_data = result.all()
-                inventories = {}
-                for (
-                    inventory_id,
-                    user_id,
-                    name,
-                    script,
-                    use_limit,
-                    cooldown,
-                    shop_item_id,
-                    amount
-                 ) in items_data:
-                    if inventory_id not in inventories:
-                        inventories[inventory_id] = {
-                            'user_id': user_id,
-                            'linked_items': []
-                        }
-                    inventories[inventory_id]['linked_items'].append({
-                        'item_id': item_id,
-                        'name': name,
-                        'script': script,
-                        'use_limit': use_limit,
-                        'cooldown': cooldown,
-                        'shop_item_id': shop_item_id,
-                        'amount': amount
-                    })
-                return [
-                    InventoryResponse(
-                        user_id=data['user_id'],
-                        linked_items=[
-                            InventoryItemResponse(
-                                item_id=item['item_id'],
-                                name=item['name'],
-                                shop_item_id=item['shop_item_id'],
-                                script=item['script'],
-                                use_limit=item['use_limit'],
-                                cooldown=item['cooldown'],
-                                amount=item['amount']
-                            )
-                            for item in data['linked_items']
-                        ]
-                    )
-                    for inventory_id, data in inventories.items()
-                ]
+
+inventory_writer = GroupCommitWriter(
+    'inventory',
+    InventoryRepository.apply_mutations,
+    window_ms=settings.GROUP_COMMIT_WINDOW_MS,
+    max_batch=settings.GROUP_COMMIT_MAX_BATCH
+)
@@ -1,22 +1,81 @@
-from sqlalchemy import exists, select
+from sqlalchemy import (Integer, any_, bindparam, delete, exists, select,
+                        update)
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.exc import SQLAlchemyError
 
 from app.base import BaseDAO, logger
-from app.database import get_session
+from app.config import settings
+from app.database import unit_of_work
+from app.dataloader import BatchLoader
 from app.exceptions import DatabaseError, RepositoryError
-from app.inventory.models import Item
+from app.inventory.models import Inventory, InventoryItem, Item, OutboxEvent
+from app.query_cache import cached_query, invalidates, is_dirty
+from app.repositories.outbox_repo import inventory_event
 
 
 class ItemRepository(BaseDAO):
     model = Item
 
     @classmethod
-    async def check_name_exists(cls, name: str) -> bool:
+    async def find_many_by_ids(
+            cls,
+            session,
+            item_ids: list[int]
+    ) -> dict[int, Item]:
+        """
+        Получить предметы одним запросом WHERE id = ANY(...).
+        Отсутствующие предметы в результат не попадают.
+        """
+        query = select(cls.model).where(
+            cls.model.id == any_(
+                bindparam('item_ids', item_ids, type_=ARRAY(Integer))
+            )
+        )
         try:
-            async with get_session() as session:
-                query = select(exists().where(cls.model.name == name))
-                result = await session.exec(query)
-                return result.scalar()
+            result = await session.exec(query)
+            return {item.id: item for item in result.scalars().all()}
+        except SQLAlchemyError as e:
+            logger.error(f"Database error for item_ids {item_ids}: {e}")
+            raise DatabaseError("Failed to fetch items") from e
+        except Exception as e:
+            logger.error(f"Unexpected error in repository: {e}")
+            raise RepositoryError("Repository operation failed") from e
+
+    @classmethod
+    @cached_query(
+        '{model}.by_id',
+        tags=('{model}',),
+        schema=lambda cls: cls.model | None
+    )
+    async def find_one_or_none_by_id(
+            cls,
+            session,
+            data_id: int
+    ) -> Item | None:
+        """
+        Одновременные запросы предметов выполняются одним SELECT на
+        отдельном соединении. Единица работы, уже менявшая предметы,
+        читает через свою сессию
+        """
+        if is_dirty(session):
+            return await super().find_one_or_none_by_id(session, data_id)
+        return await item_loader.load(data_id)
+
+    @classmethod
+    @cached_query('{model}.exists', tags=('{model}',))
+    async def check_exists(cls, session, item_id: int) -> bool:
+        """Одновременные проверки предметов выполняются одним SELECT"""
+        if is_dirty(session):
+            return await super().check_exists(session, item_id)
+        return await item_loader.load(item_id) is not None
+
+    @classmethod
+    @cached_query('{model}.name_exists', tags=('{model}',))
+    async def check_name_exists(cls, session, name: str) -> bool:
+        try:
+            query = select(exists().where(cls.model.name == name))
+            result = await session.exec(query)
+            return result.scalar()
         except SQLAlchemyError as e:
             logger.error(f"Database error for item {name}: {e}")
             raise DatabaseError(
@@ -25,3 +84,129 @@ class ItemRepository(BaseDAO):
         except Exception as e:
             logger.error(f"Unexpected error in repository: {e}")
             raise RepositoryError("Repository operation failed") from e
+
+    @classmethod
+    @invalidates('{model}')
+    async def add_with_event(
+            cls,
+            session,
+            values: dict,
+            topic: str
+    ) -> Item:
+        """
+        Создать предмет и событие outbox о нём в одной транзакции
+        """
+        try:
+            new_instance = cls.model(**values)
+            session.add(new_instance)
+            await session.flush()
+            session.add(OutboxEvent(
+                topic=topic,
+                key=str(new_instance.id),
+                payload=new_instance.model_dump_json()
+            ))
+            return new_instance
+        except SQLAlchemyError as e:
+            logger.error(f"Database error: {e}")
+            raise DatabaseError("Failed to add new item") from e
+        except Exception as e:
+            logger.error(f"Unexpected error in repository: {e}")
+            raise RepositoryError("Repository operation failed") from e
+
+    @classmethod
+    @invalidates(
+        '{model}',
+        'inventory',
+        result_tags=lambda versions: [
+            f'inventory:{user_id}' for user_id in versions
+        ]
+    )
+    async def delete_with_events(
+            cls,
+            session,
+            item_id: int
+    ) -> dict[int, int]:
+        """
+        Удалить предмет вместе с его записями в инвентарях.
+        Для каждого затронутого инвентаря увеличивается версия и в outbox
+        пишется событие списания остатка.
+        Возвращает новые версии затронутых инвентарей по user_id.
+        Блокировки берутся в том же порядке, что у начислений и списаний:
+        предмет, инвентари по возрастанию id, затем их строки с предметом.
+        """
+        try:
+            await session.exec(
+                select(cls.model.id)
+                .where(cls.model.id == item_id)
+                .with_for_update()
+            )
+            await session.exec(
+                select(Inventory.id)
+                .where(Inventory.id.in_(
+                    select(InventoryItem.inventory_id)
+                    .where(InventoryItem.item_id == item_id)
+                ))
+                .order_by(Inventory.id)
+                .with_for_update()
+            )
+            result = await session.exec(
+                delete(InventoryItem)
+                .where(InventoryItem.item_id == item_id)
+                .returning(
+                    InventoryItem.inventory_id,
+                    InventoryItem.amount
+                )
+                .execution_options(synchronize_session=False)
+            )
+            removed = dict(result.all())
+            versions = {}
+            if removed:
+                result = await session.exec(
+                    update(Inventory)
+                    .where(Inventory.id.in_(removed))
+                    .values(version=Inventory.version + 1)
+                    .returning(
+                        Inventory.id,
+                        Inventory.user_id,
+                        Inventory.version
+                    )
+                    .execution_options(synchronize_session=False)
+                )
+                for inventory_id, user_id, version in result.all():
+                    versions[user_id] = version
+                    session.add(inventory_event(
+                        user_id,
+                        item_id,
+                        -removed[inventory_id],
+                        0,
+                        version
+                    ))
+            await session.exec(
+                delete(cls.model)
+                .where(cls.model.id == item_id)
+                .execution_options(synchronize_session=False)
+            )
+            return versions
+        except SQLAlchemyError as e:
+            logger.error(f"Database error for item_id {item_id}: {e}")
+            raise DatabaseError(f"Failed to delete item {item_id}") from e
+        except Exception as e:
+            logger.error(f"Unexpected error in repository: {e}")
+            raise RepositoryError("Repository operation failed") from e
+
+
+async def _load_items(item_ids: list[int]) -> dict[int, Item]:
+    """
+    Загрузить пачку предметов для item_loader. Пачка общая для
+    нескольких запросов, поэтому читается в своей единице работы
+    """
+    async with unit_of_work() as session:
+        return await ItemRepository.find_many_by_ids(session, item_ids)
+
+
+item_loader = BatchLoader(
+    'item',
+    _load_items,
+    window_us=settings.ITEM_LOADER_WINDOW_US,
+    max_batch=settings.ITEM_LOADER_MAX_BATCH
+)
@@ -0,0 +1,113 @@
+import json
+from datetime import datetime, timezone
+from typing import Awaitable, Callable
+
+from sqlalchemy import delete, func, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.future import select
+
+from app.base import BaseDAO, logger
+from app.config import settings
+from app.database import get_session
+from app.exceptions import DatabaseError, RepositoryError
+from app.inventory.models import OutboxEvent
+
+# Ключ pg_try_advisory_xact_lock, под которым отправляется outbox
+OUTBOX_RELAY_LOCK_ID = 7_346_001
+
+
+def inventory_event(
+        user_id: int,
+        item_id: int | None,
+        delta: int,
+        amount: int,
+        version: int
+) -> OutboxEvent:
+    """
+    Событие изменения инвентаря для INVENTORY_EVENTS_TOPIC.
+    Ключ - user_id, поэтому события одного пользователя попадают в одну
+    партицию и сохраняют порядок. Все события одной транзакции имеют
+    одинаковую версию инвентаря.
+    """
+    payload = {
+        'user_id': user_id,
+        'item_id': item_id,
+        'delta': delta,
+        'amount': amount,
+        'version': version
+    }
+    return OutboxEvent(
+        topic=settings.INVENTORY_EVENTS_TOPIC,
+        key=str(user_id),
+        payload=json.dumps(payload, separators=(',', ':'))
+    )
+
+
+class OutboxRepository(BaseDAO):
+    model = OutboxEvent
+
+    @classmethod
+    async def deliver_pending(
+            cls,
+            limit: int,
+            publish: Callable[[list[OutboxEvent]], Awaitable[None]]
+    ) -> int:
+        """
+        Отправить пачку недоставленных событий и пометить их доставленными.
+        Relay запущен в каждом процессе API, но отправляет события только
+        держатель advisory-блокировки транзакции: пачки уходят строго
+        по очереди в порядке id, и события одного пользователя не
+        обгоняют друг друга. Остальные процессы сразу получают 0.
+        Если publish выбрасывает исключение, транзакция откатывается и
+        события будут отправлены повторно.
+        Возвращает количество отправленных событий.
+        """
+        try:
+            async with get_session() as session:
+                async with session.begin():
+                    locked = await session.scalar(
+                        select(func.pg_try_advisory_xact_lock(
+                            OUTBOX_RELAY_LOCK_ID
+                        ))
+                    )
+                    if not locked:
+                        return 0
+                    query = (
+                        select(cls.model)
+                        .where(cls.model.delivered_at.is_(None))
+                        .order_by(cls.model.id)
+                        .limit(limit)
+                    )
+                    result = await session.exec(query)
+                    events = result.scalars().all()
+                    if not events:
+                        return 0
+                    await publish(events)
+                    await session.exec(
+                        update(cls.model)
+                        .where(cls.model.id.in_([e.id for e in events]))
+                        .values(delivered_at=datetime.now(timezone.utc))
+                        .execution_options(synchronize_session=False)
+                    )
+                    return len(events)
+        except SQLAlchemyError as e:
+            logger.error(f"Database error in outbox: {e}")
+            raise DatabaseError("Failed to deliver outbox events") from e
+
+    @classmethod
+    async def purge_delivered(cls, older_than: datetime) -> None:
+        """Удалить доставленные события старше older_than"""
+        try:
+            async with get_session() as session:
+                async with session.begin():
+                    await session.exec(
+                        delete(cls.model)
+                        .where(cls.model.delivered_at < older_than)
+                        .execution_options(synchronize_session=False)
+                    )
+        except SQLAlchemyError as e:
+            logger.error(f"Database error in outbox: {e}")
+            raise DatabaseError("Failed to purge outbox events") from e
+        except Exception as e:
+            logger.error(f"Unexpected error in repository: {e}")
+            raise RepositoryError("Repository operation failed") from e
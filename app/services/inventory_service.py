@@ -2,21 +2,31 @@ import logging
 import os
 import asyncio
 import json
+import time
 from logging.handlers import RotatingFileHandler
 
 from fastapi import Depends
-from fastapi.encoders import jsonable_encoder
-from fastapi_cache.backends.redis import RedisCacheBackend
-from aiokafka import AIOKafkaConsumer
+from aiokafka import AIOKafkaConsumer, ConsumerRebalanceListener
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 
+from app.cache import (CacheBackend, CacheEntry, cache_ttl, mark_stale,
+                       negative_cache, single_flight)
+from app.codec import cache_serializer
 from app.config import settings
+from app.database import after_commit, get_unit_of_work, unit_of_work
 from app.exceptions import (DatabaseError, InventoryAlreadyExistsError,
-                            NotAdminError, NotFoundError, ServiceError)
+                            NotAdminError, NotFoundError, ServiceError,
+                            ValidationError)
 from app.inventory.models import Inventory
 from app.inventory.common import get_cache
-from app.inventory.schemas import (ItemToInventory, SuccessResponse, UseItem,
-                                   UserInfo, InventoryResponse)
+from app.metrics import (CONSUMER_BATCH_ERRORS, CONSUMER_BATCH_SECONDS,
+                         CONSUMER_BATCHES_SKIPPED,
+                         CONSUMER_INVENTORIES_CREATED, CONSUMER_MESSAGES)
+from app.inventory.schemas import (BatchGrant, GrantResult, GrantStatus,
+                                   InventoryItemResponse, InventoryResponse,
+                                   ItemToInventory, SuccessResponse, UseItem,
+                                   UserInfo, VersionedInventory)
 from app.repositories.inventory_repo import InventoryRepository
 from app.services.item_service import ItemService, get_item_service
 
@@ -38,15 +48,19 @@ class InventoryService:
     """
     Сервис для работы с инвентарями пользователей.
     Содержит бизнес-логику для создания, получения и изменения инвентарей.
+    Репозитории вызываются в сессии единицы работы запроса, кэш
+    меняется после её коммита.
     """
 
     def __init__(
         self,
         item_service: ItemService,
-        cache: RedisCacheBackend
+        cache: CacheBackend,
+        session: AsyncSession
     ):
         self.inventory_repository = InventoryRepository()
         self.cache = cache
+        self.session = session
         self.item_service = item_service
 
     async def create_inventory(self, user: UserInfo) -> Inventory:
@@ -57,15 +71,18 @@ class InventoryService:
         :return: созданный инвентарь
         """
         is_inventory_exist = await (
-            self.inventory_repository.check_exists(user.user_id)
+            self.inventory_repository.check_exists(self.session, user.user_id)
         )
         if not is_inventory_exist:
             try:
                 new_inventory = await (
                     self.inventory_repository.add_for_current_user(
-                        user
+                        self.session, user
                     )
                 )
+                after_commit(self.session, lambda: negative_cache.forget(
+                    self.cache, f'missing:inventory_{user.user_id}'
+                ))
                 return new_inventory
             except InventoryAlreadyExistsError:
                 # Инвентарь уже существует — пробрасываем исключение
@@ -87,24 +104,55 @@ class InventoryService:
     ):
         """
         Добавить предмет в инвентарь пользователя
+        Отсутствие предмета или инвентаря определяется по результату
+        upsert'а в репозитории, без предварительных запросов
         :param item_to_inventory: данные о добавляемом предмете
         :param user: информация о пользователе
-        :return: обновлённый инвентарь
+        :return: новое количество предмета в инвентаре
         """
-        await self.cache.delete(f'inventory_{user.user_id}')
         try:
-            await self.item_service.get_item(item_to_inventory.item_id)
-            is_inventory_exist = await self.inventory_repository.check_exists(
-                user.user_id
+            amount, version = await self.inventory_repository.add_item(
+                self.session,
+                user_id=user.user_id,
+                item_id=item_to_inventory.item_id,
+                amount=item_to_inventory.amount
             )
-
-            if is_inventory_exist:
-                fields = item_to_inventory.model_dump()
-                fields.update({'user_id': user.user_id})
-                return await self.inventory_repository.add_item(**fields)
-            raise NotFoundError('Инвентарь пользователя не найден.')
-        except NotFoundError:
+        except (NotFoundError, ValidationError):
             raise
+        except DatabaseError as e:
+            logger.error(f"Database error in service: {e}")
+            raise ServiceError("Service temporarily unavailable") from e
+        after_commit(self.session, lambda: self.write_through(
+            user.user_id, item_to_inventory.item_id, amount, version
+        ))
+        return amount
+
+    async def grant_items(
+        self,
+        batch: BatchGrant,
+        user: UserInfo
+    ) -> list[GrantResult]:
+        """
+        Пакетно начислить предметы в инвентари пользователей.
+        Доступно только администратору
+        :param batch: список начислений (user_id, item_id, amount)
+        :param user: информация о пользователе
+        :return: результат для каждого начисления
+        """
+        await self.check_user_is_admin(user)
+        try:
+            results = await self.inventory_repository.add_items_bulk(
+                self.session, batch.grants
+            )
+        except DatabaseError as e:
+            logger.error(f"Database error in service: {e}")
+            raise ServiceError("Service temporarily unavailable") from e
+        after_commit(self.session, lambda: mark_stale(self.cache, {
+            f'inventory_{result.user_id}': result.version
+            for result in results
+            if result.status == GrantStatus.GRANTED
+        }))
+        return results
 
     async def get_user_inventory(self, user: UserInfo):
         """
@@ -112,26 +160,126 @@ class InventoryService:
         :param user: пользователь
         :return: инвентарь пользователя
         """
-        cache_key = f'inventory_{user.user_id}'
-        cached_data = await self.cache.get(cache_key)
+        entry = await self._read_cached_inventory(user.user_id)
+        if entry is None:
+            entry = await single_flight.load(
+                self.cache,
+                f'inventory_{user.user_id}',
+                'inventory',
+                read_cached=lambda: self._read_cached_inventory(user.user_id),
+                load=lambda: self._load_inventory(user.user_id)
+            )
+        elif entry.needs_refresh():
+            self.refresh_inventory(user.user_id)
+        return entry.value
+
+    def refresh_inventory(self, user_id: int) -> None:
+        """Обновить закэшированный инвентарь в фоне"""
+        single_flight.refresh(
+            self.cache,
+            f'inventory_{user_id}',
+            'inventory',
+            lambda: self._load_inventory(user_id)
+        )
+
+    async def _read_cached_inventory(
+        self, user_id: int
+    ) -> CacheEntry | None:
+        try:
+            [cached_data] = await self.cache.get_versioned_many(
+                f'inventory_{user_id}'
+            )
+        except Exception as e:
+            logger.error(f'Cache get failed: {e}')
+            return None
         if cached_data:
             try:
-                return InventoryResponse(**json.loads(cached_data))
-            except json.JSONDecodeError:
+                return self.decode_inventory(user_id, cached_data)
+            except (ValueError, KeyError, TypeError):
                 logger.error('Failed to decode cached data')
-        await self.check_inventory_exists(user.user_id)
-        inventory = await self.inventory_repository.get_user_inventory(
-            user.user_id
-        )
+        return None
+
+    async def _load_inventory(self, user_id: int) -> CacheEntry:
+        # Загрузка общая для запросов и может пережить запрос,
+        # поэтому идёт в своей единице работы
+        started = time.monotonic()
+        async with unit_of_work() as session:
+            await self.check_inventory_exists(user_id, session)
+            inventory = await self.inventory_repository.get_user_inventory(
+                session, user_id
+            )
+        entry = CacheEntry.fresh(inventory, time.monotonic() - started)
         try:
-            await self.cache.set(
-                cache_key,
-                json.dumps(jsonable_encoder(inventory)),
-                expire=settings.CACHE_EXPIRE,
+            await self.cache.set_versioned_many(
+                {f'inventory_{user_id}': self.encode_inventory(entry)},
+                expire=cache_ttl(),
             )
         except Exception as e:
             logger.error(f'Cache set failed: {e}')
-        return inventory
+        return entry
+
+    async def get_user_inventories(
+        self,
+        user_ids: list[int]
+    ) -> list[InventoryResponse]:
+        """
+        Получить инвентари нескольких пользователей.
+        Кэш читается одним MGET, промахи загружаются одним запросом к БД
+        и записываются в кэш одним пайплайном
+        :param user_ids: идентификаторы пользователей
+        :return: найденные инвентари в порядке user_ids
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        cache_keys = [f'inventory_{user_id}' for user_id in user_ids]
+        inventories: dict[int, InventoryResponse] = {}
+        try:
+            cached = await self.cache.get_versioned_many(*cache_keys)
+        except Exception as e:
+            logger.error(f'Cache get failed: {e}')
+            cached = [None] * len(cache_keys)
+        for user_id, cached_data in zip(user_ids, cached):
+            if cached_data:
+                try:
+                    entry = self.decode_inventory(user_id, cached_data)
+                except (ValueError, KeyError, TypeError):
+                    logger.error('Failed to decode cached data')
+                    continue
+                inventories[user_id] = entry.value
+                if entry.needs_refresh():
+                    self.refresh_inventory(user_id)
+        missing = [
+            user_id for user_id in user_ids if user_id not in inventories
+        ]
+        if missing:
+            started = time.monotonic()
+            try:
+                loaded = await self.inventory_repository.get_user_inventories(
+                    self.session, missing
+                )
+            except DatabaseError as e:
+                logger.error(f"Database error in service: {e}")
+                raise ServiceError("Service temporarily unavailable") from e
+            for inventory in loaded:
+                inventories[inventory.user_id] = inventory
+            delta = time.monotonic() - started
+            try:
+                await self.cache.set_versioned_many(
+                    {
+                        f'inventory_{inventory.user_id}': (
+                            self.encode_inventory(
+                                CacheEntry.fresh(inventory, delta)
+                            )
+                        )
+                        for inventory in loaded
+                    },
+                    expire=cache_ttl(),
+                )
+            except Exception as e:
+                logger.error(f'Cache set failed: {e}')
+        return [
+            inventories[user_id] for user_id in user_ids
+            if user_id in inventories
+        ]
 
     async def use_item_from_inventory(
         self,
@@ -140,45 +288,148 @@ class InventoryService:
     ):
         """
         Использование и списание предмета из инвентаря пользователя
-        Проверяет наличие инвентаря и предмета, уменьшает количество
-        или удаляет предмет
+        Списание выполняется одним условным UPDATE в репозитории,
+        который различает отсутствие инвентаря/предмета и нехватку количества
         :param use_item: данные о списываемом предмете
         :param user: пользователь
         :return: SuccessResponse при успехе
         """
-        await self.check_inventory_exists(user.user_id)
-        await self.item_service.check_item_exists(use_item.item_id)
-        user_inventory = await self.get_user_inventory(user)
+        try:
+            amount, version = (
+                await self.inventory_repository.use_item_from_inventory(
+                    self.session,
+                    use_item,
+                    user
+                )
+            )
+        except (NotFoundError, ValidationError):
+            raise
+        except DatabaseError as e:
+            logger.error(f"Database error in service: {e}")
+            raise ServiceError("Service temporarily unavailable") from e
+        after_commit(self.session, lambda: self.write_through(
+            user.user_id, use_item.item_id, amount, version
+        ))
+        return SuccessResponse(
+            detail=f"Item {use_item.item_id} used success"
+        )
 
-        if any(
-            item.item_id == use_item.item_id
-            for item in user_inventory.linked_items
-        ):
-            await self.inventory_repository.use_item_from_inventory(
-                use_item,
-                user
+    async def write_through(
+        self,
+        user_id: int,
+        item_id: int,
+        amount: int,
+        version: int
+    ) -> None:
+        """
+        Применить изменение количества предмета к закэшированному
+        инвентарю вместо удаления ключа. Изменение применяется только
+        к записи предыдущей версии, поэтому опоздавший писатель
+        не перезапишет более новое состояние
+        :param amount: новое количество предмета (0 - предмет удалён)
+        :param version: версия инвентаря после изменения
+        """
+        cache_key = f'inventory_{user_id}'
+        field = f'item:{item_id}'
+        try:
+            if amount > 0:
+                item = await self.item_service.get_item(item_id)
+                linked_item = InventoryItemResponse(
+                    item_id=item_id,
+                    name=item.name,
+                    script=item.script,
+                    use_limit=item.use_limit,
+                    cooldown=item.cooldown,
+                    amount=amount
+                )
+                fields = {
+                    field: cache_serializer.dumps(linked_item.model_dump())
+                }
+                deleted = ()
+            else:
+                fields, deleted = {}, (field,)
+            await self.cache.patch_versioned(
+                cache_key,
+                version,
+                fields,
+                deleted,
+                expire=cache_ttl()
             )
-            await self.cache.delete(f'inventory_{user.user_id}')
-            return SuccessResponse(
-                detail=f"Item {use_item.item_id} used success"
+        except Exception as e:
+            logger.error(f'Cache write-through failed: {e}')
+            # Метка версии, а не удаление: запрос, прочитавший БД до
+            # изменения, не запишет устаревший инвентарь обратно.
+            # Ошибки кэша mark_stale не пробрасывает
+            await mark_stale(self.cache, {cache_key: version})
+
+    @staticmethod
+    def encode_inventory(entry: CacheEntry) -> tuple[int, dict]:
+        """
+        Представление инвентаря в кэше: hash с полем на каждый предмет
+        и сроком годности записи
+        :param entry: запись с инвентарём (VersionedInventory)
+        :return: версия и поля записи
+        """
+        inventory: VersionedInventory = entry.value
+        fields = {
+            f'item:{linked_item.item_id}': cache_serializer.dumps(
+                linked_item.model_dump()
             )
+            for linked_item in inventory.linked_items
+        }
+        fields['delta'] = entry.delta
+        fields['expires_at'] = entry.expires_at
+        return inventory.version, fields
 
-        # Если предмета нет — выбрасываем NotFoundError
-        raise NotFoundError(
-            f"User with ID {user.user_id} not have item {use_item.item_id}"
+    @staticmethod
+    def decode_inventory(user_id: int, fields: dict) -> CacheEntry:
+        """
+        Собрать инвентарь из полей версионированной записи кэша.
+        Модели собираются без валидации
+        :raises ValueError: если поле в другом формате
+        """
+        inventory = InventoryResponse.model_construct(
+            user_id=user_id,
+            linked_items=sorted(
+                (
+                    InventoryItemResponse.from_cache(
+                        cache_serializer.loads(value)
+                    )
+                    for field, value in fields.items()
+                    if field.startswith('item:')
+                ),
+                key=lambda linked_item: linked_item.item_id
+            )
+        )
+        return CacheEntry(
+            inventory,
+            float(fields.get('delta', 0)),
+            float(fields.get('expires_at', 0))
         )
 
-    async def check_inventory_exists(self, user_id: int) -> bool:
+    async def check_inventory_exists(
+        self,
+        user_id: int,
+        session: AsyncSession | None = None
+    ) -> bool:
         """
         Проверить, что инвентарь пользователя существует
         :param user_id: идентификатор пользователя
+        :param session: сессия, если не сессия запроса
         :return: True, если инвентарь есть, иначе выбрасывает NotFoundError
+        Отсутствие инвентаря запоминается на NEGATIVE_CACHE_TTL
         """
+        missing_key = f'missing:inventory_{user_id}'
+        if await negative_cache.is_missing(self.cache, missing_key):
+            raise NotFoundError(
+                f"Inventory for user with ID {user_id} not found"
+            )
         is_inventory_exist = await self.inventory_repository.check_exists(
-            user_id
+            session or self.session, user_id
         )
         if is_inventory_exist:
             return is_inventory_exist
+        await negative_cache.remember(self.cache, missing_key)
         raise NotFoundError(f"Inventory for user with ID {user_id} not found")
 
     @staticmethod
@@ -194,50 +445,125 @@ class InventoryService:
     async def get_all_with_item(
         self,
         item_id: int,
-    ) -> list[InventoryResponse]:
+        after_inventory_id: int | None = None,
+        limit: int = 100
+    ) -> tuple[list[InventoryResponse], int | None]:
         """
-        Получить список всех инвентарей с предметом
-        :return: список инвентарей
+        Получить страницу инвентарей с предметом
+        :param item_id: идентификатор предмета
+        :param after_inventory_id: курсор предыдущей страницы
+        :param limit: размер страницы
+        :return: список инвентарей и курсор следующей страницы
         """
-        return await self.inventory_repository.get_inventories_with_item(
-            item_id,
-        )
+        try:
+            return await self.inventory_repository.get_inventories_with_item(
+                self.session,
+                item_id,
+                after_inventory_id=after_inventory_id,
+                limit=limit
+            )
+        except NotFoundError:
+            raise
+        except DatabaseError as e:
+            logger.error(f'Database error in service: {e}')
+            raise ServiceError('Service temporarily unavailable') from e
+
+    async def stream_all_with_item(self, item_id: int):
+        """
+        Получить все инвентари с предметом в формате NDJSON.
+        Существование предмета проверяется до начала ответа,
+        чтобы отдать 404 вместо оборванного потока.
+        :param item_id: идентификатор предмета
+        :return: асинхронный итератор строк NDJSON
+        """
+        try:
+            await self.item_service.check_item_exists(item_id)
+        except DatabaseError as e:
+            logger.error(f'Database error in service: {e}')
+            raise ServiceError('Service temporarily unavailable') from e
+        return self._ndjson_lines(item_id)
+
+    async def _ndjson_lines(self, item_id: int):
+        try:
+            async for inventory in (
+                self.inventory_repository.stream_inventories_with_item(
+                    item_id
+                )
+            ):
+                yield inventory.model_dump_json() + '\n'
+        except Exception as e:
+            logger.error(f'Inventory stream for item {item_id} failed: {e}')
+            raise
 
 
 async def get_inventory_service(
-    cache: RedisCacheBackend = Depends(get_cache),
+    cache: CacheBackend = Depends(get_cache),
     item_service: ItemService = Depends(get_item_service),
+    session: AsyncSession = Depends(get_unit_of_work),
 ) -> InventoryService:
-    return InventoryService(cache=cache, item_service=item_service)
+    return InventoryService(
+        cache=cache, item_service=item_service, session=session
+    )
+
+
+class KafkaRebalanceListener(ConsumerRebalanceListener):
+    """Дожидается обработки отзываемых партиций и коммитит их оффсеты"""
+
+    def __init__(self, kafka_consumer: 'KafkaConsumer'):
+        self.kafka_consumer = kafka_consumer
+
+    async def on_partitions_revoked(self, revoked):
+        await self.kafka_consumer.drain_partitions(revoked)
+
+    async def on_partitions_assigned(self, assigned):
+        pass
 
 
 class KafkaConsumer:
-    def __init__(self):
+    def __init__(self, cache: CacheBackend | None = None):
+        self.cache = cache
         self.topic_name = 'prod.auth.fact.new-user.1'
         self.bootstrap_servers = settings.KAFKA_SERVER
         self.group_id = 'inventory'
+        self.batch_size = settings.KAFKA_CONSUMER_BATCH_SIZE
+        self.flush_interval_ms = settings.KAFKA_CONSUMER_FLUSH_INTERVAL_MS
+        self.workers = settings.KAFKA_CONSUMER_WORKERS
+        self.queue_size = settings.KAFKA_CONSUMER_QUEUE_SIZE
+        self.max_retries = settings.KAFKA_CONSUMER_MAX_RETRIES
+        self.drain_timeout_ms = settings.KAFKA_CONSUMER_DRAIN_TIMEOUT_MS
+        self.inventory_repository = InventoryRepository()
+        self._semaphore = asyncio.Semaphore(self.workers)
+        self._queues: dict = {}
+        self._worker_tasks: dict = {}
+        self._processed_offsets: dict = {}
 
     async def consume_message(self):
-        """Получение сообщения из kafka"""
+        """
+        Получение сообщений из kafka пачками.
+        Оффсеты коммитятся вручную только после успешной записи пачки в БД.
+        При KAFKA_CONSUMER_WORKERS > 1 партиции обрабатываются параллельно
+        """
 
         while True:
             try:
                 self.consumer = AIOKafkaConsumer(
-                    self.topic_name,
                     bootstrap_servers=self.bootstrap_servers,
                     group_id=self.group_id,
                     heartbeat_interval_ms=10000,
-                    auto_offset_reset='earliest'
+                    auto_offset_reset='earliest',
+                    enable_auto_commit=False,
+                    max_poll_records=self.batch_size
+                )
+                self.consumer.subscribe(
+                    [self.topic_name],
+                    listener=KafkaRebalanceListener(self)
                 )
                 await self.consumer.start()
                 logger.info('Starting concuming kafka...')
-
-                async for msg in self.consumer:
-                    try:
-                        await self.process_message(msg)
-                    except Exception as e:
-                        logger.error(f'Consumer message processing error: {e}')
-                        continue
+                if self.workers > 1:
+                    await self.consume_partitioned()
+                else:
+                    await self.consume_sequential()
             except asyncio.CancelledError:
                 logger.info("Consumer stopped by application")
                 break
@@ -245,18 +571,183 @@ class KafkaConsumer:
                 logger.error(f"Consumer failed: {e}. Reconnecting...")
                 await asyncio.sleep(5)
             finally:
+                await self.stop_partition_workers()
                 await self.consumer.stop()
 
-    async def process_message(self, msg):
+    async def consume_sequential(self):
+        """Обработка пачек из всех партиций по очереди"""
+        while True:
+            batches = await self.consumer.getmany(
+                timeout_ms=self.flush_interval_ms,
+                max_records=self.batch_size
+            )
+            messages = [
+                msg for partition_messages in batches.values()
+                for msg in partition_messages
+            ]
+            if not messages:
+                continue
+            await self.process_with_retries(messages, 'all partitions')
+            await self.consumer.commit()
+
+    async def consume_partitioned(self):
+        """
+        Раздача пачек по воркерам партиций через ограниченные очереди.
+        Заполненная очередь медленной партиции тормозит чтение из kafka,
+        порядок внутри партиции сохраняется
+        """
+        while True:
+            batches = await self.consumer.getmany(
+                timeout_ms=self.flush_interval_ms,
+                max_records=self.batch_size
+            )
+            for tp, messages in batches.items():
+                if messages:
+                    await self.get_partition_queue(tp).put(messages)
+            await self.commit_processed()
+
+    def get_partition_queue(self, tp) -> asyncio.Queue:
+        """Вернуть очередь партиции, запустив для неё воркер при необходимости"""
+        if tp not in self._queues:
+            queue = asyncio.Queue(maxsize=self.queue_size)
+            self._queues[tp] = queue
+            self._worker_tasks[tp] = asyncio.create_task(
+                self.partition_worker(tp, queue)
+            )
+        return self._queues[tp]
+
+    async def process_with_retries(self, messages, source) -> None:
+        """
+        Обработать пачку, повторяя её с растущей паузой.
+        После KAFKA_CONSUMER_MAX_RETRIES неудач пачка пропускается,
+        чтобы одна неисправимая пачка не останавливала партицию навсегда.
+        Пропущенные user_id пишутся в лог для ручной повторной обработки
+        :param source: партиция для логов
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._semaphore:
+                    await self.process_batch(messages)
+                return
+            except Exception as e:
+                CONSUMER_BATCH_ERRORS.inc()
+                logger.error(
+                    f'Consumer batch processing error for {source} '
+                    f'(attempt {attempt + 1}): {e}'
+                )
+                if attempt < self.max_retries:
+                    await asyncio.sleep(min(2 ** attempt, 30))
+        CONSUMER_BATCHES_SKIPPED.inc()
+        logger.critical(
+            f'Skipped batch from {source}, offsets '
+            f'{messages[0].offset}-{messages[-1].offset}, user_ids '
+            f'{[self.parse_message(msg) for msg in messages]}'
+        )
+
+    async def partition_worker(self, tp, queue: asyncio.Queue):
+        """
+        Последовательно обрабатывает пачки одной партиции.
+        Неудачная пачка повторяется, чтобы не нарушить порядок
+        """
+        while True:
+            messages = await queue.get()
+            try:
+                await self.process_with_retries(messages, tp)
+                self._processed_offsets[tp] = messages[-1].offset + 1
+            finally:
+                queue.task_done()
+
+    async def commit_processed(self):
+        """Закоммитить оффсеты, до которых дошли воркеры партиций"""
+        if not self._processed_offsets:
+            return
+        offsets, self._processed_offsets = self._processed_offsets, {}
+        await self.consumer.commit(offsets)
+
+    async def drain_partitions(self, partitions):
+        """
+        Дождаться обработки очередей партиций и остановить их воркеры.
+        Ожидание ограничено KAFKA_CONSUMER_DRAIN_TIMEOUT_MS, чтобы
+        не задерживать ребалансировку группы: необработанные пачки
+        получит новый владелец партиции с последнего оффсета
+        """
+        queues = {
+            tp: self._queues.pop(tp) for tp in partitions if tp in self._queues
+        }
+        if queues:
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*(q.join() for q in queues.values())),
+                    timeout=self.drain_timeout_ms / 1000
+                )
+            except asyncio.TimeoutError:
+                logger.warning(
+                    f'Partitions {list(queues)} were not drained in time'
+                )
+        for tp in queues:
+            self._worker_tasks.pop(tp).cancel()
+        await self.commit_processed()
+
+    async def stop_partition_workers(self):
+        """Остановить воркеры партиций без ожидания очередей"""
+        tasks = list(self._worker_tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._queues.clear()
+        self._worker_tasks.clear()
+        self._processed_offsets.clear()
+
+    async def process_batch(self, messages) -> int:
+        """
+        Создать инвентари для всех пользователей из пачки сообщений
+        одним INSERT ... ON CONFLICT DO NOTHING
+        :return: количество созданных инвентарей
+        """
+        CONSUMER_MESSAGES.inc(len(messages))
+        user_ids = [
+            user_id for user_id in map(self.parse_message, messages)
+            if user_id
+        ]
+        if not user_ids:
+            return 0
+        with CONSUMER_BATCH_SECONDS.time():
+            async with unit_of_work() as session:
+                created = await self.inventory_repository.add_for_users(
+                    session, user_ids
+                )
+        CONSUMER_INVENTORIES_CREATED.inc(created)
+        if self.cache is not None and created:
+            try:
+                await negative_cache.forget(
+                    self.cache,
+                    *(f'missing:inventory_{user_id}' for user_id in user_ids)
+                )
+            except Exception as e:
+                logger.error(f'Cache invalidation failed: {e}')
+        logger.info(
+            f'Processed {len(messages)} messages, '
+            f'created {created} inventories'
+        )
+        return created
+
+    @staticmethod
+    def parse_message(msg) -> int | None:
+        """Извлечь user_id из сообщения о новом пользователе"""
         try:
             message = json.loads(msg.value.decode('utf-8'))
-            logger.info(f'Recieved message from kafka: {message}')
-            user_id = message.get('user_id')
-            role = message.get('role')
-            if user_id:
-                inv_service = await get_inventory_service()
-                await inv_service.create_inventory(
-                    UserInfo(user_id=user_id, role=role)
-                )
-        except json.JSONDecodeError as e:
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
             logger.error(f'Consumer msg decode error: {e}')
+            return None
+        if not isinstance(message, dict):
+            logger.error(f'Consumer msg has unexpected format: {message}')
+            return None
+        user_id = message.get('user_id')
+        # bool - подкласс int, но id пользователя быть не может
+        if (
+            not isinstance(user_id, int) or isinstance(user_id, bool)
+            or user_id <= 0
+        ):
+            logger.error(f'Consumer msg has invalid user_id: {message}')
+            return None
+        return user_id
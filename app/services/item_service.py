@@ -1,14 +1,16 @@
 import logging
 import os
-import json
+import time
 from logging.handlers import RotatingFileHandler
 from fastapi.responses import Response
-from fastapi.encoders import jsonable_encoder
-from fastapi import status, Depends, Request
-from fastapi_cache.backends.redis import RedisCacheBackend
+from fastapi import status, Depends
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 
+from app.cache import (CacheBackend, CacheEntry, LocalCache, cache_ttl,
+                       mark_stale, negative_cache, single_flight)
 from app.config import settings
+from app.database import after_commit, get_unit_of_work, unit_of_work
 from app.exceptions import (DatabaseError, ItemAlreadyExistsError,
                             NotAdminError, NotFoundError, ServiceError,
                             ValidationError)
@@ -30,22 +32,43 @@ formatter = logging.Formatter(
 )
 handler.setFormatter(formatter)
 
+ITEM_EVENTS_TOPIC = 'shop.inventory.updates'
+
+# Общий для всех запросов процесса кэш декодированных ItemResponse.
+# Возвращаемые из него объекты разделяются между запросами,
+# изменять их нельзя.
+item_local_cache = LocalCache(
+    maxsize=settings.ITEM_LOCAL_CACHE_SIZE,
+    ttl=settings.ITEM_LOCAL_CACHE_TTL
+)
+
 
 class ItemService:
     """
     Сервис для работы с предметами (Item)
-    Содержит бизнес-логику для создания, получения и поиска предметов
+    Содержит бизнес-логику для создания, получения и поиска предметов.
+    Репозитории вызываются в сессии единицы работы запроса, кэш
+    меняется после её коммита
     """
 
-    def __init__(self, cache: RedisCacheBackend):
+    def __init__(
+        self,
+        cache: CacheBackend,
+        session: AsyncSession,
+        local_cache: LocalCache = item_local_cache
+    ):
         self.item_repository = ItemRepository()
         self.cache = cache
+        self.session = session
+        self.local_cache = local_cache
 
     async def create_item(
-        self, item: ItemCreate, user: UserInfo, request: Request
+        self, item: ItemCreate, user: UserInfo
     ) -> Item:
         """
         Создать новый предмет. Доступен только администратору
+        Событие о новом предмете записывается в outbox в той же транзакции
+        и отправляется в kafka фоновым OutboxRelay
 
         :param item: данные нового предмета (ItemCreate)
         :param user: пользователь
@@ -53,24 +76,20 @@ class ItemService:
         """
         await self.check_user_is_admin(user)
         is_item_exist = await (
-            self.item_repository.check_name_exists(item.name)
+            self.item_repository.check_name_exists(self.session, item.name)
         )
         if is_item_exist:
             raise ItemAlreadyExistsError('Item already exists')
         try:
-            await self.cache.delete('items_list')
             new_instance: Item = await (
-                self.item_repository.add(item.model_dump())
-            )
-            producer = request.app.state.kafkaproducer
-            try:
-                await producer.send_and_wait(
-                    topic='shop.inventory.updates',
-                    key=str(new_instance.id).encode('utf-8'),
-                    value=new_instance.model_dump_json().encode('utf-8')
+                self.item_repository.add_with_event(
+                    self.session, item.model_dump(), ITEM_EVENTS_TOPIC
                 )
-            except Exception as e:
-                logger.error(f'Error in kafka producing: {e}')
+            )
+            after_commit(self.session, lambda: self.invalidate('items_list'))
+            after_commit(self.session, lambda: negative_cache.forget(
+                self.cache, f'missing:item_{new_instance.id}'
+            ))
             return new_instance
         except DatabaseError as e:
             logger.error(f'Database error in service: {e}')
@@ -81,28 +100,36 @@ class ItemService:
 
     async def get_all_items(self) -> list[ItemResponse]:
         """
-        Получить список всех предметов
+        Получить список всех предметов.
+        Сначала проверяется локальный кэш процесса, затем Redis.
+        Одновременные промахи загружают список из БД один раз,
+        устаревший список отдаётся сразу и обновляется в фоне
 
         :return: список предметов (list[ItemResponse])
         """
         cache_key = 'items_list'
+        items = self.local_cache.get(cache_key)
+        if items is not None:
+            return list(items)
         try:
-            cached_data = await self.cache.get(cache_key)
-            if cached_data:
-                try:
-                    return json.loads(cached_data)
-                except json.JSONDecodeError:
-                    logger.error('Failed to decode cached data')
-            items = await self.item_repository.find_all()
-            try:
-                await self.cache.set(
+            entry = await self._read_cached_items(cache_key)
+            if entry is None:
+                entry = await single_flight.load(
+                    self.cache,
+                    cache_key,
+                    'items_list',
+                    read_cached=lambda: self._read_cached_items(cache_key),
+                    load=lambda: self._load_items(cache_key)
+                )
+            elif entry.needs_refresh():
+                single_flight.refresh(
+                    self.cache,
                     cache_key,
-                    json.dumps(jsonable_encoder(items)),
-                    expire=settings.CACHE_EXPIRE
+                    'items_list',
+                    lambda: self._load_items(cache_key)
                 )
-            except Exception as e:
-                logger.error(f'Cache set failed: {e}')
-            return items
+            self.local_cache.set(cache_key, entry.value)
+            return list(entry.value)
         except DatabaseError as e:
             logger.error(f'Database error in service: {e}')
             raise ServiceError('Service temporarily unavailable') from e
@@ -110,34 +137,81 @@ class ItemService:
             logger.error(f'Unexpected error in service: {e}')
             raise ServiceError('Internal service error') from e
 
-    async def get_item(self, item_id: int) -> Item | None:
+    async def _read_cached_items(self, cache_key: str) -> CacheEntry | None:
+        try:
+            cached_data = await self.cache.get(cache_key)
+        except Exception as e:
+            logger.error(f'Cache get failed: {e}')
+            return None
+        if cached_data:
+            try:
+                payload, delta, expires_at = CacheEntry.loads(cached_data)
+                return CacheEntry(
+                    [ItemResponse.from_cache(item) for item in payload],
+                    delta,
+                    expires_at
+                )
+            except (ValueError, KeyError, TypeError):
+                logger.error('Failed to decode cached data')
+        return None
+
+    async def _load_items(self, cache_key: str) -> CacheEntry:
+        # Загрузка общая для запросов и может пережить запрос,
+        # поэтому идёт в своей единице работы
+        started = time.monotonic()
+        async with unit_of_work() as session:
+            found = await self.item_repository.find_all(session)
+        items = [
+            ItemResponse.model_validate(item, from_attributes=True)
+            for item in found
+        ]
+        entry = CacheEntry.fresh(items, time.monotonic() - started)
+        try:
+            await self.cache.set(
+                cache_key,
+                entry.dumps([item.model_dump(mode='json') for item in items]),
+                expire=cache_ttl()
+            )
+        except Exception as e:
+            logger.error(f'Cache set failed: {e}')
+        return entry
+
+    async def get_item(self, item_id: int) -> ItemResponse:
         """
-        Получить предмет по его ID
+        Получить предмет по его ID.
+        Сначала проверяется локальный кэш процесса, затем Redis.
+        Одновременные промахи загружают предмет из БД один раз,
+        устаревший предмет отдаётся сразу и обновляется в фоне
 
         :param item_id: идентификатор предмета
-        :return: предмет (Item) или None, если не найден
+        :return: предмет (ItemResponse)
+        :raises NotFoundError: если предмет не найден
         """
         cache_key = f'item_{item_id}'
         try:
             if item_id <= 0:
                 raise ValidationError('Item ID must be positive')
-            cached_data = await self.cache.get(cache_key)
-            if cached_data:
-                try:
-                    return json.loads(cached_data)
-                except json.JSONDecodeError:
-                    logger.error('Failed to decode cached data')
-            await self.check_item_exists(item_id)
-            item = await self.item_repository.find_one_or_none_by_id(item_id)
-            try:
-                await self.cache.set(
+            item = self.local_cache.get(cache_key)
+            if item is not None:
+                return item
+            entry = await self._read_cached_item(cache_key)
+            if entry is None:
+                entry = await single_flight.load(
+                    self.cache,
+                    cache_key,
+                    'item',
+                    read_cached=lambda: self._read_cached_item(cache_key),
+                    load=lambda: self._load_item(item_id, cache_key)
+                )
+            elif entry.needs_refresh():
+                single_flight.refresh(
+                    self.cache,
                     cache_key,
-                    json.dumps(jsonable_encoder(item)),
-                    expire=settings.CACHE_EXPIRE
+                    'item',
+                    lambda: self._load_item(item_id, cache_key)
                 )
-            except Exception as e:
-                logger.error(f'Cache set failed: {e}')
-            return item
+            self.local_cache.set(cache_key, entry.value)
+            return entry.value
         except NotFoundError:
             raise
         except ValidationError:
@@ -149,14 +223,77 @@ class ItemService:
             logger.error(f'Unexpected error in service: {e}')
             raise ServiceError('Internal service error') from e
 
+    async def _read_cached_item(self, cache_key: str) -> CacheEntry | None:
+        try:
+            cached_data = await self.cache.get(cache_key)
+        except Exception as e:
+            logger.error(f'Cache get failed: {e}')
+            return None
+        if cached_data:
+            try:
+                payload, delta, expires_at = CacheEntry.loads(cached_data)
+                return CacheEntry(
+                    ItemResponse.from_cache(payload), delta, expires_at
+                )
+            except (ValueError, KeyError, TypeError):
+                logger.error('Failed to decode cached data')
+        return None
+
+    async def _load_item(self, item_id: int, cache_key: str) -> CacheEntry:
+        # Загрузка общая для запросов и может пережить запрос, поэтому
+        # идёт без сессии запроса: item_loader читает в своей единице работы
+        missing_key = f'missing:item_{item_id}'
+        if await negative_cache.is_missing(self.cache, missing_key):
+            raise NotFoundError(f'Item with ID {item_id} not found')
+        started = time.monotonic()
+        found = await self.item_repository.find_one_or_none_by_id(
+            None, item_id
+        )
+        if found is None:
+            await negative_cache.remember(self.cache, missing_key)
+            raise NotFoundError(f'Item with ID {item_id} not found')
+        item = ItemResponse.model_validate(found, from_attributes=True)
+        entry = CacheEntry.fresh(item, time.monotonic() - started)
+        try:
+            await self.cache.set(
+                cache_key,
+                entry.dumps(item.model_dump(mode='json')),
+                expire=cache_ttl()
+            )
+        except Exception as e:
+            logger.error(f'Cache set failed: {e}')
+        return entry
+
+    async def invalidate(self, *keys: str) -> None:
+        """
+        Удалить ключи предметов из Redis и из локальных кэшей
+        всех процессов (через канал LOCAL_CACHE_CHANNEL).
+        Вызывается после изменения данных в БД
+        """
+        self.local_cache.delete(*keys)
+        try:
+            await self.cache.invalidate(settings.LOCAL_CACHE_CHANNEL, *keys)
+        except Exception as e:
+            # Изменение уже в БД: недоступный кэш не должен
+            # превращаться в ошибку запроса. Ключи удалятся повторно,
+            # когда redis станет доступен
+            logger.error(f'Item cache invalidation failed: {e}')
+
     async def check_item_exists(self, item_id: int) -> bool:
         """
             Проверить, что предмет существует по id.
-            Возбуждает NotFoundError если не существует
+            Возбуждает NotFoundError если не существует.
+            Отсутствие предмета запоминается на NEGATIVE_CACHE_TTL
         """
-        item_is_exist = await self.item_repository.check_exists(item_id)
+        missing_key = f'missing:item_{item_id}'
+        if await negative_cache.is_missing(self.cache, missing_key):
+            raise NotFoundError(f'Item with ID {item_id} not found')
+        item_is_exist = await self.item_repository.check_exists(
+            self.session, item_id
+        )
         if item_is_exist:
             return item_is_exist
+        await negative_cache.remember(self.cache, missing_key)
         raise NotFoundError(f'Item with ID {item_id} not found')
 
     @staticmethod
@@ -183,10 +320,18 @@ class ItemService:
                 raise ValidationError('Item ID must be positive')
             await self.check_user_is_admin(user)
             await self.check_item_exists(item_id)
-            await self.cache.delete(cache_key)
-            await self.cache.flush()
-            await self.cache.delete('items_list')
-            await self.item_repository.delete_one_by_id(item_id)
+            versions = await self.item_repository.delete_with_events(
+                self.session, item_id
+            )
+            after_commit(
+                self.session, lambda: self.invalidate(cache_key, 'items_list')
+            )
+            # Инвентари с предметом известны из самого удаления,
+            # помечаем только их, а не сбрасываем весь кэш
+            after_commit(self.session, lambda: mark_stale(self.cache, {
+                f'inventory_{user_id}': version
+                for user_id, version in versions.items()
+            }))
             return Response(status_code=status.HTTP_204_NO_CONTENT)
         except (NotFoundError, NotAdminError):
             raise
@@ -201,6 +346,7 @@ class ItemService:
 
 
 async def get_item_service(
-    cache: RedisCacheBackend = Depends(get_cache)
+    cache: CacheBackend = Depends(get_cache),
+    session: AsyncSession = Depends(get_unit_of_work)
 ) -> ItemService:
-    return ItemService(cache)
+    return ItemService(cache, session)
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from logging.handlers import RotatingFileHandler
+
+from aiokafka import AIOKafkaProducer
+
+from app.config import settings
+from app.inventory.models import OutboxEvent
+from app.repositories.outbox_repo import OutboxRepository
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+handler = RotatingFileHandler(
+    os.path.join(settings.LOG_PATH, 'app.log'),
+    maxBytes=50000,
+    backupCount=1
+)
+logger.addHandler(handler)
+formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+handler.setFormatter(formatter)
+
+
+def create_kafka_producer() -> AIOKafkaProducer:
+    """Продюсер kafka со сжатием и накоплением сообщений в пачки"""
+    return AIOKafkaProducer(
+        bootstrap_servers=settings.KAFKA_SERVER,
+        compression_type=settings.KAFKA_PRODUCER_COMPRESSION,
+        linger_ms=settings.KAFKA_PRODUCER_LINGER_MS,
+        acks='all',
+        enable_idempotence=True
+    )
+
+
+class OutboxRelay:
+    """
+    Фоновая отправка событий из таблицы outbox в kafka.
+    Доставка - at-least-once: событие помечается доставленным только
+    после подтверждения брокера
+    """
+
+    def __init__(self, producer: AIOKafkaProducer):
+        self.producer = producer
+        self.outbox_repository = OutboxRepository()
+        self.batch_size = settings.OUTBOX_BATCH_SIZE
+        self.poll_interval = settings.OUTBOX_POLL_INTERVAL_MS / 1000
+        self.retention = timedelta(hours=settings.OUTBOX_RETENTION_HOURS)
+        self._last_purge = datetime.now(timezone.utc)
+
+    async def run(self):
+        """Цикл отправки событий"""
+        logger.info('Outbox relay started')
+        while True:
+            try:
+                delivered = await self.outbox_repository.deliver_pending(
+                    self.batch_size, self.publish
+                )
+                await self.purge_if_due()
+            except asyncio.CancelledError:
+                logger.info('Outbox relay stopped')
+                raise
+            except Exception as e:
+                logger.error(f'Outbox relay error: {e}')
+                delivered = 0
+            if delivered < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
+
+    async def publish(self, events: list[OutboxEvent]):
+        """
+        Поставить все события пачки в продюсер и дождаться подтверждений.
+        send() только кладёт сообщение в буфер, поэтому пачка уходит
+        несколькими сжатыми запросами к брокеру
+        """
+        futures = [
+            await self.producer.send(
+                topic=event.topic,
+                key=event.key.encode('utf-8') if event.key else None,
+                value=event.payload.encode('utf-8')
+            )
+            for event in events
+        ]
+        await asyncio.gather(*futures)
+
+    async def purge_if_due(self):
+        """Раз в час удаляет доставленные события старше срока хранения"""
+        now = datetime.now(timezone.utc)
+        if now - self._last_purge < timedelta(hours=1):
+            return
+        self._last_purge = now
+        await self.outbox_repository.purge_delivered(now - self.retention)
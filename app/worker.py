@@ -0,0 +1,77 @@
+"""
+Отдельный процесс консьюмера kafka.
+
+Запуск: python -m app.worker
+
+Позволяет масштабировать консьюмеры независимо от API-воркеров.
+В этом случае в API нужно выставить RUN_KAFKA_CONSUMER=false.
+"""
+import asyncio
+import logging
+import os
+import signal
+from logging.handlers import RotatingFileHandler
+
+from prometheus_client import start_http_server
+
+from app.cache import CacheBackend
+from app.config import settings
+from app.database import (check_connection, configure_engine,
+                          prewarm_pool)
+from app.query_cache import query_cache
+from app.replicas import replica_router
+from app.services.inventory_service import KafkaConsumer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+handler = RotatingFileHandler(
+    os.path.join(settings.LOG_PATH, 'worker.log'),
+    maxBytes=50000,
+    backupCount=1
+)
+logger.addHandler(handler)
+formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+handler.setFormatter(formatter)
+
+
+async def run_worker() -> None:
+    """Запускает консьюмер и ждёт SIGTERM/SIGINT для остановки"""
+    configure_engine(
+        pool_size=settings.WORKER_DB_POOL_SIZE,
+        max_overflow=0
+    )
+    if not await check_connection():
+        raise RuntimeError('Database is unavailable')
+    await prewarm_pool()
+    start_http_server(settings.WORKER_METRICS_PORT)
+    logger.info(
+        f'Metrics exposed on port {settings.WORKER_METRICS_PORT}'
+    )
+
+    # Нужен, чтобы снимать отметки об отсутствии созданных инвентарей,
+    # сбрасывать теги кэша запросов и отмечать изменения для реплик
+    cache = CacheBackend(
+        f'redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}'
+    )
+    query_cache.configure(cache)
+    replica_router.configure(cache)
+    consumer = KafkaConsumer(cache)
+    task = asyncio.create_task(consumer.consume_message())
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, task.cancel)
+    logger.info('Worker started')
+    try:
+        await task
+    except asyncio.CancelledError:
+        logger.info('Consumer task cancelled')
+    query_cache.configure(None)
+    replica_router.configure(None)
+    await cache.close()
+    logger.info('Worker stopped')
+
+
+if __name__ == '__main__':
+    asyncio.run(run_worker())
@@ -2,15 +2,16 @@ import asyncio
 import os
 import pytest
 from typing import AsyncGenerator, Generator
-from unittest.mock import AsyncMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 
 from fastapi.testclient import TestClient
 from sqlmodel import SQLModel
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.pool import StaticPool
 
+from app.cache import negative_cache
 from app.main import app
-from app.database import get_session
+from app.database import get_unit_of_work, run_after_commit
 from app.inventory.schemas import UserInfo
 from app.services.item_service import get_item_service, ItemService
 from app.services.inventory_service import InventoryService, get_inventory_service
@@ -49,9 +50,11 @@ TestingSessionLocal = async_sessionmaker(
 )
 
 
-async def override_get_session() -> AsyncGenerator[AsyncSession, None]:
+async def override_get_unit_of_work() -> AsyncGenerator[AsyncSession, None]:
     async with TestingSessionLocal() as session:
-        yield session
+        async with session.begin():
+            yield session
+        await run_after_commit(session)
 
 
 @pytest.fixture(scope="session")
@@ -86,6 +89,14 @@ async def db_session() -> AsyncGenerator[AsyncSession, None]:
         yield session
 
 
+@pytest.fixture
+def request_session():
+    """Фикстура для сессии единицы работы запроса (репозитории мокаются)"""
+    session = MagicMock(spec=AsyncSession)
+    session.info = {}
+    return session
+
+
 @pytest.fixture
 def mock_cache():
     """Фикстура для мок-кэша"""
@@ -94,21 +105,24 @@ def mock_cache():
     mock_cache.set.return_value = None
     mock_cache.delete.return_value = None
     mock_cache.flush.return_value = None
+    mock_cache.get_versioned_many.return_value = [None]
     return mock_cache
 
 
-@pytest.fixture
-def patch_fastapi_cache():
-    with patch('fastapi_cache.caches.set'), patch('fastapi_cache.caches.get'):
-        yield
+@pytest.fixture(autouse=True)
+def clear_negative_cache():
+    """Отметки об отсутствии сущностей не переходят между тестами"""
+    negative_cache.local_cache.clear()
+    yield
+    negative_cache.local_cache.clear()
 
 
 @pytest.fixture
-def client(mock_cache, patch_fastapi_cache) -> Generator:
+def client(mock_cache) -> Generator:
     """Фикстура для тестового клиента"""
     # Мокируем кэш для предотвращения ошибки регистрации
     with patch('app.inventory.common.get_cache', return_value=mock_cache):
-        app.dependency_overrides[get_session] = override_get_session
+        app.dependency_overrides[get_unit_of_work] = override_get_unit_of_work
         with TestClient(app) as test_client:
             yield test_client
         app.dependency_overrides.clear()
@@ -166,25 +180,28 @@ def patch_init_db():
         yield
 
 
+@pytest.fixture(autouse=True)
+def patch_prewarm_pool():
+    """Не открывает соединения пула основной БД в lifespan приложения"""
+    with patch("app.main.prewarm_pool", new=AsyncMock(return_value=0)):
+        yield
+
+
 @pytest.fixture(autouse=True)
 def patch_redis_init():
     """Мокает инициализацию Redis в app.main, чтобы избежать ошибок подключения"""
-    with patch("app.main.RedisCacheBackend") as mock_redis:
+    with patch("app.main.CacheBackend") as mock_redis:
         # Создаём мок для Redis кэша
         mock_redis_instance = AsyncMock()
-        mock_redis_instance.set.return_value = None
-        mock_redis_instance.get.return_value = "ok"
+        mock_redis_instance.ping.return_value = True
         mock_redis.return_value = mock_redis_instance
-        
-        # Мокаем caches.set
-        with patch("app.main.caches.set") as mock_caches_set:
-            yield 
+        yield
 
 
 @pytest.fixture(autouse=True)
 def patch_kafka_producer():
     """Мокает KafkaProducer в app.main, чтобы не было реального подключения к Kafka в тестах"""
-    with patch("app.main.AIOKafkaProducer") as mock_producer:
+    with patch("app.main.create_kafka_producer") as mock_producer:
         mock_instance = AsyncMock()
         mock_instance.start.return_value = None
         mock_instance.stop.return_value = None
@@ -192,6 +209,14 @@ def patch_kafka_producer():
         yield 
 
 
+@pytest.fixture(autouse=True)
+def disable_kafka_consumer():
+    """Не запускает консьюмер kafka и relay outbox в lifespan приложения"""
+    with patch("app.main.settings.RUN_KAFKA_CONSUMER", False), \
+            patch("app.main.settings.RUN_OUTBOX_RELAY", False):
+        yield
+
+
 @pytest.fixture(autouse=True)
 def patch_kafka_consumer():
     with patch("app.services.inventory_service.AIOKafkaConsumer") as mock_consumer:
@@ -199,4 +224,11 @@ def patch_kafka_consumer():
         mock_instance.start.return_value = None
         mock_instance.stop.return_value = None
         mock_consumer.return_value = mock_instance
-        yield 
\ No newline at end of file
+        yield 
+
+@pytest.fixture(autouse=True)
+def patch_local_cache_invalidator():
+    """Не подписывается на канал инвалидации локальных кэшей в тестах"""
+    with patch("app.main.LocalCacheInvalidator") as mock_invalidator:
+        mock_invalidator.return_value.run = AsyncMock()
+        yield
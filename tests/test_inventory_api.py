@@ -8,7 +8,9 @@ from app.inventory.schemas import (
     ItemToInventory, 
     UseItem,
     InventoryItemResponse,
-    SuccessResponse
+    SuccessResponse,
+    GrantResult,
+    GrantStatus
 )
 
 
@@ -114,6 +116,109 @@ class TestInventoryAPI:
         # Assert
         assert response.status_code == status.HTTP_403_FORBIDDEN
 
+    def test_grant_batch_success(self, client, mock_inventory_service, mock_admin_jwt_token):
+        """Тест пакетного начисления предметов"""
+        # Arrange
+        mock_inventory_service.grant_items.return_value = [
+            GrantResult(user_id=1, item_id=1, status=GrantStatus.GRANTED, amount=5),
+            GrantResult(user_id=2, item_id=1, status=GrantStatus.INVENTORY_NOT_FOUND),
+        ]
+
+        # Act
+        response = client.post(
+            "/inventory/grant_batch",
+            json={"grants": [
+                {"user_id": 1, "item_id": 1, "amount": 5},
+                {"user_id": 2, "item_id": 1, "amount": 5},
+            ]},
+            headers={"Authorization": f"Bearer {mock_admin_jwt_token}"}
+        )
+
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        data = response.json()
+        assert data[0]["status"] == "granted"
+        assert data[0]["amount"] == 5
+        assert data[1]["status"] == "inventory_not_found"
+        mock_inventory_service.grant_items.assert_called_once()
+
+    def test_grant_batch_empty(self, client, mock_inventory_service, mock_admin_jwt_token):
+        """Тест пакетного начисления с пустым списком"""
+        # Act
+        response = client.post(
+            "/inventory/grant_batch",
+            json={"grants": []},
+            headers={"Authorization": f"Bearer {mock_admin_jwt_token}"}
+        )
+
+        # Assert
+        assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+        mock_inventory_service.grant_items.assert_not_called()
+
+    def test_get_user_inventories_success(self, client, mock_inventory_service, mock_jwt_token):
+        """Тест пакетного получения инвентарей"""
+        # Arrange
+        mock_inventory_service.get_user_inventories.return_value = [
+            InventoryResponse(user_id=1, linked_items=[]),
+            InventoryResponse(user_id=2, linked_items=[]),
+        ]
+
+        # Act
+        response = client.get(
+            "/inventory/user_inventories?user_ids=1&user_ids=2",
+            headers={"Authorization": f"Bearer {mock_jwt_token}"}
+        )
+
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        assert [inv["user_id"] for inv in response.json()] == [1, 2]
+        mock_inventory_service.get_user_inventories.assert_called_once_with([1, 2])
+
+    def test_get_all_inventory_with_item_page(self, client, mock_inventory_service, mock_jwt_token):
+        """Тест постраничного получения инвентарей с предметом"""
+        # Arrange
+        mock_inventory_service.get_all_with_item.return_value = (
+            [InventoryResponse(user_id=3, linked_items=[])], 42
+        )
+
+        # Act
+        response = client.get(
+            "/inventory/all_inventory_with_item?item_id=1&after=10&limit=1",
+            headers={"Authorization": f"Bearer {mock_jwt_token}"}
+        )
+
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()[0]["user_id"] == 3
+        assert response.headers["X-Next-Cursor"] == "42"
+        mock_inventory_service.get_all_with_item.assert_called_once_with(
+            1, after_inventory_id=10, limit=1
+        )
+
+    def test_get_all_inventory_with_item_stream(self, client, mock_inventory_service, mock_jwt_token):
+        """Тест потоковой выдачи инвентарей с предметом в NDJSON"""
+        # Arrange
+        async def lines():
+            yield '{"user_id": 1, "linked_items": []}\n'
+            yield '{"user_id": 2, "linked_items": []}\n'
+
+        mock_inventory_service.stream_all_with_item.return_value = lines()
+
+        # Act
+        response = client.get(
+            "/inventory/all_inventory_with_item?item_id=1&stream=true",
+            headers={"Authorization": f"Bearer {mock_jwt_token}"}
+        )
+
+        # Assert
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers["content-type"] == "application/x-ndjson"
+        assert response.text.splitlines() == [
+            '{"user_id": 1, "linked_items": []}',
+            '{"user_id": 2, "linked_items": []}',
+        ]
+        mock_inventory_service.get_all_with_item.assert_not_called()
+
     def test_use_item_success(self, client, mock_inventory_service, mock_jwt_token):
         """Тест успешного использования предмета"""
         # Arrange
@@ -0,0 +1,543 @@
+import asyncio
+import json
+
+from unittest.mock import AsyncMock
+
+import pytest
+import pytest_asyncio
+from prometheus_client import REGISTRY
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlmodel import SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.exceptions import NotFoundError, ValidationError
+from app.inventory.models import Inventory, InventoryItem, Item, OutboxEvent
+from app.inventory.schemas import GrantItem, GrantStatus, UseItem, UserInfo
+from app.config import settings
+from app.database import create_engine, prewarm_pool, unit_of_work
+from app.repositories.inventory_repo import InventoryMutation, InventoryRepository
+from app.repositories.item_repo import ItemRepository
+from app.replicas import Replica, replica_router
+from tests.conftest import SQLALCHEMY_DATABASE_URL, engine
+
+# Репозиторий использует CTE с UPDATE ... RETURNING, ON CONFLICT и FOR UPDATE,
+# поэтому тесты идут только на PostgreSQL (make test-container)
+pytestmark = pytest.mark.skipif(
+    not SQLALCHEMY_DATABASE_URL.startswith("postgresql"),
+    reason="Тесты репозитория требуют PostgreSQL"
+)
+
+SessionLocal = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+@pytest.fixture(autouse=True)
+def use_test_engine(monkeypatch):
+    """Репозитории открывают сессии тестового движка"""
+    monkeypatch.setattr("app.database.async_session_maker", SessionLocal)
+
+
+@pytest_asyncio.fixture
+async def seeded():
+    """Предметы 1 и 2, инвентарь пользователя 1 с тремя предметами 1 и пустой инвентарь пользователя 2"""
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.drop_all)
+        await conn.run_sync(SQLModel.metadata.create_all)
+    async with SessionLocal() as session:
+        async with session.begin():
+            session.add_all([Item(id=1, name="a"), Item(id=2, name="b")])
+            session.add_all([Inventory(id=1, user_id=1), Inventory(id=2, user_id=2)])
+        async with session.begin():
+            session.add(InventoryItem(item_id=1, inventory_id=1, amount=3))
+    yield
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.drop_all)
+    await engine.dispose()
+
+
+async def fetch_amount(inventory_id: int, item_id: int) -> int | None:
+    async with SessionLocal() as session:
+        link = await session.get(InventoryItem, (item_id, inventory_id))
+        return link.amount if link else None
+
+
+async def fetch_version(user_id: int) -> int:
+    async with SessionLocal() as session:
+        result = await session.exec(select(Inventory.version).where(Inventory.user_id == user_id))
+        return result.one()
+
+
+async def fetch_events() -> list[OutboxEvent]:
+    async with SessionLocal() as session:
+        result = await session.exec(select(OutboxEvent).order_by(OutboxEvent.id))
+        return list(result.all())
+
+
+class TestUseItemFromInventory:
+    """Тесты условного списания предмета"""
+
+    @pytest.mark.asyncio
+    async def test_use_item_found(self, seeded):
+        """Тест: списание уменьшает количество, версию инвентаря и пишет событие"""
+        # Act
+        async with unit_of_work() as session:
+            amount, version = await InventoryRepository.use_item_from_inventory(
+                session, UseItem(item_id=1, amount=2), UserInfo(user_id=1, role="user")
+            )
+
+        # Assert
+        assert (amount, version) == (1, 1)
+        assert await fetch_amount(1, 1) == 1
+        assert await fetch_version(1) == 1
+        [event] = await fetch_events()
+        assert json.loads(event.payload) == {
+            "user_id": 1, "item_id": 1, "delta": -2, "amount": 1, "version": 1
+        }
+
+    @pytest.mark.asyncio
+    async def test_use_last_item_deletes_row(self, seeded):
+        """Тест: при нулевом остатке строка предмета удаляется"""
+        # Act
+        async with unit_of_work() as session:
+            amount, _ = await InventoryRepository.use_item_from_inventory(
+                session, UseItem(item_id=1, amount=3), UserInfo(user_id=1, role="user")
+            )
+
+        # Assert
+        assert amount == 0
+        assert await fetch_amount(1, 1) is None
+
+    @pytest.mark.asyncio
+    async def test_use_item_insufficient(self, seeded):
+        """Тест: нехватка предметов не меняет количество и версию"""
+        # Act & Assert
+        with pytest.raises(ValidationError, match="Not enough items"):
+            async with unit_of_work() as session:
+                await InventoryRepository.use_item_from_inventory(
+                    session, UseItem(item_id=1, amount=4), UserInfo(user_id=1, role="user")
+                )
+        assert await fetch_amount(1, 1) == 3
+        assert await fetch_version(1) == 0
+        assert await fetch_events() == []
+
+    @pytest.mark.asyncio
+    async def test_use_item_not_in_inventory(self, seeded):
+        """Тест: предмета нет в инвентаре"""
+        # Act & Assert
+        with pytest.raises(NotFoundError, match="not have item 2"):
+            async with unit_of_work() as session:
+                await InventoryRepository.use_item_from_inventory(
+                    session, UseItem(item_id=2, amount=1), UserInfo(user_id=1, role="user")
+                )
+        assert await fetch_version(1) == 0
+
+    @pytest.mark.asyncio
+    async def test_use_item_inventory_not_found(self, seeded):
+        """Тест: инвентаря пользователя нет"""
+        # Act & Assert
+        with pytest.raises(NotFoundError, match="Inventory for user with ID 3"):
+            async with unit_of_work() as session:
+                await InventoryRepository.use_item_from_inventory(
+                    session, UseItem(item_id=1, amount=1), UserInfo(user_id=3, role="user")
+                )
+
+
+class TestAddItem:
+    """Тесты добавления предмета одним upsert"""
+
+    @pytest.mark.asyncio
+    async def test_add_item_increments_existing_row(self, seeded):
+        """Тест: повторное добавление суммирует количество в существующей строке"""
+        # Act
+        async with unit_of_work() as session:
+            amount, version = await InventoryRepository.add_item(session, user_id=1, item_id=1, amount=2)
+
+        # Assert
+        assert (amount, version) == (5, 1)
+        assert await fetch_amount(1, 1) == 5
+        [event] = await fetch_events()
+        assert json.loads(event.payload) == {
+            "user_id": 1, "item_id": 1, "delta": 2, "amount": 5, "version": 1
+        }
+
+    @pytest.mark.asyncio
+    async def test_add_item_inserts_new_row(self, seeded):
+        """Тест: первый предмет в инвентаре создаёт строку"""
+        # Act
+        async with unit_of_work() as session:
+            amount, version = await InventoryRepository.add_item(session, user_id=2, item_id=2, amount=4)
+
+        # Assert
+        assert (amount, version) == (4, 1)
+        assert await fetch_amount(2, 2) == 4
+
+    @pytest.mark.asyncio
+    async def test_add_item_missing_item(self, seeded):
+        """Тест: несуществующий предмет определяется по нарушению внешнего ключа"""
+        # Act & Assert
+        with pytest.raises(NotFoundError, match="Item with ID 99 not found"):
+            async with unit_of_work() as session:
+                await InventoryRepository.add_item(session, user_id=1, item_id=99, amount=1)
+        assert await fetch_version(1) == 0
+        assert await fetch_events() == []
+
+    @pytest.mark.asyncio
+    async def test_add_item_inventory_not_found(self, seeded):
+        """Тест: инвентаря пользователя нет"""
+        # Act & Assert
+        with pytest.raises(NotFoundError, match="Инвентарь пользователя не найден"):
+            async with unit_of_work() as session:
+                await InventoryRepository.add_item(session, user_id=3, item_id=1, amount=1)
+        assert await fetch_events() == []
+
+
+class TestAddItemsBulk:
+    """Тесты пакетного начисления"""
+
+    @pytest.mark.asyncio
+    async def test_bulk_grant_statuses(self, seeded):
+        """Тест: результат по каждому начислению, повторные пары суммируются"""
+        # Act
+        async with unit_of_work() as session:
+            results = await InventoryRepository.add_items_bulk(session, [
+                GrantItem(user_id=1, item_id=1, amount=2),
+                GrantItem(user_id=2, item_id=1, amount=1),
+                GrantItem(user_id=1, item_id=1, amount=1),
+                GrantItem(user_id=1, item_id=99, amount=1),
+                GrantItem(user_id=3, item_id=1, amount=1),
+            ])
+
+        # Assert
+        assert [(r.status, r.amount, r.version) for r in results] == [
+            (GrantStatus.GRANTED, 6, 1),
+            (GrantStatus.GRANTED, 1, 1),
+            (GrantStatus.GRANTED, 6, 1),
+            (GrantStatus.ITEM_NOT_FOUND, None, None),
+            (GrantStatus.INVENTORY_NOT_FOUND, None, None),
+        ]
+        assert await fetch_amount(1, 1) == 6
+        assert await fetch_amount(2, 1) == 1
+        assert [json.loads(e.payload)["delta"] for e in await fetch_events()] == [3, 1]
+
+    @pytest.mark.asyncio
+    async def test_bulk_grant_nothing_granted(self, seeded):
+        """Тест: без существующих предметов версии инвентарей не меняются"""
+        # Act
+        async with unit_of_work() as session:
+            results = await InventoryRepository.add_items_bulk(session, [
+                GrantItem(user_id=1, item_id=99, amount=1),
+            ])
+
+        # Assert
+        assert [r.status for r in results] == [GrantStatus.ITEM_NOT_FOUND]
+        assert await fetch_version(1) == 0
+        assert await fetch_events() == []
+
+    @pytest.mark.asyncio
+    async def test_concurrent_bulk_grants_do_not_deadlock(self, seeded):
+        """Тест: пачки с общими пользователями в разном порядке не блокируют друг друга"""
+        # Arrange
+        forward = [GrantItem(user_id=user_id, item_id=2, amount=1) for user_id in (1, 2)]
+
+        async def grant(grants):
+            async with unit_of_work() as session:
+                return await InventoryRepository.add_items_bulk(session, grants)
+
+        # Act
+        await asyncio.gather(*(grant(forward if i % 2 else forward[::-1]) for i in range(10)))
+
+        # Assert
+        assert await fetch_amount(1, 2) == 10
+        assert await fetch_amount(2, 2) == 10
+        assert await fetch_version(1) == 10
+
+
+class TestDeleteItem:
+    """Тесты удаления предмета вместе с записями в инвентарях"""
+
+    @pytest.mark.asyncio
+    async def test_delete_bumps_versions_and_writes_events(self, seeded):
+        """Тест: удаление предмета списывает остатки и увеличивает версии инвентарей"""
+        # Act
+        async with unit_of_work() as session:
+            versions = await ItemRepository.delete_with_events(session, 1)
+
+        # Assert
+        assert versions == {1: 1}
+        assert await fetch_amount(1, 1) is None
+        assert await fetch_version(2) == 0
+        events = await fetch_events()
+        assert [json.loads(event.payload)["delta"] for event in events] == [-3]
+        async with SessionLocal() as session:
+            assert await session.get(Item, 1) is None
+
+    @pytest.mark.asyncio
+    async def test_concurrent_delete_does_not_deadlock(self, seeded):
+        """Тест: удаление предмета одновременно с начислениями и списаниями не блокирует их по кругу"""
+        # Arrange
+        user = UserInfo(user_id=1, role="user")
+
+        async def run(call):
+            async with unit_of_work() as session:
+                return await call(session)
+
+        calls = [lambda session: ItemRepository.delete_with_events(session, 1)]
+        for _ in range(5):
+            calls.append(lambda session: InventoryRepository.add_item(session, 1, 1, 1))
+            calls.append(lambda session: InventoryRepository.add_item(session, 2, 1, 1))
+            calls.append(lambda session: InventoryRepository.use_item_from_inventory(
+                session, UseItem(item_id=1, amount=1), user
+            ))
+            calls.append(lambda session: InventoryRepository.add_items_bulk(
+                session, [GrantItem(user_id=user_id, item_id=1, amount=1) for user_id in (2, 1)]
+            ))
+
+        # Act
+        results = await asyncio.gather(*(run(call) for call in calls), return_exceptions=True)
+
+        # Assert
+        errors = [r for r in results if isinstance(r, Exception) and not isinstance(r, (NotFoundError, ValidationError))]
+        assert errors == []
+        assert await fetch_amount(1, 1) is None
+        assert await fetch_amount(2, 1) is None
+
+
+class TestItemLoader:
+    """Тесты пакетного поиска предметов"""
+
+    @pytest.mark.asyncio
+    async def test_concurrent_lookups(self, seeded):
+        """Тест: одновременные поиски и проверки предметов получают свои результаты"""
+        # Act
+        async with unit_of_work() as session:
+            found, missing, exists, not_exists = await asyncio.gather(
+                ItemRepository.find_one_or_none_by_id(session, 1),
+                ItemRepository.find_one_or_none_by_id(session, 99),
+                ItemRepository.check_exists(session, 2),
+                ItemRepository.check_exists(session, 99),
+            )
+
+        # Assert
+        assert found.name == "a"
+        assert missing is None
+        assert exists is True
+        assert not_exists is False
+
+    @pytest.mark.asyncio
+    async def test_lookup_sees_own_changes(self, seeded):
+        """Тест: единица работы, создавшая предмет, находит его до коммита"""
+        # Act
+        async with unit_of_work() as session:
+            item = await ItemRepository.add_with_event(session, {"id": 3, "name": "c"}, "topic")
+            found = await ItemRepository.find_one_or_none_by_id(session, item.id)
+            exists = await ItemRepository.check_exists(session, item.id)
+
+        # Assert
+        assert found.name == "c"
+        assert exists is True
+
+    @pytest.mark.asyncio
+    async def test_find_many_by_ids(self, seeded):
+        """Тест: поиск предметов одним запросом по списку id"""
+        # Act
+        async with unit_of_work() as session:
+            items = await ItemRepository.find_many_by_ids(session, [1, 2, 99])
+
+        # Assert
+        assert {item_id: item.name for item_id, item in items.items()} == {1: "a", 2: "b"}
+
+
+class TestGroupCommit:
+    """Тесты групповой записи изменений инвентарей"""
+
+    @pytest.mark.asyncio
+    async def test_apply_mutations_results(self, seeded):
+        """Тест: результат или ошибка по каждому изменению, ошибки не откатывают пачку"""
+        # Act
+        results = await InventoryRepository.apply_mutations([
+            InventoryMutation(user_id=1, item_id=1, amount=2),
+            InventoryMutation(user_id=1, item_id=99, amount=1),
+            InventoryMutation(user_id=1, item_id=1, amount=-10),
+            InventoryMutation(user_id=2, item_id=2, amount=1),
+            InventoryMutation(user_id=1, item_id=1, amount=-1),
+            InventoryMutation(user_id=3, item_id=1, amount=1),
+        ])
+
+        # Assert
+        assert results[0] == (5, 1)
+        assert isinstance(results[1], NotFoundError)
+        assert isinstance(results[2], ValidationError)
+        assert results[3] == (1, 1)
+        # Версия инвентаря увеличивается один раз за пачку
+        assert results[4] == (4, 1)
+        assert isinstance(results[5], NotFoundError)
+        assert await fetch_amount(1, 1) == 4
+        assert [json.loads(e.payload)["delta"] for e in await fetch_events()] == [2, 1, -1]
+
+    @pytest.mark.asyncio
+    async def test_concurrent_requests_with_group_commit(self, seeded, monkeypatch):
+        """Тест: одновременные добавления и списания через групповую запись"""
+        # Arrange
+        monkeypatch.setattr(settings, "GROUP_COMMIT_ENABLED", True)
+        user = UserInfo(user_id=1, role="user")
+
+        # Act
+        async with unit_of_work() as session:
+            results = await asyncio.gather(
+                *(InventoryRepository.add_item(session, user_id=1, item_id=2, amount=1) for _ in range(5)),
+                InventoryRepository.use_item_from_inventory(session, UseItem(item_id=1, amount=1), user),
+                InventoryRepository.use_item_from_inventory(session, UseItem(item_id=2, amount=9), user),
+                return_exceptions=True
+            )
+
+        # Assert
+        assert [amount for amount, _ in results[:5]] == [1, 2, 3, 4, 5]
+        assert results[5][0] == 2
+        assert isinstance(results[6], ValidationError)
+        assert await fetch_amount(1, 2) == 5
+        # Одна версия на каждую пачку, изменившую инвентарь
+        versions = {version for _, version in results[:6]}
+        assert await fetch_version(1) == max(versions) == len(versions)
+
+    @pytest.mark.asyncio
+    async def test_uses_of_one_row_are_combined(self, seeded):
+        """Тест: списания одной строки применяются суммой и удаляют опустевшую строку"""
+        # Act
+        results = await InventoryRepository.apply_mutations([
+            InventoryMutation(user_id=1, item_id=1, amount=-1),
+            InventoryMutation(user_id=1, item_id=1, amount=-2),
+            InventoryMutation(user_id=1, item_id=2, amount=-1),
+            InventoryMutation(user_id=2, item_id=1, amount=-1),
+        ])
+
+        # Assert
+        assert results[:2] == [(2, 1), (0, 1)]
+        assert isinstance(results[2], NotFoundError)
+        assert isinstance(results[3], NotFoundError)
+        assert await fetch_amount(1, 1) is None
+        assert await fetch_version(1) == 1
+        assert await fetch_version(2) == 0
+        assert [json.loads(e.payload)["amount"] for e in await fetch_events()] == [2, 0]
+
+
+class TestUnitOfWork:
+    """Тесты единицы работы: одна транзакция на все вызовы репозиториев"""
+
+    @pytest.mark.asyncio
+    async def test_error_rolls_back_earlier_calls(self, seeded):
+        """Тест: ошибка в середине единицы работы откатывает уже выполненные изменения"""
+        # Act & Assert
+        with pytest.raises(ValidationError, match="Not enough items"):
+            async with unit_of_work() as session:
+                await InventoryRepository.add_item(session, user_id=1, item_id=2, amount=1)
+                await InventoryRepository.use_item_from_inventory(
+                    session, UseItem(item_id=1, amount=9), UserInfo(user_id=1, role="user")
+                )
+        assert await fetch_amount(1, 2) is None
+        assert await fetch_version(1) == 0
+        assert await fetch_events() == []
+
+    @pytest.mark.asyncio
+    async def test_calls_commit_once(self, seeded):
+        """Тест: изменения нескольких вызовов видны после одного коммита с одной версией на вызов"""
+        # Act
+        async with unit_of_work() as session:
+            await InventoryRepository.add_item(session, user_id=1, item_id=2, amount=1)
+            await InventoryRepository.use_item_from_inventory(
+                session, UseItem(item_id=1, amount=1), UserInfo(user_id=1, role="user")
+            )
+            assert await fetch_events() == []
+
+        # Assert
+        assert await fetch_amount(1, 1) == 2
+        assert await fetch_amount(1, 2) == 1
+        assert [json.loads(e.payload)["version"] for e in await fetch_events()] == [1, 2]
+
+
+class TestConnectionPool:
+    """Тесты пула соединений с настройками и метриками"""
+
+    @pytest.mark.asyncio
+    async def test_prewarm_opens_pool_connections(self, monkeypatch):
+        """Тест: прогрев открывает соединения, но не больше размера пула"""
+        # Arrange
+        pool_engine = create_engine(SQLALCHEMY_DATABASE_URL, name="prewarm", pool_size=3, max_overflow=0)
+        monkeypatch.setattr("app.database.engine", pool_engine)
+
+        # Act
+        opened = await prewarm_pool(5)
+
+        # Assert
+        assert opened == 3
+        assert pool_engine.pool.checkedin() == 3
+        assert REGISTRY.get_sample_value("inventory_db_pool_checked_out", {"pool": "prewarm"}) == 0
+        await pool_engine.dispose()
+
+    @pytest.mark.asyncio
+    async def test_pool_timeout_is_counted(self):
+        """Тест: занятость пула и таймаут ожидания соединения попадают в метрики"""
+        # Arrange
+        pool_engine = create_engine(
+            SQLALCHEMY_DATABASE_URL, name="timeout", pool_size=1, max_overflow=0, pool_timeout=0.1
+        )
+        labels = {"pool": "timeout"}
+        timeouts = REGISTRY.get_sample_value("inventory_db_pool_timeouts_total", labels) or 0
+
+        # Act
+        async with pool_engine.connect():
+            checked_out = REGISTRY.get_sample_value("inventory_db_pool_checked_out", labels)
+            with pytest.raises(PoolTimeoutError):
+                await pool_engine.connect()
+
+        # Assert
+        assert checked_out == 1
+        assert REGISTRY.get_sample_value("inventory_db_pool_timeouts_total", labels) == timeouts + 1
+        assert REGISTRY.get_sample_value("inventory_db_pool_wait_seconds_count", labels) == 2
+        await pool_engine.dispose()
+
+
+class TestReplicaRouting:
+    """Тесты чтения с реплик (реплика - та же тестовая БД)"""
+
+    @pytest.fixture
+    def replica(self, monkeypatch):
+        replica = Replica("pgreplica", create_engine(SQLALCHEMY_DATABASE_URL, name="pgreplica"))
+        monkeypatch.setattr(replica_router, "replicas", [replica])
+        backend = AsyncMock()
+        backend.get_many.return_value = [None]
+        replica_router.configure(backend)
+        yield replica
+        replica_router.configure(None)
+
+    @pytest.mark.asyncio
+    async def test_user_inventory_read_on_replica(self, seeded, replica):
+        """Тест: инвентарь читается в сессии реплики"""
+        # Arrange
+        labels = {"pool": "pgreplica", "reason": "replica"}
+        reads = REGISTRY.get_sample_value("inventory_db_reads_total", labels) or 0
+
+        # Act
+        async with unit_of_work() as session:
+            inventory = await InventoryRepository.get_user_inventory(session, 1)
+
+        # Assert
+        assert [(item.item_id, item.amount) for item in inventory.linked_items] == [(1, 3)]
+        assert REGISTRY.get_sample_value("inventory_db_reads_total", labels) == reads + 1
+        await replica.engine.dispose()
+
+    @pytest.mark.asyncio
+    async def test_health_check(self, replica, monkeypatch):
+        """Тест: проверка измеряет отставание и исключает недоступную реплику"""
+        # Arrange
+        down = Replica("pgdown", create_engine("postgresql+asyncpg://postgres@/postgres?host=/nonexistent", name="pgdown"))
+        monkeypatch.setattr(replica_router, "replicas", [replica, down])
+
+        # Act
+        await replica_router.check_health()
+
+        # Assert
+        assert replica.healthy
+        assert REGISTRY.get_sample_value("inventory_db_replica_lag_seconds", {"pool": "pgreplica"}) == 0
+        assert not down.healthy
+        assert replica_router.choose() is replica
+        await replica.engine.dispose()
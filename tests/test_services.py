@@ -1,15 +1,29 @@
+import asyncio
+import json
+import time
+from contextlib import asynccontextmanager
+
 import pytest
-from unittest.mock import AsyncMock, MagicMock
+from unittest.mock import ANY, AsyncMock, MagicMock
 
+from app.cache import LocalCache, single_flight
+from app.codec import cache_serializer
+from app.database import run_after_commit
 from app.services.item_service import ItemService
-from app.services.inventory_service import InventoryService
-from app.inventory.schemas import ItemCreate, ItemToInventory, UseItem, ItemKind
-from app.inventory.models import Item, Inventory
+from app.services.inventory_service import InventoryService, KafkaConsumer
+from app.repositories.outbox_repo import inventory_event
+from app.services.outbox_service import OutboxRelay
+from app.inventory.schemas import (
+    BatchGrant, GrantItem, GrantResult, GrantStatus,
+    ItemCreate, ItemToInventory, UseItem, ItemKind, UserInfo
+)
+from app.inventory.models import Item, Inventory, OutboxEvent
 from app.exceptions import (
     NotFoundError, 
     NotAdminError, 
     InventoryAlreadyExistsError,
-    ItemAlreadyExistsError
+    ItemAlreadyExistsError,
+    ValidationError
 )
 
 
@@ -17,8 +31,8 @@ class TestItemService:
     """Тесты для сервиса предметов"""
 
     @pytest.fixture
-    def item_service(self, db_session, mock_cache):
-        return ItemService(mock_cache)
+    def item_service(self, request_session, mock_cache):
+        return ItemService(mock_cache, request_session, LocalCache(maxsize=16, ttl=60))
 
     @pytest.fixture
     def mock_item(self):
@@ -49,7 +63,6 @@ class TestItemService:
         """Тест успешного получения предмета по ID"""
         # Arrange
         item_service.item_repository.find_one_or_none_by_id = AsyncMock(return_value=mock_item)
-        item_service.item_repository.check_exists = AsyncMock(return_value=True)
 
         # Act
         result = await item_service.get_item(1)
@@ -57,18 +70,172 @@ class TestItemService:
         # Assert
         assert result.id == 1
         assert result.name == "Test Item"
-        item_service.item_repository.find_one_or_none_by_id.assert_called_once_with(1)
+        item_service.item_repository.find_one_or_none_by_id.assert_called_once_with(None, 1)
+
+    @pytest.mark.asyncio
+    async def test_get_item_served_from_local_cache(self, item_service, mock_item):
+        """Тест: повторное чтение предмета не обращается ни к Redis, ни к БД"""
+        # Arrange
+        item_service.item_repository.find_one_or_none_by_id = AsyncMock(return_value=mock_item)
+
+        # Act
+        first = await item_service.get_item(1)
+        redis_reads = item_service.cache.get.call_count
+        second = await item_service.get_item(1)
+
+        # Assert
+        assert second is first
+        assert item_service.cache.get.call_count == redis_reads
+        item_service.item_repository.find_one_or_none_by_id.assert_called_once_with(ANY, 1)
+
+    @pytest.mark.asyncio
+    async def test_stale_item_served_and_refreshed_in_background(self, item_service, mock_item):
+        """Тест: устаревший предмет отдаётся сразу, а обновляется в фоне"""
+        # Arrange
+        stale = cache_serializer.dumps({"value": {
+            "id": 1, "name": "Old Name", "kind": ItemKind.CONSUMABLE.value,
+            "shop_item_id": None, "use_limit": 1, "cooldown": 0
+        }, "delta": 0.01, "expires_at": time.time() - 1})
+        item_service.cache.get.side_effect = lambda key: stale if key == "item_1" else None
+        item_service.item_repository.find_one_or_none_by_id = AsyncMock(return_value=mock_item)
+
+        # Act
+        result = await item_service.get_item(1)
+        await asyncio.gather(*single_flight._refreshing.values())
+
+        # Assert
+        assert result.name == "Old Name"
+        item_service.item_repository.find_one_or_none_by_id.assert_called_once_with(ANY, 1)
+        stored = cache_serializer.loads(item_service.cache.set.call_args.args[1])
+        assert stored["value"]["name"] == "Test Item"
+        assert stored["expires_at"] > time.time()
+
+    @pytest.mark.asyncio
+    async def test_item_in_old_format_is_reloaded(self, item_service, mock_item):
+        """Тест: запись в прежнем формате (JSON) считается промахом"""
+        # Arrange
+        item_service.cache.get.side_effect = lambda key: json.dumps({"value": {
+            "id": 1, "name": "Old Name", "kind": ItemKind.CONSUMABLE.value,
+            "shop_item_id": None, "use_limit": 1, "cooldown": 0
+        }, "delta": 0.01, "expires_at": time.time() + 60}) if key == "item_1" else None
+        item_service.item_repository.find_one_or_none_by_id = AsyncMock(return_value=mock_item)
+
+        # Act
+        result = await item_service.get_item(1)
+
+        # Assert
+        assert result.name == "Test Item"
+        item_service.item_repository.find_one_or_none_by_id.assert_called_once_with(ANY, 1)
+
+    @pytest.mark.asyncio
+    async def test_concurrent_misses_load_item_once(self, item_service, mock_item):
+        """Тест: одновременные промахи по одному ключу загружают предмет из БД один раз"""
+        # Arrange
+        async def slow_find(session, item_id):
+            await asyncio.sleep(0.01)
+            return mock_item
+
+        item_service.item_repository.find_one_or_none_by_id = AsyncMock(side_effect=slow_find)
+        readers = [
+            ItemService(item_service.cache, item_service.session, LocalCache(maxsize=16, ttl=60))
+            for _ in range(5)
+        ]
+        for reader in readers:
+            reader.item_repository = item_service.item_repository
+
+        # Act
+        results = await asyncio.gather(*(reader.get_item(1) for reader in readers))
+
+        # Assert
+        assert {result.id for result in results} == {1}
+        item_service.item_repository.find_one_or_none_by_id.assert_called_once_with(ANY, 1)
+        item_service.cache.acquire_lock.assert_called_once()
+        item_service.cache.release_lock.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_item_miss_waits_for_other_process(self, item_service, mock_item, monkeypatch):
+        """Тест: без блокировки промах дожидается значения, загруженного другим процессом"""
+        # Arrange
+        monkeypatch.setattr("app.cache.settings.CACHE_LOCK_POLL_MS", 1)
+        item_service.cache.acquire_lock.return_value = False
+        values = [None, None, cache_serializer.dumps({"value": {
+            "id": 1, "name": "Test Item", "kind": ItemKind.CONSUMABLE.value,
+            "shop_item_id": None, "use_limit": 1, "cooldown": 0
+        }, "delta": 0.01, "expires_at": time.time() + 60})]
+        item_service.cache.get.side_effect = lambda key: (
+            b"token" if key == "lock:item_1" else values.pop(0)
+        )
+        item_service.item_repository.find_one_or_none_by_id = AsyncMock()
+
+        # Act
+        result = await item_service.get_item(1)
+
+        # Assert
+        assert result.name == "Test Item"
+        item_service.item_repository.find_one_or_none_by_id.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_item_miss_stops_waiting_when_lock_released(self, item_service, monkeypatch):
+        """Тест: снятая без значения блокировка не ждётся до таймаута, отметка missing:* учитывается"""
+        # Arrange
+        monkeypatch.setattr("app.cache.settings.CACHE_LOCK_POLL_MS", 1)
+        monkeypatch.setattr("app.cache.settings.CACHE_LOCK_WAIT_MS", 60000)
+        item_service.cache.acquire_lock.return_value = False
+        item_service.cache.get.side_effect = lambda key: (
+            b"1" if key == "missing:item_1" else None
+        )
+        item_service.item_repository.find_one_or_none_by_id = AsyncMock()
+
+        # Act & Assert
+        with pytest.raises(NotFoundError):
+            await asyncio.wait_for(item_service.get_item(1), timeout=1)
+        item_service.item_repository.find_one_or_none_by_id.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_get_item_decodes_redis_value(self, item_service):
+        """Тест: значение из Redis декодируется в ItemResponse"""
+        # Arrange
+        item_service.cache.get.return_value = cache_serializer.dumps({"value": {
+            "id": 1, "name": "Test Item", "kind": ItemKind.CONSUMABLE.value,
+            "shop_item_id": None, "use_limit": 1, "cooldown": 0
+        }, "delta": 0.01, "expires_at": time.time() + 60})
+        item_service.item_repository.find_one_or_none_by_id = AsyncMock()
+
+        # Act
+        result = await item_service.get_item(1)
+
+        # Assert
+        assert result.name == "Test Item"
+        assert item_service.local_cache.get("item_1") is result
+        item_service.item_repository.find_one_or_none_by_id.assert_not_called()
 
     @pytest.mark.asyncio
     async def test_get_item_not_found(self, item_service):
         """Тест получения несуществующего предмета"""
         # Arrange
-        item_service.item_repository.check_exists = AsyncMock(return_value=False)
+        item_service.item_repository.find_one_or_none_by_id = AsyncMock(return_value=None)
 
         # Act & Assert
         with pytest.raises(NotFoundError, match="Item with ID 999 not found"):
             await item_service.get_item(999)
 
+    @pytest.mark.asyncio
+    async def test_missing_item_remembered(self, item_service):
+        """Тест: повторный запрос несуществующего предмета не доходит до БД"""
+        # Arrange
+        item_service.item_repository.find_one_or_none_by_id = AsyncMock(return_value=None)
+        item_service.item_repository.check_exists = AsyncMock()
+
+        # Act
+        for _ in range(3):
+            with pytest.raises(NotFoundError, match="Item with ID 999 not found"):
+                await item_service.get_item(999)
+
+        # Assert
+        item_service.item_repository.find_one_or_none_by_id.assert_called_once_with(None, 999)
+        item_service.item_repository.check_exists.assert_not_called()
+        item_service.cache.set_if_absent.assert_called_once_with("missing:item_999", b"1", expire=30)
+
     @pytest.mark.asyncio
     async def test_create_item_success(self, item_service, mock_admin):
         """Тест успешного создания предмета"""
@@ -86,19 +253,39 @@ class TestItemService:
             description="New description",
             kind=ItemKind.CONSUMABLE
         )
-        item_service.item_repository.add = AsyncMock(return_value=new_item)
+        item_service.item_repository.add_with_event = AsyncMock(return_value=new_item)
         item_service.item_repository.check_name_exists = AsyncMock(return_value=False)
-        mock_request = MagicMock()
-        mock_request.app = MagicMock()
-        mock_request.app.state = MagicMock()
-        mock_request.app.state.kafkaproducer = AsyncMock()
 
         # Act
-        result = await item_service.create_item(item_data, mock_admin, mock_request)
+        result = await item_service.create_item(item_data, mock_admin)
+        await run_after_commit(item_service.session)
 
         # Assert
         assert result.name == "New Item"
-        item_service.item_repository.add.assert_called_once()
+        item_service.item_repository.add_with_event.assert_called_once_with(
+            item_service.session, item_data.model_dump(), "shop.inventory.updates"
+        )
+        item_service.cache.set_and_publish.assert_called_once_with(
+            "cache:local:invalidate", {"missing:item_1": b"0"}, expire=30
+        )
+
+    @pytest.mark.asyncio
+    async def test_create_item_survives_unavailable_cache(self, item_service, mock_admin, mock_item):
+        """Тест: предмет создан, даже если кэш недоступен после коммита"""
+        # Arrange
+        from app.exceptions import CacheUnavailableError
+        item_data = ItemCreate(name="Test Item", use_limit=1, cooldown=0)
+        item_service.item_repository.check_name_exists = AsyncMock(return_value=False)
+        item_service.item_repository.add_with_event = AsyncMock(return_value=mock_item)
+        item_service.cache.invalidate.side_effect = CacheUnavailableError("open")
+        item_service.cache.set_and_publish.side_effect = CacheUnavailableError("open")
+
+        # Act
+        result = await item_service.create_item(item_data, mock_admin)
+        await run_after_commit(item_service.session)
+
+        # Assert
+        assert result is mock_item
 
     @pytest.mark.asyncio
     async def test_create_item_not_admin(self, item_service, mock_user):
@@ -111,14 +298,10 @@ class TestItemService:
             use_limit=10,
             cooldown=0
         )
-        mock_request = MagicMock()
-        mock_request.app = MagicMock()
-        mock_request.app.state = MagicMock()
-        mock_request.app.state.kafkaproducer = AsyncMock()
 
         # Act & Assert
         with pytest.raises(NotAdminError, match="Only admin allowed"):
-            await item_service.create_item(item_data, mock_user, mock_request)
+            await item_service.create_item(item_data, mock_user)
 
     @pytest.mark.asyncio
     async def test_create_item_already_exists(self, item_service, mock_admin):
@@ -132,28 +315,66 @@ class TestItemService:
             cooldown=0
         )
         item_service.item_repository.check_name_exists = AsyncMock(return_value=True)
-        mock_request = MagicMock()
-        mock_request.app = MagicMock()
-        mock_request.app.state = MagicMock()
-        mock_request.app.state.kafkaproducer = AsyncMock()
 
         # Act & Assert
         with pytest.raises(ItemAlreadyExistsError, match="Item already exists"):
-            await item_service.create_item(item_data, mock_admin, mock_request)
+            await item_service.create_item(item_data, mock_admin)
 
     @pytest.mark.asyncio
     async def test_delete_item_success(self, item_service, mock_admin):
         """Тест успешного удаления предмета"""
         # Arrange
         item_service.item_repository.check_exists = AsyncMock(return_value=True)
-        item_service.item_repository.delete_one_by_id = AsyncMock(return_value=None)
+        item_service.item_repository.delete_with_events = AsyncMock(return_value={1: 3, 2: 5})
+
+        # Act
+        result = await item_service.delete_item(1, mock_admin)
+        await run_after_commit(item_service.session)
+
+        # Assert
+        assert result.status_code == 204
+        item_service.item_repository.delete_with_events.assert_called_once_with(item_service.session, 1)
+        item_service.cache.mark_stale_many.assert_called_once_with(
+            {"inventory_1": 3, "inventory_2": 5}, expire=4200
+        )
+        item_service.cache.delete_many.assert_not_called()
+        item_service.cache.flush.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_delete_item_deletes_inventories_when_marking_fails(self, item_service, mock_admin):
+        """Тест: если метки версий не записались, закэшированные инвентари удаляются"""
+        # Arrange
+        from app.exceptions import CacheUnavailableError
+        item_service.item_repository.check_exists = AsyncMock(return_value=True)
+        item_service.item_repository.delete_with_events = AsyncMock(return_value={1: 3})
+        item_service.cache.mark_stale_many.side_effect = CacheUnavailableError("down")
 
         # Act
         result = await item_service.delete_item(1, mock_admin)
+        await run_after_commit(item_service.session)
 
         # Assert
         assert result.status_code == 204
-        item_service.item_repository.delete_one_by_id.assert_called_once_with(1)
+        item_service.cache.delete_many.assert_called_once_with("inventory_1")
+
+    @pytest.mark.asyncio
+    async def test_delete_item_invalidates_local_caches(self, item_service, mock_admin):
+        """Тест: удаление предмета чистит локальный кэш и оповещает остальные процессы"""
+        # Arrange
+        item_service.local_cache.set("item_1", object())
+        item_service.local_cache.set("items_list", [])
+        item_service.item_repository.check_exists = AsyncMock(return_value=True)
+        item_service.item_repository.delete_with_events = AsyncMock(return_value={})
+
+        # Act
+        await item_service.delete_item(1, mock_admin)
+        await run_after_commit(item_service.session)
+
+        # Assert
+        assert len(item_service.local_cache) == 0
+        item_service.cache.invalidate.assert_called_once_with(
+            "cache:local:invalidate", "item_1", "items_list"
+        )
 
     @pytest.mark.asyncio
     async def test_delete_item_not_admin(self, item_service, mock_user):
@@ -177,8 +398,8 @@ class TestInventoryService:
     """Тесты для сервиса инвентаря"""
 
     @pytest.fixture
-    def inventory_service(self, db_session, mock_cache, mock_item_service):
-        service = InventoryService(mock_item_service, mock_cache)
+    def inventory_service(self, request_session, mock_cache, mock_item_service):
+        service = InventoryService(mock_item_service, mock_cache, request_session)
         # Мокаем все методы репозитория
         service.inventory_repository.check_exists = AsyncMock(return_value=True)
         service.inventory_repository.add_for_current_user = AsyncMock()
@@ -201,10 +422,30 @@ class TestInventoryService:
 
         # Act
         result = await inventory_service.create_inventory(mock_user)
+        await run_after_commit(inventory_service.session)
 
         # Assert
         assert result.id == 1
-        inventory_service.inventory_repository.add_for_current_user.assert_called_once_with(mock_user)
+        inventory_service.inventory_repository.add_for_current_user.assert_called_once_with(
+            inventory_service.session, mock_user
+        )
+        inventory_service.cache.set_and_publish.assert_called_once_with(
+            "cache:local:invalidate", {"missing:inventory_1": b"0"}, expire=30
+        )
+
+    @pytest.mark.asyncio
+    async def test_missing_inventory_remembered(self, inventory_service, mock_user):
+        """Тест: повторный запрос несуществующего инвентаря не доходит до БД"""
+        # Arrange
+        inventory_service.inventory_repository.check_exists = AsyncMock(return_value=False)
+
+        # Act
+        for _ in range(2):
+            with pytest.raises(NotFoundError, match="Inventory for user with ID 1 not found"):
+                await inventory_service.get_user_inventory(mock_user)
+
+        # Assert
+        inventory_service.inventory_repository.check_exists.assert_called_once_with(ANY, 1)
 
     @pytest.mark.asyncio
     async def test_create_inventory_already_exists(self, inventory_service, mock_user):
@@ -225,7 +466,7 @@ class TestInventoryService:
         
         inventory_service.item_service.get_item = AsyncMock(return_value=mock_item)
         inventory_service.inventory_repository.check_exists = AsyncMock(return_value=True)
-        inventory_service.inventory_repository.add_item = AsyncMock(return_value=None)
+        inventory_service.inventory_repository.add_item = AsyncMock(return_value=(5, 1))
 
         # Act
         result = await inventory_service.add_to_inventory(item_data, mock_admin)
@@ -233,6 +474,115 @@ class TestInventoryService:
         # Assert
         inventory_service.inventory_repository.add_item.assert_called_once()
 
+    @pytest.mark.asyncio
+    async def test_add_to_inventory_single_upsert(self, inventory_service, mock_admin):
+        """Тест, что добавление выполняется одним upsert без предварительных чтений"""
+        # Arrange
+        item_data = ItemToInventory(item_id=1, amount=5)
+        inventory_service.inventory_repository.add_item = AsyncMock(return_value=(7, 3))
+
+        # Act
+        result = await inventory_service.add_to_inventory(item_data, mock_admin)
+
+        # Assert
+        assert result == 7
+        inventory_service.inventory_repository.check_exists.assert_not_called()
+        inventory_service.inventory_repository.add_item.assert_called_once_with(
+            inventory_service.session, user_id=1, item_id=1, amount=5
+        )
+
+    @pytest.mark.asyncio
+    async def test_add_to_inventory_writes_through_cache(self, inventory_service, mock_admin):
+        """Тест: новое количество записывается в кэш инвентаря с версией вместо удаления ключа"""
+        # Arrange
+        from app.inventory.schemas import ItemResponse
+        item_data = ItemToInventory(item_id=1, amount=5)
+        inventory_service.item_service.get_item = AsyncMock(return_value=ItemResponse(
+            id=1, name="Test Item", kind=ItemKind.CONSUMABLE, shop_item_id=None,
+            use_limit=1, cooldown=0, script="x"
+        ))
+        inventory_service.inventory_repository.add_item = AsyncMock(return_value=(7, 3))
+
+        # Act
+        await inventory_service.add_to_inventory(item_data, mock_admin)
+        await run_after_commit(inventory_service.session)
+
+        # Assert
+        key, version, fields, deleted = inventory_service.cache.patch_versioned.call_args.args
+        assert (key, version, deleted) == ("inventory_1", 3, ())
+        assert cache_serializer.loads(fields["item:1"])["amount"] == 7
+        inventory_service.cache.delete.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_write_through_item_without_script(self, inventory_service, mock_admin):
+        """Тест: предмет без скрипта записывается в кэш инвентаря, а не сбрасывает ключ"""
+        # Arrange
+        from app.inventory.schemas import ItemResponse
+        inventory_service.item_service.get_item = AsyncMock(return_value=ItemResponse(
+            id=1, name="Test Item", kind=ItemKind.CONSUMABLE, shop_item_id=None,
+            use_limit=1, cooldown=0, script=None
+        ))
+        inventory_service.inventory_repository.add_item = AsyncMock(return_value=(7, 3))
+
+        # Act
+        await inventory_service.add_to_inventory(ItemToInventory(item_id=1, amount=5), mock_admin)
+        await run_after_commit(inventory_service.session)
+
+        # Assert
+        _, _, fields, _ = inventory_service.cache.patch_versioned.call_args.args
+        assert cache_serializer.loads(fields["item:1"])["script"] is None
+        inventory_service.cache.delete.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_add_to_inventory_missing_item(self, inventory_service, mock_admin):
+        """Тест добавления несуществующего предмета"""
+        # Arrange
+        item_data = ItemToInventory(item_id=999, amount=5)
+        inventory_service.inventory_repository.add_item = AsyncMock(
+            side_effect=NotFoundError("Item with ID 999 not found")
+        )
+
+        # Act & Assert
+        with pytest.raises(NotFoundError, match="Item with ID 999 not found"):
+            await inventory_service.add_to_inventory(item_data, mock_admin)
+        inventory_service.cache.delete.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_grant_items_invalidates_affected_inventories(self, inventory_service, mock_admin):
+        """Тест пакетного начисления: сбрасывается кэш только затронутых инвентарей"""
+        # Arrange
+        batch = BatchGrant(grants=[
+            GrantItem(user_id=1, item_id=1, amount=5),
+            GrantItem(user_id=2, item_id=1, amount=5),
+        ])
+        inventory_service.inventory_repository.add_items_bulk = AsyncMock(return_value=[
+            GrantResult(user_id=1, item_id=1, status=GrantStatus.GRANTED, amount=5, version=4),
+            GrantResult(user_id=2, item_id=1, status=GrantStatus.INVENTORY_NOT_FOUND),
+        ])
+
+        # Act
+        result = await inventory_service.grant_items(batch, mock_admin)
+        await run_after_commit(inventory_service.session)
+
+        # Assert
+        assert [r.status for r in result] == [GrantStatus.GRANTED, GrantStatus.INVENTORY_NOT_FOUND]
+        inventory_service.cache.mark_stale_many.assert_called_once_with(
+            {"inventory_1": 4}, expire=4200
+        )
+        inventory_service.cache.delete_many.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_grant_items_not_admin(self, inventory_service, mock_user):
+        """Тест пакетного начисления не администратором"""
+        # Arrange
+        batch = BatchGrant(grants=[GrantItem(user_id=1, item_id=1, amount=5)])
+        inventory_service.inventory_repository.add_items_bulk = AsyncMock()
+
+        # Act & Assert
+        with pytest.raises(NotAdminError, match="Only admin allowed"):
+            await inventory_service.grant_items(batch, mock_user)
+        inventory_service.inventory_repository.add_items_bulk.assert_not_called()
+
     @pytest.mark.asyncio
     async def test_add_to_inventory_not_admin(self, inventory_service, mock_user):
         """Тест добавления предмета не администратором"""
@@ -281,7 +631,7 @@ class TestInventoryService:
             ]
         )
         inventory_service.get_user_inventory = AsyncMock(return_value=mock_inventory_response)
-        inventory_service.inventory_repository.use_item_from_inventory = AsyncMock(return_value=None)
+        inventory_service.inventory_repository.use_item_from_inventory = AsyncMock(return_value=(4, 2))
 
         # Act
         result = await inventory_service.use_item_from_inventory(item_data, mock_user)
@@ -295,19 +645,67 @@ class TestInventoryService:
         """Тест использования предмета из несуществующего инвентаря"""
         # Arrange
         item_data = UseItem(item_id=1, user_id=1, amount=1)
-        inventory_service.inventory_repository.check_exists = AsyncMock(return_value=False)
+        inventory_service.inventory_repository.use_item_from_inventory = AsyncMock(
+            side_effect=NotFoundError("Inventory for user with ID 1 not found")
+        )
 
         # Act & Assert
         with pytest.raises(NotFoundError, match="Inventory for user with ID 1 not found"):
             await inventory_service.use_item_from_inventory(item_data, mock_user)
+        inventory_service.cache.delete.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_use_item_not_enough(self, inventory_service, mock_user):
+        """Тест использования большего количества предметов, чем есть"""
+        # Arrange
+        item_data = UseItem(item_id=1, amount=10)
+        inventory_service.inventory_repository.use_item_from_inventory = AsyncMock(
+            side_effect=ValidationError("Not enough items")
+        )
+
+        # Act & Assert
+        with pytest.raises(ValidationError, match="Not enough items"):
+            await inventory_service.use_item_from_inventory(item_data, mock_user)
+
+    @pytest.mark.asyncio
+    async def test_use_item_single_repository_call(self, inventory_service, mock_user):
+        """Тест, что списание не делает предварительных проверок"""
+        # Arrange
+        item_data = UseItem(item_id=1, amount=1)
+        inventory_service.inventory_repository.use_item_from_inventory = AsyncMock(return_value=(4, 2))
+        inventory_service.get_user_inventory = AsyncMock()
+
+        # Act
+        await inventory_service.use_item_from_inventory(item_data, mock_user)
+
+        # Assert
+        inventory_service.inventory_repository.check_exists.assert_not_called()
+        inventory_service.get_user_inventory.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_use_last_item_removes_it_from_cache(self, inventory_service, mock_user):
+        """Тест: при нулевом остатке предмет удаляется из кэша инвентаря"""
+        # Arrange
+        item_data = UseItem(item_id=1, amount=1)
+        inventory_service.inventory_repository.use_item_from_inventory = AsyncMock(return_value=(0, 5))
+
+        # Act
+        await inventory_service.use_item_from_inventory(item_data, mock_user)
+        await run_after_commit(inventory_service.session)
+
+        # Assert
+        inventory_service.cache.patch_versioned.assert_called_once_with(
+            "inventory_1", 5, {}, ("item:1",), expire=4200
+        )
 
     @pytest.mark.asyncio
     async def test_get_user_inventory_success(self, inventory_service, mock_user):
         """Тест успешного получения инвентаря пользователя"""
         # Arrange
-        from app.inventory.schemas import InventoryResponse, InventoryItemResponse
-        mock_inventory_response = InventoryResponse(
+        from app.inventory.schemas import VersionedInventory, InventoryItemResponse
+        mock_inventory_response = VersionedInventory(
             user_id=1,
+            version=4,
             linked_items=[
                 InventoryItemResponse(
                     item_id=1,
@@ -330,7 +728,92 @@ class TestInventoryService:
         # Assert
         assert result.user_id == 1
         assert len(result.linked_items) == 1
-        inventory_service.inventory_repository.get_user_inventory.assert_called_once_with(mock_user.user_id)
+        inventory_service.inventory_repository.get_user_inventory.assert_called_once_with(ANY, mock_user.user_id)
+        [(version, fields)] = inventory_service.cache.set_versioned_many.call_args.args[0].values()
+        assert version == 4
+        assert list(fields) == ["item:1", "delta", "expires_at"]
+
+    @pytest.mark.asyncio
+    async def test_write_through_survives_unavailable_cache(self, inventory_service, mock_admin):
+        """Тест: недоступный кэш не ломает изменение инвентаря"""
+        # Arrange
+        from app.exceptions import CacheUnavailableError
+        inventory_service.inventory_repository.add_item = AsyncMock(return_value=(0, 2))
+        inventory_service.cache.patch_versioned.side_effect = CacheUnavailableError("open")
+        inventory_service.cache.mark_stale_many.side_effect = CacheUnavailableError("open")
+        inventory_service.cache.delete_many.side_effect = CacheUnavailableError("open")
+
+        # Act
+        result = await inventory_service.add_to_inventory(
+            ItemToInventory(item_id=1, amount=1), mock_admin
+        )
+        await run_after_commit(inventory_service.session)
+
+        # Assert
+        assert result == 0
+        inventory_service.cache.delete_many.assert_called_once_with("inventory_1")
+
+    @pytest.mark.asyncio
+    async def test_failed_write_through_marks_version_stale(self, inventory_service, mock_admin):
+        """Тест: при ошибке патча запись помечается версией изменения, а не удаляется"""
+        # Arrange
+        inventory_service.inventory_repository.add_item = AsyncMock(return_value=(1, 2))
+        inventory_service.cache.patch_versioned.side_effect = ValueError("bad entry")
+
+        # Act
+        await inventory_service.add_to_inventory(ItemToInventory(item_id=1, amount=1), mock_admin)
+        await run_after_commit(inventory_service.session)
+
+        # Assert
+        inventory_service.cache.mark_stale_many.assert_called_once_with({"inventory_1": 2}, expire=ANY)
+        inventory_service.cache.delete.assert_not_called()
+        inventory_service.cache.delete_many.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_get_user_inventory_from_cache(self, inventory_service, mock_user):
+        """Тест чтения инвентаря из версионированной записи кэша"""
+        # Arrange
+        inventory_service.cache.get_versioned_many.return_value = [{
+            "version": "3",
+            "item:2": cache_serializer.dumps({"item_id": 2, "name": "b", "use_limit": 1, "cooldown": 0, "amount": 1, "script": ""}),
+            "item:1": cache_serializer.dumps({"item_id": 1, "name": "a", "use_limit": 1, "cooldown": 0, "amount": 4, "script": ""}),
+        }]
+        inventory_service.inventory_repository.get_user_inventory = AsyncMock()
+
+        # Act
+        result = await inventory_service.get_user_inventory(mock_user)
+
+        # Assert
+        assert [(item.item_id, item.amount) for item in result.linked_items] == [(1, 4), (2, 1)]
+        inventory_service.inventory_repository.get_user_inventory.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_get_user_inventories_mixes_cache_and_db(self, inventory_service):
+        """Тест пакетного чтения: попадания из кэша, промахи одним запросом к БД"""
+        # Arrange
+        from app.inventory.schemas import VersionedInventory
+        inventory_service.cache.get_versioned_many = AsyncMock(
+            return_value=[{"version": "1"}, None, None]
+        )
+        inventory_service.inventory_repository.get_user_inventories = AsyncMock(
+            return_value=[VersionedInventory(user_id=2, version=7)]
+        )
+
+        # Act
+        result = await inventory_service.get_user_inventories([1, 2, 3, 2])
+
+        # Assert
+        assert [inventory.user_id for inventory in result] == [1, 2]
+        inventory_service.cache.get_versioned_many.assert_called_once_with(
+            "inventory_1", "inventory_2", "inventory_3"
+        )
+        inventory_service.inventory_repository.get_user_inventories.assert_called_once_with(
+            inventory_service.session, [2, 3]
+        )
+        inventory_service.cache.set_versioned_many.assert_called_once()
+        [(version, fields)] = inventory_service.cache.set_versioned_many.call_args.args[0].values()
+        assert version == 7
+        assert fields.keys() == {"delta", "expires_at"}
 
     @pytest.mark.asyncio
     async def test_get_user_inventory_not_found(self, inventory_service, mock_user):
@@ -340,4 +823,951 @@ class TestInventoryService:
 
         # Act & Assert
         with pytest.raises(NotFoundError, match="Inventory for user with ID 1 not found"):
-            await inventory_service.get_user_inventory(mock_user) 
\ No newline at end of file
+            await inventory_service.get_user_inventory(mock_user) 
+
+    @pytest.mark.asyncio
+    async def test_stream_all_with_item_yields_ndjson(self, inventory_service):
+        """Тест потоковой выдачи инвентарей с предметом построчно в NDJSON"""
+        # Arrange
+        from app.inventory.schemas import InventoryResponse
+
+        async def inventories(item_id):
+            for user_id in (1, 2):
+                yield InventoryResponse(user_id=user_id, linked_items=[])
+
+        inventory_service.inventory_repository.stream_inventories_with_item = inventories
+
+        # Act
+        stream = await inventory_service.stream_all_with_item(1)
+        lines = [line async for line in stream]
+
+        # Assert
+        inventory_service.item_service.check_item_exists.assert_called_once_with(1)
+        assert [json.loads(line)["user_id"] for line in lines] == [1, 2]
+        assert all(line.endswith("\n") for line in lines)
+
+    @pytest.mark.asyncio
+    async def test_stream_all_with_item_not_found(self, inventory_service):
+        """Тест: отсутствие предмета обнаруживается до начала потока"""
+        # Arrange
+        inventory_service.item_service.check_item_exists.side_effect = NotFoundError(
+            "Item with ID 1 not found"
+        )
+
+        # Act & Assert
+        with pytest.raises(NotFoundError, match="Item with ID 1 not found"):
+            await inventory_service.stream_all_with_item(1)
+
+class TestKafkaConsumer:
+    """Тесты для пакетного консьюмера новых пользователей"""
+
+    @pytest.fixture
+    def consumer(self):
+        consumer = KafkaConsumer()
+        consumer.inventory_repository.add_for_users = AsyncMock(return_value=2)
+        return consumer
+
+    @staticmethod
+    def make_message(value: bytes):
+        message = MagicMock()
+        message.value = value
+        return message
+
+    @pytest.mark.asyncio
+    async def test_process_batch_creates_inventories_in_one_call(self, consumer):
+        """Тест создания инвентарей одной пачкой с пропуском битых сообщений"""
+        # Arrange
+        messages = [
+            self.make_message(b'{"user_id": 1, "role": "user"}'),
+            self.make_message(b'not json'),
+            self.make_message(b'{"role": "user"}'),
+            self.make_message(b'{"user_id": 2, "role": "user"}'),
+        ]
+
+        # Act
+        result = await consumer.process_batch(messages)
+
+        # Assert
+        assert result == 2
+        consumer.inventory_repository.add_for_users.assert_called_once_with(ANY, [1, 2])
+
+    @pytest.mark.asyncio
+    async def test_process_batch_skips_invalid_user_ids(self, consumer):
+        """Тест: сообщения с user_id не положительным целым пропускаются"""
+        # Arrange
+        messages = [
+            self.make_message(b'{"user_id": "x"}'),
+            self.make_message(b'{"user_id": -1}'),
+            self.make_message(b'{"user_id": true}'),
+            self.make_message(b'{"user_id": 1.5}'),
+            self.make_message(b'{"user_id": 3}'),
+        ]
+
+        # Act
+        await consumer.process_batch(messages)
+
+        # Assert
+        consumer.inventory_repository.add_for_users.assert_called_once_with(ANY, [3])
+
+    @pytest.mark.asyncio
+    async def test_process_batch_forgets_missing_inventories(self, consumer, mock_cache):
+        """Тест: после создания инвентарей снимаются отметки об их отсутствии"""
+        # Arrange
+        consumer.cache = mock_cache
+
+        # Act
+        await consumer.process_batch([self.make_message(b'{"user_id": 5}')])
+
+        # Assert
+        mock_cache.set_and_publish.assert_called_once_with(
+            "cache:local:invalidate", {"missing:inventory_5": b"0"}, expire=30
+        )
+
+    @pytest.mark.asyncio
+    async def test_process_batch_without_users(self, consumer):
+        """Тест пачки без валидных сообщений"""
+        # Act
+        result = await consumer.process_batch([self.make_message(b'[]')])
+
+        # Assert
+        assert result == 0
+        consumer.inventory_repository.add_for_users.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_partition_workers_track_offsets_per_partition(self, consumer):
+        """Тест параллельной обработки: оффсеты учитываются по партициям"""
+        # Arrange
+        consumer.consumer = AsyncMock()
+        first = [self.make_message(b'{"user_id": 1}'), self.make_message(b'{"user_id": 2}')]
+        first[0].offset, first[1].offset = 10, 11
+        second = [self.make_message(b'{"user_id": 3}')]
+        second[0].offset = 5
+
+        # Act
+        await consumer.get_partition_queue("tp-0").put(first)
+        await consumer.get_partition_queue("tp-1").put(second)
+        await consumer.drain_partitions(["tp-0", "tp-1"])
+
+        # Assert
+        consumer.consumer.commit.assert_called_once_with({"tp-0": 12, "tp-1": 6})
+        assert consumer.inventory_repository.add_for_users.call_count == 2
+        await consumer.stop_partition_workers()
+
+    @pytest.mark.asyncio
+    async def test_partition_worker_retries_failed_batch(self, consumer, monkeypatch):
+        """Тест повторной обработки пачки после ошибки БД"""
+        # Arrange
+        from app.exceptions import DatabaseError
+        monkeypatch.setattr("app.services.inventory_service.asyncio.sleep", AsyncMock())
+        consumer.consumer = AsyncMock()
+        consumer.inventory_repository.add_for_users = AsyncMock(
+            side_effect=[DatabaseError("db down"), 1]
+        )
+        message = self.make_message(b'{"user_id": 1}')
+        message.offset = 0
+
+        # Act
+        await consumer.get_partition_queue("tp-0").put([message])
+        await consumer.drain_partitions(["tp-0"])
+
+        # Assert
+        assert consumer.inventory_repository.add_for_users.call_count == 2
+        consumer.consumer.commit.assert_called_once_with({"tp-0": 1})
+
+
+    @pytest.mark.asyncio
+    async def test_partition_worker_skips_batch_after_retries(self, consumer, monkeypatch):
+        """Тест: после исчерпания повторов пачка пропускается, партиция не стоит"""
+        # Arrange
+        from app.exceptions import RepositoryError
+        monkeypatch.setattr("app.services.inventory_service.asyncio.sleep", AsyncMock())
+        consumer.consumer = AsyncMock()
+        consumer.max_retries = 2
+        consumer.inventory_repository.add_for_users = AsyncMock(
+            side_effect=RepositoryError("broken")
+        )
+        message = self.make_message(b'{"user_id": 1}')
+        message.offset = 0
+
+        # Act
+        await consumer.get_partition_queue("tp-0").put([message])
+        await consumer.drain_partitions(["tp-0"])
+
+        # Assert
+        assert consumer.inventory_repository.add_for_users.call_count == 3
+        consumer.consumer.commit.assert_called_once_with({"tp-0": 1})
+
+    @pytest.mark.asyncio
+    async def test_drain_partitions_is_bounded(self, consumer):
+        """Тест: зависшая партиция не задерживает ребалансировку дольше таймаута"""
+        # Arrange
+        consumer.consumer = AsyncMock()
+        consumer.drain_timeout_ms = 10
+
+        async def hang(user_ids):
+            await asyncio.sleep(10)
+
+        consumer.inventory_repository.add_for_users = AsyncMock(side_effect=hang)
+        message = self.make_message(b'{"user_id": 1}')
+        message.offset = 0
+
+        # Act
+        await consumer.get_partition_queue("tp-0").put([message])
+        await consumer.drain_partitions(["tp-0"])
+
+        # Assert
+        assert consumer._worker_tasks == {}
+        consumer.consumer.commit.assert_not_called()
+
+
+class TestCacheSerializer:
+    """Тесты для кодека значений кэша"""
+
+    def test_small_value_is_not_compressed(self):
+        """Тест: короткое значение хранится без сжатия с байтом формата"""
+        # Arrange
+        from app.codec import COMPRESSED, CacheSerializer, OrjsonCodec
+        serializer = CacheSerializer(OrjsonCodec(), compress_min_size=1024)
+
+        # Act
+        data = serializer.dumps({"id": 1})
+
+        # Assert
+        assert not data[0] & COMPRESSED
+        assert serializer.loads(data) == {"id": 1}
+
+    def test_large_value_is_compressed(self):
+        """Тест: значение больше порога сжимается и читается обратно"""
+        # Arrange
+        from app.codec import COMPRESSED, CacheSerializer, OrjsonCodec
+        serializer = CacheSerializer(OrjsonCodec(), compress_min_size=64)
+        value = {"script": "print('hello')\n" * 100}
+
+        # Act
+        data = serializer.dumps(value)
+
+        # Assert
+        assert data[0] & COMPRESSED
+        assert len(data) < len(json.dumps(value))
+        assert serializer.loads(data) == value
+
+    def test_unknown_format_is_rejected(self):
+        """Тест: значение в прежнем формате (JSON) не декодируется"""
+        # Act & Assert
+        with pytest.raises(ValueError):
+            cache_serializer.loads(json.dumps({"value": 1}).encode())
+
+    def test_incomplete_codec_is_rejected(self):
+        """Тест: кодек без loads не создаётся"""
+        # Arrange
+        from app.codec import CacheCodec
+
+        class DumpsOnlyCodec(CacheCodec):
+            codec_id = 3
+            name = "dumps-only"
+
+            def dumps(self, value):
+                return b""
+
+        # Act & Assert
+        with pytest.raises(TypeError):
+            DumpsOnlyCodec()
+
+
+class TestCacheBackend:
+    """Тесты таймаутов и размыкателя кэша"""
+
+    @pytest.fixture
+    def cache(self):
+        from app.cache import CacheBackend
+        cache = CacheBackend("redis://localhost:1", read_timeout_ms=10)
+        cache._client = AsyncMock()
+        cache.breaker.failure_threshold = 2
+        cache.breaker.reset_timeout = 60
+        return cache
+
+    @pytest.mark.asyncio
+    async def test_breaker_opens_after_consecutive_failures(self, cache):
+        """Тест: после ошибок подряд redis не вызывается"""
+        # Arrange
+        from redis.exceptions import ConnectionError as RedisConnectionError
+        from app.cache import CircuitBreaker
+        from app.exceptions import CacheUnavailableError
+        cache._client.get.side_effect = RedisConnectionError("down")
+
+        # Act
+        for _ in range(3):
+            with pytest.raises(CacheUnavailableError):
+                await cache.get("item_1")
+
+        # Assert
+        assert cache.breaker.state == CircuitBreaker.OPEN
+        assert cache._client.get.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_breaker_closes_after_successful_probe(self, cache):
+        """Тест: по истечении паузы пробный вызов замыкает размыкатель"""
+        # Arrange
+        from app.cache import CircuitBreaker
+        cache.breaker.record_failure()
+        cache.breaker.record_failure()
+        cache.breaker.opened_at -= 60
+        cache._client.get.return_value = b"1"
+
+        # Act
+        result = await cache.get("item_1")
+
+        # Assert
+        assert result == b"1"
+        assert cache.breaker.state == CircuitBreaker.CLOSED
+
+    @pytest.mark.asyncio
+    async def test_slow_operation_times_out(self, cache):
+        """Тест: медленный ответ redis прерывается таймаутом и считается ошибкой"""
+        # Arrange
+        from app.exceptions import CacheUnavailableError
+
+        async def slow_get(key):
+            await asyncio.sleep(1)
+
+        cache._client.get = slow_get
+
+        # Act
+        with pytest.raises(CacheUnavailableError):
+            await cache.get("item_1")
+
+        # Assert
+        assert cache.breaker.failures == 1
+
+    @pytest.mark.asyncio
+    async def test_failed_delete_is_replayed(self, cache):
+        """Тест: несостоявшееся удаление повторяется после восстановления redis"""
+        # Arrange
+        from redis.exceptions import ConnectionError as RedisConnectionError
+        from app.exceptions import CacheUnavailableError
+        cache._client.pipeline = MagicMock(side_effect=RedisConnectionError("down"))
+        with pytest.raises(CacheUnavailableError):
+            await cache.invalidate("cache:local:invalidate", "item_1")
+        replayed = []
+
+        async def invalidate(channel, *keys):
+            replayed.extend(keys)
+
+        cache.invalidate = invalidate
+        cache._client.get.return_value = None
+
+        # Act
+        await cache.get("item_2")
+        await asyncio.sleep(0)
+
+        # Assert
+        assert replayed == ["item_1"]
+        assert not cache._pending_deletes
+
+
+class TestQueryCache:
+    """Тесты для кэша запросов репозиториев"""
+
+    @pytest.fixture
+    def backend(self, monkeypatch):
+        from app.query_cache import query_cache
+        backend = AsyncMock()
+        backend.get_tagged.return_value = ("q:item.by_id:k:3.0", None)
+        monkeypatch.setattr("app.query_cache.settings.QUERY_CACHE_ENABLED", True)
+        query_cache.configure(backend)
+        yield backend
+        query_cache.configure(None)
+
+    @pytest.fixture
+    def repository(self):
+        from app.query_cache import cached_query, invalidates
+
+        class ItemRepo:
+            model = Item
+            load = AsyncMock(return_value=Item(id=1, name="a", kind=ItemKind.CONSUMABLE))
+
+            @classmethod
+            @cached_query(
+                "{model}.by_id",
+                tags=("{model}", "{model}:{data_id}"),
+                schema=lambda cls: cls.model | None
+            )
+            async def find(cls, data_id: int):
+                return await cls.load(data_id)
+
+            @classmethod
+            @invalidates("{model}", result_tags=lambda user_ids: [f"inventory:{u}" for u in user_ids])
+            async def give(cls, item_id: int):
+                return [7]
+
+            @classmethod
+            @cached_query("{model}.by_id", tags=("{model}",))
+            async def find_in(cls, session, data_id: int):
+                return await cls.load(data_id)
+
+            @classmethod
+            @invalidates("{model}")
+            async def give_in(cls, session, item_id: int):
+                return None
+
+        return ItemRepo
+
+    @pytest.mark.asyncio
+    async def test_miss_stores_result_under_tagged_key(self, backend, repository):
+        """Тест: промах читает БД и сохраняет результат под ключом с версиями тегов"""
+        # Act
+        result = await repository.find(1)
+
+        # Assert
+        assert result.name == "a"
+        prefix, *tags = backend.get_tagged.call_args.args
+        assert prefix.startswith("q:item.by_id:")
+        assert tags == ["qtag:item", "qtag:item:1"]
+        key, value = backend.set.call_args.args
+        assert key == "q:item.by_id:k:3.0"
+        assert cache_serializer.loads(value)["name"] == "a"
+        assert backend.set.call_args.kwargs == {"expire": 60}
+
+    @pytest.mark.asyncio
+    async def test_hit_skips_database(self, backend, repository):
+        """Тест: попадание восстанавливает модель без запроса к БД"""
+        # Arrange
+        backend.get_tagged.return_value = ("key", cache_serializer.dumps({"id": 1, "name": "cached"}))
+
+        # Act
+        result = await repository.find(1)
+
+        # Assert
+        assert isinstance(result, Item)
+        assert result.name == "cached"
+        repository.load.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_unavailable_cache_reads_database(self, backend, repository):
+        """Тест: ошибка redis не ломает чтение"""
+        # Arrange
+        from app.exceptions import CacheUnavailableError
+        backend.get_tagged.side_effect = CacheUnavailableError("open")
+
+        # Act
+        result = await repository.find(1)
+
+        # Assert
+        assert result.name == "a"
+        backend.set.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_family_ttl_override(self, backend, repository, monkeypatch):
+        """Тест: срок семейства берётся из QUERY_CACHE_FAMILY_TTL"""
+        # Arrange
+        monkeypatch.setattr("app.query_cache.settings.QUERY_CACHE_FAMILY_TTL", {"item.by_id": 300})
+
+        # Act
+        await repository.find(1)
+
+        # Assert
+        assert backend.set.call_args.kwargs == {"expire": 300}
+
+    @pytest.mark.asyncio
+    async def test_write_bumps_tags(self, backend, repository):
+        """Тест: метод записи увеличивает версии своих тегов и тегов из результата"""
+        # Act
+        await repository.give(1)
+
+        # Assert
+        backend.bump_tags.assert_called_once_with("qtag:item", "qtag:inventory:7", expire=86400)
+
+    @pytest.mark.asyncio
+    async def test_write_in_unit_of_work_bumps_tags_after_commit(self, backend, repository, request_session):
+        """Тест: теги записи в единице работы сбрасываются только после её коммита"""
+        # Act
+        await repository.give_in(request_session, 1)
+        await repository.give_in(request_session, 2)
+        backend.bump_tags.assert_not_called()
+        await run_after_commit(request_session)
+
+        # Assert
+        backend.bump_tags.assert_called_once_with("qtag:item", expire=86400)
+
+    @pytest.mark.asyncio
+    async def test_unit_of_work_with_writes_reads_database(self, backend, repository, request_session):
+        """Тест: после записи чтения единицы работы идут мимо кэша"""
+        # Arrange
+        await repository.find_in(request_session, 1)
+        await repository.give_in(request_session, 1)
+
+        # Act
+        await repository.find_in(request_session, 1)
+
+        # Assert
+        backend.get_tagged.assert_called_once()
+        assert repository.load.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_disabled_cache_is_passthrough(self, repository):
+        """Тест: без QUERY_CACHE_ENABLED методы выполняются без кэша"""
+        # Arrange
+        from app.query_cache import query_cache
+        backend = AsyncMock()
+        query_cache.configure(backend)
+
+        # Act
+        await repository.find(1)
+        await repository.give(1)
+
+        # Assert
+        repository.load.assert_called_once_with(1)
+        backend.get_tagged.assert_not_called()
+        backend.bump_tags.assert_not_called()
+
+
+class TestBatchLoader:
+    """Тесты для пакетного загрузчика"""
+
+    @pytest.mark.asyncio
+    async def test_concurrent_loads_share_one_query(self):
+        """Тест: одновременные запросы ключей выполняются одной загрузкой"""
+        # Arrange
+        from app.dataloader import BatchLoader
+        load_many = AsyncMock(return_value={1: "a", 2: "b"})
+        loader = BatchLoader("test", load_many)
+
+        # Act
+        result = await asyncio.gather(*(loader.load(key) for key in (1, 2, 1, 3)))
+
+        # Assert
+        assert result == ["a", "b", "a", None]
+        load_many.assert_called_once_with([1, 2, 3])
+
+    @pytest.mark.asyncio
+    async def test_max_batch_splits_loads(self):
+        """Тест: пачка уходит сразу по достижении max_batch"""
+        # Arrange
+        from app.dataloader import BatchLoader
+        load_many = AsyncMock(side_effect=lambda keys: {key: key * 10 for key in keys})
+        loader = BatchLoader("test", load_many, max_batch=2)
+
+        # Act
+        result = await asyncio.gather(*(loader.load(key) for key in (1, 2, 3)))
+
+        # Assert
+        assert result == [10, 20, 30]
+        assert [call.args[0] for call in load_many.call_args_list] == [[1, 2], [3]]
+
+    @pytest.mark.asyncio
+    async def test_load_error_reaches_every_caller(self):
+        """Тест: ошибка загрузки пачки получают все ожидающие"""
+        # Arrange
+        from app.dataloader import BatchLoader
+        from app.exceptions import DatabaseError
+        loader = BatchLoader("test", AsyncMock(side_effect=DatabaseError("down")))
+
+        # Act
+        result = await asyncio.gather(loader.load(1), loader.load(2), return_exceptions=True)
+
+        # Assert
+        assert all(isinstance(error, DatabaseError) for error in result)
+
+    @pytest.mark.asyncio
+    async def test_cancelled_caller_does_not_cancel_batch(self):
+        """Тест: отмена одного вызывающего не отменяет загрузку для остальных"""
+        # Arrange
+        from app.dataloader import BatchLoader
+
+        async def slow_load(keys):
+            await asyncio.sleep(0.01)
+            return {key: key for key in keys}
+
+        loader = BatchLoader("test", slow_load)
+        first = asyncio.ensure_future(loader.load(1))
+        second = asyncio.ensure_future(loader.load(1))
+        await asyncio.sleep(0)
+
+        # Act
+        first.cancel()
+
+        # Assert
+        assert await second == 1
+
+
+class TestGroupCommitWriter:
+    """Тесты для групповой записи"""
+
+    @pytest.mark.asyncio
+    async def test_concurrent_mutations_share_one_batch(self):
+        """Тест: изменения окна применяются одной пачкой, ошибки достаются своим вызывающим"""
+        # Arrange
+        from app.group_commit import GroupCommitWriter
+        apply_batch = AsyncMock(return_value=[1, NotFoundError("missing"), 3])
+        writer = GroupCommitWriter("test", apply_batch, window_ms=1, max_batch=10)
+
+        # Act
+        result = await asyncio.gather(
+            *(writer.submit(mutation) for mutation in ("a", "b", "c")),
+            return_exceptions=True
+        )
+
+        # Assert
+        assert result[0] == 1 and result[2] == 3
+        assert isinstance(result[1], NotFoundError)
+        apply_batch.assert_called_once_with(["a", "b", "c"])
+
+    @pytest.mark.asyncio
+    async def test_max_batch_flushes_immediately(self):
+        """Тест: пачка уходит сразу по достижении max_batch"""
+        # Arrange
+        from app.group_commit import GroupCommitWriter
+        apply_batch = AsyncMock(side_effect=lambda batch: [m * 10 for m in batch])
+        writer = GroupCommitWriter("test", apply_batch, window_ms=1000, max_batch=2)
+
+        # Act
+        result = await asyncio.wait_for(
+            asyncio.gather(writer.submit(1), writer.submit(2)), timeout=0.5
+        )
+
+        # Assert
+        assert result == [10, 20]
+
+    @pytest.mark.asyncio
+    async def test_batch_error_reaches_every_caller(self):
+        """Тест: ошибку транзакции пачки получают все вызывающие"""
+        # Arrange
+        from app.exceptions import DatabaseError
+        from app.group_commit import GroupCommitWriter
+        writer = GroupCommitWriter(
+            "test", AsyncMock(side_effect=DatabaseError("down")), window_ms=1, max_batch=10
+        )
+
+        # Act
+        result = await asyncio.gather(writer.submit(1), writer.submit(2), return_exceptions=True)
+
+        # Assert
+        assert all(isinstance(error, DatabaseError) for error in result)
+
+
+class TestReplicaRouting:
+    """Тесты для чтения с реплик"""
+
+    @staticmethod
+    def fake_replica(name):
+        from app.replicas import Replica
+        replica = Replica(name, MagicMock())
+        replica.session = MagicMock()
+        replica.session.info = {}
+
+        @asynccontextmanager
+        async def begin():
+            yield
+
+        @asynccontextmanager
+        async def session_maker():
+            yield replica.session
+
+        replica.session.begin = begin
+        replica.session_maker = session_maker
+        return replica
+
+    @pytest.fixture
+    def router(self, monkeypatch):
+        from app.replicas import replica_router
+        monkeypatch.setattr(
+            replica_router, "replicas", [self.fake_replica("test0"), self.fake_replica("test1")]
+        )
+        monkeypatch.setattr(replica_router, "_next", 0)
+        backend = AsyncMock()
+        backend.get_many.return_value = [None]
+        replica_router.configure(backend)
+        yield replica_router
+        replica_router.configure(None)
+
+    @pytest.fixture
+    def repository(self):
+        from app.replicas import replica_read
+
+        class InventoryRepo:
+            model = Inventory
+            load = AsyncMock(return_value="inventory")
+
+            @classmethod
+            @replica_read("{model}:{user_id}")
+            async def get(cls, session, user_id: int):
+                return await cls.load(session, user_id)
+
+        return InventoryRepo
+
+    @pytest.mark.asyncio
+    async def test_reads_rotate_over_replicas(self, router, repository, request_session):
+        """Тест: чтения идут на реплики по кругу"""
+        # Act
+        await repository.get(request_session, 1)
+        await repository.get(request_session, 1)
+
+        # Assert
+        sessions = [call.args[0] for call in repository.load.call_args_list]
+        assert sessions == [router.replicas[0].session, router.replicas[1].session]
+        router.backend.get_many.assert_called_with("written:inventory:1")
+
+    @pytest.mark.asyncio
+    async def test_recent_write_reads_primary(self, router, repository, request_session):
+        """Тест: в окне чтения своих записей данные читаются с основной БД"""
+        # Arrange
+        router.backend.get_many.return_value = [b"1"]
+
+        # Act
+        await repository.get(request_session, 1)
+
+        # Assert
+        repository.load.assert_called_once_with(request_session, 1)
+
+    @pytest.mark.asyncio
+    async def test_inventory_write_reads_item_holders_from_primary(self, router, request_session, monkeypatch):
+        """Тест: после изменения инвентаря владельцы предмета читаются с основной БД"""
+        # Arrange
+        from app.repositories.inventory_repo import InventoryRepository
+        router.backend.get_many.return_value = [None, b"1"]
+        get_item = AsyncMock(side_effect=NotFoundError("Item with ID 1 not found"))
+        monkeypatch.setattr(InventoryRepository, "_get_item_or_raise", get_item)
+
+        # Act & Assert
+        with pytest.raises(NotFoundError):
+            await InventoryRepository.get_inventories_with_item(request_session, 1)
+        router.backend.get_many.assert_called_once_with("written:item", "written:inventory")
+        get_item.assert_called_once_with(request_session, 1)
+
+    @pytest.mark.asyncio
+    async def test_dirty_unit_of_work_reads_primary(self, router, repository, request_session):
+        """Тест: единица работы, менявшая данные, читает свои изменения с основной БД"""
+        # Arrange
+        from app.query_cache import invalidate_on_commit
+        invalidate_on_commit(request_session, "inventory:1")
+
+        # Act
+        await repository.get(request_session, 1)
+
+        # Assert
+        repository.load.assert_called_once_with(request_session, 1)
+        router.backend.get_many.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_replica_error_falls_back_to_primary(self, router, repository, request_session):
+        """Тест: ошибка реплики повторяет чтение на основной БД и исключает реплику"""
+        # Arrange
+        from app.exceptions import DatabaseError
+        repository.load.side_effect = [DatabaseError("replica down"), "primary", "replica"]
+
+        # Act
+        first = await repository.get(request_session, 1)
+        second = await repository.get(request_session, 1)
+
+        # Assert
+        assert (first, second) == ("primary", "replica")
+        sessions = [call.args[0] for call in repository.load.call_args_list]
+        assert sessions == [router.replicas[0].session, request_session, router.replicas[1].session]
+        assert not router.replicas[0].healthy
+        assert router.choose() is router.replicas[1]
+
+    @pytest.mark.asyncio
+    async def test_commit_marks_written_tags(self, router, request_session, monkeypatch):
+        """Тест: после коммита изменённые теги отмечаются на окно чтения своих записей"""
+        # Arrange
+        from app.query_cache import invalidate_on_commit
+        monkeypatch.setattr("app.replicas.settings.DB_REPLICA_READ_YOUR_WRITES", 5)
+        invalidate_on_commit(request_session, "inventory", "inventory:1")
+
+        # Act
+        await run_after_commit(request_session)
+
+        # Assert
+        router.backend.set_many.assert_called_once_with(
+            {"written:inventory": b"1", "written:inventory:1": b"1"}, expire=5
+        )
+
+
+class TestUnitOfWork:
+    """Тесты для единицы работы запроса"""
+
+    @pytest.mark.asyncio
+    async def test_after_commit_runs_after_commit(self):
+        """Тест: действия после коммита выполняются при выходе без ошибки, ошибка действия не прерывает остальные"""
+        # Arrange
+        from app.database import after_commit, unit_of_work
+        failing = AsyncMock(side_effect=RuntimeError("cache down"))
+        callback = AsyncMock()
+
+        # Act
+        async with unit_of_work() as session:
+            after_commit(session, failing)
+            after_commit(session, callback)
+            callback.assert_not_called()
+
+        # Assert
+        callback.assert_awaited_once()
+
+    @pytest.mark.asyncio
+    async def test_rollback_discards_after_commit(self):
+        """Тест: при ошибке транзакция откатывается, действия после коммита не выполняются"""
+        # Arrange
+        from app.database import after_commit, unit_of_work
+        callback = AsyncMock()
+
+        # Act & Assert
+        with pytest.raises(NotFoundError):
+            async with unit_of_work() as session:
+                after_commit(session, callback)
+                raise NotFoundError("missing")
+        callback.assert_not_called()
+
+
+class TestNegativeCache:
+    """Тесты отметок об отсутствии сущностей"""
+
+    @pytest.fixture
+    def redis(self):
+        """Ключи redis в словаре: SET NX не перезаписывает существующий"""
+        store = {}
+        cache = AsyncMock()
+        cache.get.side_effect = store.get
+
+        async def set_if_absent(key, value, expire):
+            if key in store:
+                return False
+            store[key] = value
+            return True
+
+        async def set_and_publish(channel, mapping, expire):
+            store.update(mapping)
+
+        cache.set_if_absent.side_effect = set_if_absent
+        cache.set_and_publish.side_effect = set_and_publish
+        return cache
+
+    @pytest.mark.asyncio
+    async def test_remember_after_forget_keeps_created_entity(self, redis):
+        """Тест: отметка от проверки до коммита создания не скрывает созданную сущность"""
+        # Arrange
+        from app.cache import LocalCache, NegativeCache
+        reader = NegativeCache(LocalCache(maxsize=10, ttl=60))
+        creator = NegativeCache(LocalCache(maxsize=10, ttl=60))
+
+        # Act
+        # Читатель проверил БД до коммита, создатель снял отметку раньше,
+        # чем читатель её записал
+        await creator.forget(redis, "missing:inventory_1")
+        await reader.remember(redis, "missing:inventory_1")
+
+        # Assert
+        assert not await reader.is_missing(redis, "missing:inventory_1")
+        assert not await creator.is_missing(redis, "missing:inventory_1")
+
+    @pytest.mark.asyncio
+    async def test_remember_before_forget(self, redis):
+        """Тест: отсутствие запоминается и снимается созданием"""
+        # Arrange
+        from app.cache import LocalCache, NegativeCache
+        negative = NegativeCache(LocalCache(maxsize=10, ttl=60))
+
+        # Act
+        await negative.remember(redis, "missing:item_1")
+        remembered = await negative.is_missing(redis, "missing:item_1")
+        await negative.forget(redis, "missing:item_1")
+
+        # Assert
+        assert remembered
+        assert not await negative.is_missing(redis, "missing:item_1")
+
+
+class TestLocalCacheInvalidator:
+    """Тесты для инвалидации локальных кэшей"""
+
+    @pytest.mark.asyncio
+    async def test_run_drops_published_keys(self, mock_cache, monkeypatch):
+        """Тест: ключи из канала удаляются, при обрыве подписки кэш очищается"""
+        # Arrange
+        from app.cache import LocalCacheInvalidator
+        local_cache = LocalCache(maxsize=16, ttl=60)
+        seen = []
+
+        closed = []
+
+        async def messages():
+            local_cache.set("item_1", 1)
+            local_cache.set("item_2", 2)
+            yield json.dumps(["item_1"]).encode()
+            seen.append(local_cache.get("item_1"))
+            seen.append(local_cache.get("item_2"))
+
+        @asynccontextmanager
+        async def subscribe(channel):
+            try:
+                yield messages()
+            finally:
+                closed.append(channel)
+
+        mock_cache.subscribe = subscribe
+
+        async def stop(delay):
+            raise asyncio.CancelledError
+
+        monkeypatch.setattr("app.cache.asyncio.sleep", stop)
+
+        # Act
+        with pytest.raises(asyncio.CancelledError):
+            await LocalCacheInvalidator(mock_cache, local_cache).run()
+
+        # Assert
+        assert seen == [None, 2]
+        assert len(local_cache) == 0
+        assert closed == ["cache:local:invalidate"]
+
+
+class TestOutboxRelay:
+    """Тесты для отправки событий outbox в kafka"""
+
+    @pytest.fixture
+    def producer(self):
+        producer = AsyncMock()
+        producer.send.side_effect = lambda **kwargs: asyncio.sleep(0)
+        return producer
+
+    @pytest.mark.asyncio
+    async def test_publish_sends_batch_and_waits_for_acks(self, producer):
+        """Тест отправки пачки событий без send_and_wait"""
+        # Arrange
+        relay = OutboxRelay(producer)
+        events = [
+            OutboxEvent(id=1, topic="shop.inventory.updates", key="1", payload="{}"),
+            OutboxEvent(id=2, topic="shop.inventory.updates", key=None, payload="{}"),
+        ]
+
+        # Act
+        await relay.publish(events)
+
+        # Assert
+        assert producer.send.call_count == 2
+        producer.send_and_wait.assert_not_called()
+        assert producer.send.call_args_list[0].kwargs["key"] == b"1"
+        assert producer.send.call_args_list[1].kwargs["key"] is None
+
+    @pytest.mark.asyncio
+    async def test_publish_failure_propagates(self, producer):
+        """Тест, что ошибка брокера не помечает события доставленными"""
+        # Arrange
+        producer.send.side_effect = Exception("broker down")
+        relay = OutboxRelay(producer)
+        events = [OutboxEvent(id=1, topic="t", key="1", payload="{}")]
+
+        # Act & Assert
+        with pytest.raises(Exception, match="broker down"):
+            await relay.publish(events)
+
+    def test_inventory_event_is_keyed_by_user(self):
+        """Тест формата события изменения инвентаря"""
+        # Act
+        event = inventory_event(user_id=7, item_id=3, delta=-2, amount=5, version=11)
+
+        # Assert
+        assert event.topic == "inventory.changes"
+        assert event.key == "7"
+        assert json.loads(event.payload) == {
+            "user_id": 7, "item_id": 3, "delta": -2, "amount": 5, "version": 11
+        }